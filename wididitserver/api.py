@@ -15,11 +15,17 @@
 
 from django.conf.urls.defaults import patterns, include, url
 from django.core.context_processors import csrf
-from django.http import HttpResponse
-from django.db import IntegrityError
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http import HttpResponseNotAllowed, HttpResponseForbidden
+from django.http import QueryDict
+from django.views.decorators.csrf import csrf_exempt
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q, Max, Count
+from django.db.models.query import QuerySet, prefetch_related_objects
 
 from piston.authentication import OAuthAuthentication, HttpBasicAuthentication
-from piston.handler import BaseHandler, AnonymousBaseHandler
+from piston.handler import BaseHandler, AnonymousBaseHandler, typemapper
+from piston.emitters import Emitter
 from piston.utils import validate
 from piston.utils import rc
 from piston.models import Consumer, Token
@@ -27,22 +33,32 @@ from piston.models import Consumer, Token
 from wididit import constants
 from wididit import utils
 
-from wididitserver.models import Server, People, Entry, User, Share
-from wididitserver.models import PeopleSubscription
+from wididitserver.models import Server, People, Entry, User, Share, Tag
+from wididitserver.models import PeopleSubscription, TimelineEntry
 from wididitserver.models import ServerForm, PeopleForm, EntryForm
 from wididitserver.models import PeopleSubscriptionForm, ShareForm
-from wididitserver.models import get_server, get_people
+from wididitserver.models import get_server, get_people, get_people_list
+from wididitserver.models import timelines_enabled, thread_ancestors
+from wididitserver.models import FederationState
 from wididitserver.utils import settings
 import wididitserver.utils as serverutils
+from wididitserver import search
+from wididitserver import atom # Registers the Atom emitter
+from wididitserver import ndjson
+from wididitserver import federation
 from wididitserver.pistonextras import ConsumerForm, TokenForm
 from wididitserver.pistonextras import StrictOAuthAuthentication
+from wididitserver.pistonextras import cached_authenticate
 from wididitserver.pistonextras import CsrfExemptResource as Resource
+from wididitserver.pistonextras import set_response_header, not_modified
+from wididitserver.pistonextras import streaming
 
 
 ##########################################################################
 # Utils
 
-http_auth = HttpBasicAuthentication(realm='Wididit server')
+http_auth = HttpBasicAuthentication(auth_func=cached_authenticate,
+        realm='Wididit server')
 oauth_auth = OAuthAuthentication(realm='Wididit server')
 auth = http_auth
 
@@ -78,32 +94,48 @@ server_handler = Resource(ServerHandler, authentication=auth)
 class AnonymousPeopleHandler(AnonymousBaseHandler):
     allowed_methods = ('GET', 'POST',)
     model = People
-    fields = ('username', 'server', 'biography')
+    fields = ('username', 'server', 'biography', 'follower_count',
+            'following_count')
 
     def read(self, request, userid=None):
         """Returns either a list of all people registered, or the
         user matching the username (wildcard not allowed)."""
         if userid is None:
-            return People.objects.all()
+            stats = People.objects.aggregate(count=Count('id'),
+                    updated=Max('updated'))
+            # No Last-Modified: the date would not change when people are
+            # deleted.
+            if not_modified(request, sorted(stats.items())):
+                return HttpResponseNotModified()
+            return People.objects.select_related('server')
         else:
             try:
-                return get_people(userid)
+                people = get_people(userid)
+                # The identity cache is per process, so it may be stale.
+                people = People.objects.select_related('server') \
+                        .get(id=people.id)
             except People.DoesNotExist:
                 return rc.NOT_FOUND
             except Server.DoesNotExist:
                 return rc.NOT_FOUND
+            if not_modified(request, people_version(people), people.updated):
+                return HttpResponseNotModified()
+            return people
 
     @validate(PeopleForm, 'POST')
     def create(self, request):
-        people = request.form.save(commit=False)
         # FIXME: if creating a remote user, make sure he exists.
         try:
-            people.save()
-            response = rc.CREATED
-            response.content = str(people.userid())
-            return response
+            # The form creates the User of local people, whose username
+            # may be taken too; the rollback leaves neither behind.
+            with transaction.commit_on_success():
+                people = request.form.save(commit=False)
+                people.save()
         except IntegrityError:
             return rc.DUPLICATE_ENTRY
+        response = rc.CREATED
+        response.content = str(people.userid())
+        return response
 
 class PeopleHandler(BaseHandler):
     allowed_methods = ('GET', 'POST', 'PUT',)
@@ -198,35 +230,200 @@ class PeopleSubscriptionHandler(BaseHandler):
 people_subscription_handler = Resource(PeopleSubscriptionHandler,
         authentication=auth)
 
+class PeopleSubscriptionBatchHandler(BaseHandler):
+    allowed_methods = ('POST',)
+
+    @transaction.commit_on_success
+    def create(self, request, userid):
+        """Subscribes to the people in `subscribe` and unsubscribes from
+        the people in `unsubscribe` (lists of userids, given as form fields
+        or in a JSON object). Returns the status of each userid:
+        'subscribed', 'already subscribed', 'unsubscribed',
+        'not subscribed' or 'not found'."""
+        subscriber = get_people(userid)
+        if subscriber.user != request.user:
+            return HttpResponseForbidden()
+        data = getattr(request, 'data', None)
+        if isinstance(data, QueryDict):
+            # Form fields: get() would only return the last value.
+            subscribe = data.getlist('subscribe')
+            unsubscribe = data.getlist('unsubscribe')
+        elif isinstance(data, dict):
+            subscribe = data.get('subscribe', [])
+            unsubscribe = data.get('unsubscribe', [])
+        else:
+            return rc.BAD_REQUEST
+        if not isinstance(subscribe, list) or \
+                not isinstance(unsubscribe, list) or \
+                not all(isinstance(x, basestring)
+                    for x in subscribe + unsubscribe):
+            return rc.BAD_REQUEST
+        if len(subscribe) + len(unsubscribe) > \
+                getattr(settings, 'WIDIDIT_MAX_BATCH_SIZE', 1000):
+            response = rc.BAD_REQUEST
+            response.content = 'Too many userids.'
+            return response
+
+        people = get_people_list(subscribe + unsubscribe)
+        status = {'subscribe': {}, 'unsubscribe': {}}
+        created = PeopleSubscription.objects.subscribe_many(subscriber,
+                [people[x] for x in subscribe if x in people])
+        for userid in subscribe:
+            if userid not in people:
+                status['subscribe'][userid] = 'not found'
+            elif people[userid].id in created:
+                status['subscribe'][userid] = 'subscribed'
+            else:
+                status['subscribe'][userid] = 'already subscribed'
+
+        targets = [people[x].id for x in unsubscribe if x in people]
+        subscriptions = PeopleSubscription.objects.filter(
+                subscriber=subscriber, target_people__in=targets)
+        deleted = set(subscriptions.values_list('target_people', flat=True))
+        # Deleting through the queryset still sends the post_delete signals.
+        subscriptions.delete()
+        for userid in unsubscribe:
+            if userid not in people:
+                status['unsubscribe'][userid] = 'not found'
+            elif people[userid].id in deleted:
+                status['unsubscribe'][userid] = 'unsubscribed'
+            else:
+                status['unsubscribe'][userid] = 'not subscribed'
+        return status
+
+people_subscription_batch_handler = Resource(PeopleSubscriptionBatchHandler,
+        authentication=auth)
+
 
 ##########################################################################
 # Entry
 
+_RELATED_LOOKUPS = ('contributors__server', 'share_set__people__server')
+
+def _select_related(query):
+    return query.select_related('author__server', 'author__user')
+
+def _load_related(query):
+    return _select_related(query).prefetch_related(*_RELATED_LOOKUPS)
+
+def load_related(entries):
+    """Loads what is serialized with entries loaded by _select_related()
+    (like AnonymousEntryHandler.prefetch does)."""
+    prefetch_related_objects(entries, _RELATED_LOOKUPS)
+    load_parents(entries)
+
+def load_parents(entries):
+    """Loads the entries the entries reply to, recursively, with what is
+    serialized with them, and sets their in_reply_to. Most of them are
+    known from the thread paths, so it runs a few queries whatever the
+    depth of the threads."""
+    cache_name = Entry._meta.get_field('in_reply_to').get_cache_name()
+    known = dict((x.id, x) for x in entries)
+    pending = list(entries)
+    while pending:
+        wanted = set()
+        for entry in pending:
+            if entry.in_reply_to_id is not None and \
+                    entry.in_reply_to_id not in known:
+                wanted.add(entry.in_reply_to_id)
+                wanted.update(thread_ancestors(entry))
+        wanted -= set(known)
+        pending = list(_load_related(Entry.objects
+            .filter(id__in=wanted))) if wanted else []
+        known.update((x.id, x) for x in pending)
+    for entry in known.values():
+        if entry.in_reply_to_id in known:
+            setattr(entry, cache_name, known[entry.in_reply_to_id])
+
+def people_version(people):
+    """Returns what identifies the current version of the people as they
+    are serialized."""
+    return (people.id, people.updated, people.follower_count,
+            people.following_count)
+
+def entry_versions(entries):
+    """Returns what identifies the current version of the entries as they
+    are serialized (with their authors, contributors, shares and parents),
+    from the entries loaded by _select_related() and a single aggregate
+    query over them and their parents. It is computed before the related
+    objects are loaded, so a conditional GET costs only these two
+    queries."""
+    versions = [(x.id, x.updated, x.reply_count, x.share_count,
+        people_version(x.author)) for x in entries]
+    ids = set(x.id for x in entries)
+    for entry in entries:
+        ids.update(thread_ancestors(entry))
+    if not ids:
+        return versions
+    # The dates of update of the people are also bumped by the changes of
+    # their counters.
+    stats = Entry.objects.filter(id__in=ids).aggregate(
+            count=Count('id', distinct=True),
+            updated=Max('updated'),
+            authors=Max('author__updated'),
+            contributors=Max('contributors__updated'),
+            shares=Count('share', distinct=True),
+            sharers=Max('share__people__updated'))
+    return versions, sorted(stats.items())
+
+class _EntryQuerySet(QuerySet):
+    """Loads the parents of the entries with load_parents() when it loads
+    their related objects."""
+    def _prefetch_related_objects(self):
+        super(_EntryQuerySet, self)._prefetch_related_objects()
+        load_parents(self._result_cache)
+
 class AnonymousEntryHandler(AnonymousBaseHandler):
     allowed_methods = ('GET',)
     model = Entry
     fields = ('id', 'title', 'author', 'contributors',
             'subtitle', 'summary', 'category', 'generator', 'rights', 'source',
-            'content', 'in_reply_to', 'shared_by', 'published', 'updated')
+            'content', 'in_reply_to', 'shared_by', 'published', 'updated',
+            'thread_depth', 'reply_count', 'share_count', 'content_length')
 
     def read(self, request, mode=None, userid=None, entryid=None):
         """Returns either a list of notices (either from everybody if
         `userid` is not given, either from the `userid`) or an entry if
-        `userid` AND `id` are given."""
+        `userid` AND `id` are given.
+
+        Lists are paginated: `?limit=` sets the size of the page, and the
+        X-Wididit-Before and X-Wididit-After headers of the response give
+        the cursors to pass as `?before=` or `?after=` to get older or
+        newer entries. Without cursor, the newest entries are returned,
+        except with the `jsonstream` format, which returns all of them.
+        With the search index enabled, `?order=relevance` sorts the results
+        of a `?content=` search by relevance instead.
+
+        With the `thread` mode, returns the entry and its replies,
+        recursively, sorted depth-first (each entry is followed by its
+        replies, in the order they were posted); `?depth=` limits the
+        number of levels of replies, and `?limit=` the number of entries.
+
+        Responses (except the streamed ones) have an ETag header, computed
+        from the entries returned, and requests with a matching
+        If-None-Match get a 304 response, without loading the related
+        objects of the entries or serializing anything."""
 
         # Display a single entry
         if entryid is not None:
             assert userid is not None
-            assert mode is None
+            assert mode in (None, 'thread')
             if userid is not None:
                 try:
                     user = get_people(userid)
-                except People.DoesNotExist:
+                except (People.DoesNotExist, Server.DoesNotExist):
                     return rc.NOT_FOUND
+            query = Entry.objects.filter(author=user, id2=entryid)
+            if mode == 'thread':
+                return self.read_thread(request, query)
             try:
-                return Entry.objects.get(author=user, id2=entryid)
+                entry = _select_related(query).get()
             except Entry.DoesNotExist:
                 return rc.NOT_FOUND
+            if not_modified(request, entry_versions([entry])):
+                return HttpResponseNotModified()
+            load_related([entry])
+            return entry
 
         # Display multiple entries
         fields = dict(request.GET)
@@ -241,6 +438,13 @@ class AnonymousEntryHandler(AnonymousBaseHandler):
             # Why should we query the database for that?
             return []
 
+        # People whose entries (written or shared) are listed, as a list or
+        # a queryset; None for everybody.
+        authors = None
+        # Subscriber whose materialized timeline is read.
+        subscriber = None
+        query = Entry.objects.all()
+
         if mode == 'timeline':
             # Display (shared?) entries from people the user subscribed to.
 
@@ -253,61 +457,57 @@ class AnonymousEntryHandler(AnonymousBaseHandler):
                 # Authenticated, but not a people.
                 return rc.FORBIDDEN
 
-            query_native = query_shared = Entry.objects.none()
-
-            # The list of people we subscribed to.
-            authors = PeopleSubscription.objects.filter(subscriber=people)
-            authors = [x.target_people for x in authors]
-
-            if enable_native:
-                query_native = Entry.objects.filter(author__in=authors)
-
-            if enable_shared:
-                shares = Share.objects.filter(people__in=authors)
-                entryids = [x.entry.id for x in shares]
-                query_shared = Entry.objects.filter(id__in=entryids)
-
-            # Merge results.
-            query = query_native or query_shared
-        else:
-            if enable_native:
-                # Obviously, all shared entries also exist as native
-                query = Entry.objects.all()
+            if timelines_enabled():
+                # Read the timeline materialized by the Entry, Share and
+                # PeopleSubscription signals.
+                filters = {'timeline_entries__subscriber': people}
+                if not enable_native:
+                    filters['timeline_entries__sharer__isnull'] = False
+                elif not enable_shared:
+                    filters['timeline_entries__sharer'] = None
+                query = query.filter(**filters).distinct()
+                subscriber = people
             else:
-                assert enable_shared, 'Run memcheck! enable_native and ' +\
-                        'enable_shared weren\'t both False before.'
-                entryids = [x.entry.id for x in Share.objects.all()]
-                query = Entry.objects.filter(id__in=entryids)
+                # The people we subscribed to, as a subquery.
+                authors = People.objects.filter(id__in=PeopleSubscription \
+                        .objects.filter(subscriber=people) \
+                        .values('target_people'))
+        elif not enable_native:
+            assert enable_shared, 'Run memcheck! enable_native and ' +\
+                    'enable_shared weren\'t both False before.'
+            if 'author' not in fields:
+                query = query.filter(share__isnull=False)
 
         if 'author' in fields:
-            query_native = query_shared = Entry.objects.none()
-
-            authors = []
+            ids = []
             for author in fields['author']:
                 try:
-                    authors.append(get_people(author))
+                    ids.append(get_people(author).id)
                 except People.DoesNotExist:
                     continue
-            if enable_native:
-                query_native = query.filter(author__in=authors)
-
-            if enable_shared:
-                shares = Share.objects.filter(people__in=authors)
-                entryids = [x.entry.id for x in shares]
-                query_shared = Entry.objects.filter(id__in=entryids)
+            if authors is None:
+                authors = ids
+            else:
+                authors = authors.filter(id__in=ids)
 
-            query = query_native or query_shared
+        if authors is not None:
+            query = self.filter_authors(query, authors,
+                    enable_native, enable_shared)
 
         if 'tag' in fields:
-            for tag in fields['tag'].split():
-                tag_obj = Tag.objects.path_get(tag)
-                query = query.filter(tags__in=tag_obj)
+            # Entries having all the tags (or one of their descendants).
+            for tag in ' '.join(fields['tag']).split():
+                query = query.filter(tags__in=Tag.objects.subtree(tag))
+            query = query.distinct()
 
         if 'content' in fields:
             # Convert `?content=foo%20bar&content=baz` to
             # `"foo bar" "baz"`
             content = ' '.join(['"%s"' % x for x in fields['content']])
-            query = serverutils.auto_query(query, content)
+            if search.enabled():
+                query = search.search(query, content)
+            else:
+                query = serverutils.auto_query(query, content)
 
         if 'in_reply_to' in fields:
             if len(fields['in_reply_to']) != 1:
@@ -323,18 +523,135 @@ class AnonymousEntryHandler(AnonymousBaseHandler):
             query = query.filter(in_reply_to__exact=entry)
             query = query.exclude(in_reply_to=None)
 
-        query = query.order_by('updated')
-
-        return query
+        # Entries listed because they were shared are sorted by the date of
+        # their last share (by the listed people).
+        key = 'updated'
+        expression = None
+        if enable_shared:
+            (sql, params) = self.shared_date(authors, subscriber)
+            if enable_native:
+                sql = 'COALESCE(%s, %s.updated)' % (sql,
+                        connection.ops.quote_name(Entry._meta.db_table))
+            key = 'shared'
+            expression = (sql, params)
+            query = query.extra(select={key: sql}, select_params=params) \
+                    .distinct()
+
+        if fields.get('order') == ['relevance'] and 'content' in fields and \
+                search.enabled():
+            # Sorting by relevance does not go well with cursors.
+            try:
+                limit = serverutils.get_limit(fields)
+            except ValueError:
+                return rc.BAD_REQUEST
+            page = list(search.rank(_select_related(query), content)[:limit])
+            if not_modified(request, entry_versions(page)):
+                return HttpResponseNotModified()
+            load_related(page)
+            return page
+
+        if streaming(request) and not [x for x in ('limit', 'before', 'after')
+                if x in fields]:
+            # The emitter loads the entries by chunks.
+            return self.prefetch(query).order_by(key, 'id')
+        try:
+            page, before, after = serverutils.paginate(_select_related(query),
+                    fields, key, expression)
+        except ValueError:
+            return rc.BAD_REQUEST
+        if before is not None:
+            set_response_header(request, 'X-Wididit-Before', before)
+        if after is not None:
+            set_response_header(request, 'X-Wididit-After', after)
+        if not_modified(request, (entry_versions(page), before, after)):
+            return HttpResponseNotModified()
+        load_related(page)
+        return page
+
+
+    def read_thread(self, request, query):
+        """Returns the thread of the entry matching the query."""
+        fields = dict(request.GET)
+        try:
+            limit = serverutils.get_limit(fields)
+            depth = None
+            if 'depth' in fields:
+                depth = int(fields['depth'][0])
+                if depth < 0:
+                    raise ValueError()
+        except ValueError:
+            return rc.BAD_REQUEST
+        try:
+            entry = query.get()
+        except Entry.DoesNotExist:
+            return rc.NOT_FOUND
+        query = Entry.objects.thread(entry, depth)
+        page = list(_select_related(query)[:limit])
+        if not_modified(request, entry_versions(page)):
+            return HttpResponseNotModified()
+        load_related(page)
+        return page
+
+    @staticmethod
+    def shared_date(authors, subscriber=None):
+        """Returns the SQL (and its parameters) of the date of the last
+        share of an entry by the `authors` (a list or a queryset of People,
+        or None for everybody), or by the people followed by `subscriber`
+        according to its materialized timeline."""
+        qn = connection.ops.quote_name
+        entry = qn(Entry._meta.db_table)
+        if subscriber is not None:
+            table = qn(TimelineEntry._meta.db_table)
+            return ('(SELECT MAX(%s.timestamp) FROM %s WHERE %s.entry_id = '
+                    '%s.id AND %s.subscriber_id = %%s AND %s.sharer_id IS NOT '
+                    'NULL)' % (table, table, table, entry, table, table),
+                    [subscriber.id])
+        table = qn(Share._meta.db_table)
+        sql = '(SELECT MAX(%s.timestamp) FROM %s WHERE %s.entry_id = %s.id' \
+                % (table, table, table, entry)
+        if authors is None:
+            return (sql + ')', [])
+        if isinstance(authors, QuerySet):
+            (people, params) = authors.values('id').query.sql_with_params()
+            params = list(params)
+        else:
+            people = ', '.join(['%s'] * len(authors)) or 'NULL'
+            params = list(authors)
+        return (sql + ' AND %s.people_id IN (%s))' % (table, people), params)
+
+    @staticmethod
+    def filter_authors(query, authors, enable_native, enable_shared):
+        """Filters an Entry queryset to keep the entries written (if
+        `enable_native`) or shared (if `enable_shared`) by the `authors`,
+        which can be either a list or a queryset of People."""
+        if not enable_native:
+            return query.filter(share__people__in=authors)
+        elif not enable_shared:
+            return query.filter(author__in=authors)
+        else:
+            return query.filter(Q(author__in=authors) |
+                    Q(share__people__in=authors)).distinct()
 
+    @staticmethod
+    def prefetch(query):
+        """Makes an Entry queryset load everything that is serialized with
+        the entries (including the entries they reply to, which Piston
+        serializes recursively) in a few queries."""
+        return _load_related(query._clone(klass=_EntryQuerySet))
 
     @classmethod
     def id(cls, entry):
         return entry.id2
 
+    @classmethod
+    def contributors(cls, entry):
+        # Piston would serialize the relation with .iterator(), which
+        # ignores prefetched objects.
+        return list(entry.contributors.all())
+
     @classmethod
     def shared_by(cls, entry):
-        return [x.people for x in Share.objects.filter(entry=entry)]
+        return [x.people for x in entry.share_set.all()]
 
 class EntryHandler(BaseHandler):
     allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
@@ -403,6 +720,7 @@ class EntryHandler(BaseHandler):
         return rc.DELETED
 
     id = anonymous.id
+    contributors = anonymous.contributors
     shared_by = anonymous.shared_by
 
 entry_handler = Resource(EntryHandler, authentication=auth)
@@ -439,6 +757,86 @@ class WhoamiHandler(BaseHandler):
 
 whoami_handler = Resource(WhoamiHandler, authentication=auth)
 
+##########################################################################
+# Federation
+
+class FederationInboxHandler(BaseHandler):
+    allowed_methods = ('POST',)
+    model = FederationState
+
+    def create(self, request):
+        """Receives notifications of new entries and shares from remote
+        servers (see wididitserver.outbox), and marks the servers of their
+        authors to be pulled (`./manage.py pull_entries --requested`).
+        The notifications must be sent by the server of their authors: the
+        request is refused if it comes from an address their hostnames do
+        not resolve to."""
+        try:
+            userids = [x.get('author') or x['people']
+                    for x in request.data['notifications']]
+            hostnames = set([
+                utils.userid2tuple(x, settings.WIDIDIT_HOSTNAME)[1]
+                for x in userids])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return rc.BAD_REQUEST
+        sender = request.META.get('REMOTE_ADDR')
+        if not all(federation.is_origin(x, sender) for x in hostnames):
+            return HttpResponseForbidden()
+        servers = Server.objects.filter(hostname__in=hostnames) \
+                .exclude(hostname=settings.WIDIDIT_HOSTNAME) \
+                .values_list('id', flat=True)
+        known = FederationState.objects.filter(server__in=servers)
+        known.update(pull_requested=True)
+        known = set(known.values_list('server', flat=True))
+        FederationState.objects.bulk_create([FederationState(server_id=x,
+            pull_requested=True) for x in servers if x not in known])
+        return rc.ALL_OK
+
+federation_inbox_handler = Resource(FederationInboxHandler)
+
+##########################################################################
+# Export and import
+
+@csrf_exempt
+def transfer(request, emitter_format=None):
+    """Exports (GET) or imports (POST) people, entries, shares and
+    subscriptions as newline-delimited JSON (see wididitserver.ndjson).
+    The export can be restricted to some people with `?author=`, and is
+    only available in the JSON formats; the statistics of the import are
+    returned in the requested format. Only available to the staff."""
+    if not http_auth.is_authenticated(request):
+        return http_auth.challenge()
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    try:
+        emitter, content_type = Emitter.get(emitter_format)
+    except ValueError:
+        response = rc.BAD_REQUEST
+        response.content = "Invalid output format specified '%s'." % \
+                emitter_format
+        return response
+    if request.method == 'GET':
+        if emitter_format not in ('json', 'jsonstream'):
+            return rc.BAD_REQUEST
+        authors = None
+        if 'author' in request.GET:
+            try:
+                authors = [get_people(x).id
+                        for x in request.GET.getlist('author')]
+            except People.DoesNotExist:
+                return rc.NOT_FOUND
+        return HttpResponse(ndjson.export_lines(authors),
+                mimetype='application/x-ndjson')
+    elif request.method == 'POST':
+        try:
+            stats = ndjson.import_lines(request)
+        except (KeyError, TypeError, ValueError):
+            return rc.BAD_REQUEST
+        return HttpResponse(emitter(stats, typemapper, None).render(request),
+                mimetype=content_type)
+    else:
+        return HttpResponseNotAllowed(['GET', 'POST'])
+
 urlpatterns = patterns('',
     # Server
     url(r'^server/$', server_handler, name='server_list'),
@@ -449,16 +847,28 @@ urlpatterns = patterns('',
 
     # Subscription
     url(r'^subscription/(?P<userid>%s)/people/$' % constants.USERID_MIX_REGEXP, people_subscription_handler, name='people_subscriptions_list'),
+    url(r'^subscription/(?P<userid>%s)/people/batch/$' % constants.USERID_MIX_REGEXP,
+        people_subscription_batch_handler,
+        name='people_subscriptions_batch'),
     url(r'^subscription/(?P<userid>%s)/people/(?P<targetid>%s)/$' % (constants.USERID_MIX_REGEXP, constants.USERID_MIX_REGEXP), people_subscription_handler, name='people_subscription'),
 
     # Entries
     url(r'^entry/$', entry_handler, name='entry_list_all'),
     url(r'^entry/(?P<mode>timeline)/$', entry_handler, name='entry_timeline'),
     url(r'^entry/(?P<userid>%s)/(?P<entryid>[0-9]+)/$' % constants.USERID_MIX_REGEXP, entry_handler, name='show_entry'),
+    url(r'^entry/(?P<userid>%s)/(?P<entryid>[0-9]+)/(?P<mode>thread)/$' %
+        constants.USERID_MIX_REGEXP, entry_handler, name='entry_thread'),
 
     # Shares
     url(r'^share/$', share_handler, name='share_index'),
 
+    # Federation
+    url(r'^federation/inbox/$', federation_inbox_handler,
+        name='federation_inbox'),
+
+    # Export and import
+    url(r'^transfer/$', transfer, name='transfer'),
+
     # Utils
     url(r'^oauth/consumer/$', consumer_handler, name='consumer'),
     url(r'^whoami/$', whoami_handler, name='whoami'),
@@ -0,0 +1,132 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Atom (RFC 4287 and 4685) emitter for the entries.
+
+The XML fragment of each entry is rendered once per version of the entry
+and kept in Django's cache; feeds are built by concatenating them."""
+
+import datetime
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.db.models.query import QuerySet
+from django.utils.xmlutils import SimplerXMLGenerator
+from django.utils.feedgenerator import rfc3339_date
+
+from piston.emitters import Emitter
+from piston.utils import rc, HttpStatusCode
+
+from wididitserver.models import Entry
+from wididitserver.utils import settings
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+THREADING_NS = 'http://purl.org/syndication/thread/1.0'
+
+def entry_uri(entry):
+    """Returns the tag URI identifying an entry."""
+    return 'tag:%s,%s:%s/%i' % (entry.author.server.hostname,
+            entry.published.strftime('%Y-%m-%d'), entry.author.username,
+            entry.id2)
+
+def _fragment_key(entry):
+    return 'wididit:atom:%i:%s' % (entry.id,
+            entry.updated.strftime('%Y%m%d%H%M%S%f'))
+
+def render_entry(entry, tags):
+    """Returns the <entry> element of an entry, given the paths of its
+    tags."""
+    output = StringIO()
+    xml = SimplerXMLGenerator(output, 'utf-8')
+    xml.startElement('entry', {})
+    xml.addQuickElement('id', entry_uri(entry))
+    xml.addQuickElement('title', entry.title)
+    xml.addQuickElement('summary', entry.summary)
+    xml.addQuickElement('content', entry.content, {'type': 'text'})
+    xml.startElement('author', {})
+    xml.addQuickElement('name', entry.author.userid())
+    xml.endElement('author')
+    for people in entry.contributors.all():
+        xml.startElement('contributor', {})
+        xml.addQuickElement('name', people.userid())
+        xml.endElement('contributor')
+    if entry.category:
+        xml.addQuickElement('category', attrs={'term': entry.category})
+    for tag in tags:
+        xml.addQuickElement('category', attrs={'term': tag})
+    xml.addQuickElement('published', rfc3339_date(entry.published))
+    xml.addQuickElement('updated', rfc3339_date(entry.updated))
+    xml.addQuickElement('rights', entry.rights)
+    if entry.in_reply_to is not None:
+        xml.addQuickElement('thr:in-reply-to',
+                attrs={'ref': entry_uri(entry.in_reply_to)})
+    xml.endElement('entry')
+    return output.getvalue()
+
+def render_entries(entries):
+    """Returns the <entry> elements of the entries, rendering only the ones
+    which are not in the cache."""
+    keys = dict((entry.id, _fragment_key(entry)) for entry in entries)
+    fragments = cache.get_many(keys.values())
+    missing = [x for x in entries if keys[x.id] not in fragments]
+    if missing:
+        tags = dict((x.id, []) for x in missing)
+        for (entry, path) in Entry.tags.through.objects \
+                .filter(entry__in=[x.id for x in missing]) \
+                .values_list('entry', 'tag__path'):
+            tags[entry].append(path)
+        rendered = dict((keys[x.id], render_entry(x, sorted(tags[x.id])))
+                for x in missing)
+        cache.set_many(rendered,
+                getattr(settings, 'WIDIDIT_ATOM_CACHE_TTL', 86400))
+        fragments.update(rendered)
+    return [fragments[keys[x.id]] for x in entries]
+
+class AtomEmitter(Emitter):
+    """Renders lists of entries as Atom feeds, newest first."""
+    def render(self, request):
+        if isinstance(self.data, HttpResponse):
+            raise HttpStatusCode(self.data)
+        elif isinstance(self.data, Entry):
+            entries = [self.data]
+        elif isinstance(self.data, (list, tuple, QuerySet)) and \
+                all([isinstance(x, Entry) for x in self.data]):
+            entries = list(self.data)
+            entries.reverse()
+        else:
+            response = rc.BAD_REQUEST
+            response.write('Only entries can be rendered as Atom.')
+            raise HttpStatusCode(response)
+
+        output = StringIO()
+        xml = SimplerXMLGenerator(output, 'utf-8')
+        xml.startDocument()
+        xml.startElement('feed', {'xmlns': ATOM_NS, 'xmlns:thr': THREADING_NS})
+        xml.addQuickElement('id', request.build_absolute_uri())
+        xml.addQuickElement('title', getattr(settings, 'WIDIDIT_SERVERNAME',
+            settings.WIDIDIT_HOSTNAME))
+        xml.addQuickElement('link', attrs={'rel': 'self',
+            'href': request.build_absolute_uri()})
+        if entries:
+            updated = max([x.updated for x in entries])
+        else:
+            updated = datetime.datetime.now()
+        xml.addQuickElement('updated', rfc3339_date(updated))
+        output.write(''.join(render_entries(entries)))
+        xml.endElement('feed')
+        return output.getvalue()
+
+Emitter.register('atom', AtomEmitter, 'application/atom+xml; charset=utf-8')
@@ -0,0 +1,291 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the API on synthetic data.
+
+populate() fills the database with a reproducible (seeded) data set:
+people whose number of entries, followers and shares follows a power law,
+tag trees, threads of replies, and a skewed subscription graph. run()
+then times scenarios against the real handlers (through the Django test
+client), and returns the latency percentiles and the number of SQL
+queries of each scenario, to be dumped as JSON and compared between runs.
+
+Use `./manage.py benchmark`, which runs it in a temporary test
+database."""
+
+import time
+import bisect
+import random
+import datetime
+import base64
+
+from django.contrib.auth.models import User
+from django.test.client import Client
+
+from wididitserver.models import People, clear_identity_caches
+from wididitserver.utils import settings
+from wididitserver.querylog import QueryLog
+from wididitserver import ndjson
+from wididitserver import webcache
+
+PASSWORD = 'benchmark'
+
+VOCABULARY = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed '
+        'do eiusmod tempor incididunt ut labore et dolore magna aliqua '
+        'enim ad minim veniam quis nostrud exercitation ullamco laboris '
+        'nisi aliquip ex ea commodo consequat duis aute irure in '
+        'reprehenderit voluptate velit esse cillum fugiat nulla pariatur '
+        'excepteur sint occaecat cupidatat non proident sunt culpa qui '
+        'officia deserunt mollit anim id est laborum').split()
+
+def power_law(size, rng, exponent=1.0):
+    """Returns a function returning random integers in [0, size), 0 being
+    the most frequent, following Zipf's law."""
+    cumulative = []
+    total = 0.
+    for rank in xrange(1, size + 1):
+        total += 1. / rank ** exponent
+        cumulative.append(total)
+    return lambda: bisect.bisect_left(cumulative, rng.random() * total)
+
+def username(index):
+    return 'user%i' % index
+
+class DataSet(object):
+    """Generator of the synthetic data, as the objects of
+    wididitserver.ndjson (so the data is inserted with the bulk paths)."""
+    def __init__(self, people=1000, entries=10000, seed=0, clients=10,
+            tags=50, reply_ratio=0.3, shares=None, followings=20):
+        self.people = people
+        self.entries = entries
+        self.clients = min(clients, people)
+        self.tags = tags
+        self.reply_ratio = reply_ratio
+        self.shares = entries // 5 if shares is None else shares
+        self.followings = followings
+        self.rng = random.Random(seed)
+        # Ids ('userid/id2') of the generated entries.
+        self.entry_ids = []
+
+    def text(self, words):
+        return ' '.join(self.rng.choice(VOCABULARY) for x in xrange(words))
+
+    def tag_paths(self):
+        """Returns a tree of tags: topics, and subtopics of the most
+        popular topics."""
+        paths = ['#topic%i' % x for x in xrange(self.tags)]
+        paths += ['#topic%i#sub%i' % (x, y) for x in xrange(self.tags // 5)
+                for y in xrange(5)]
+        return paths
+
+    def __iter__(self):
+        rng = self.rng
+        for i in xrange(self.people):
+            yield {'type': 'people', 'userid': username(i),
+                    'biography': self.text(10)}
+
+        author = power_law(self.people, rng)
+        tag = power_law(len(self.tag_paths()), rng)
+        tag_paths = self.tag_paths()
+        id2s = {}
+        start = datetime.datetime(2012, 1, 1)
+        for i in xrange(self.entries):
+            people = username(author())
+            id2s[people] = id2s.get(people, 0) + 1
+            date = (start + datetime.timedelta(minutes=i)) \
+                    .strftime(ndjson._DATE_FORMAT)
+            content = self.text(rng.randint(5, 50))
+            for j in xrange(rng.randint(0, 3)):
+                content += ' ' + tag_paths[tag()]
+            entry = {'type': 'entry', 'author': people, 'id': id2s[people],
+                    'title': self.text(3), 'content': content,
+                    'published': date, 'updated': date}
+            if self.entry_ids and rng.random() < self.reply_ratio:
+                # Mostly replies to recent entries, which makes threads.
+                entry['in_reply_to'] = self.entry_ids[
+                        -1 - int(rng.expovariate(0.1)) % len(self.entry_ids)]
+            self.entry_ids.append('%s/%i' % (people, id2s[people]))
+            yield entry
+
+        entry = power_law(len(self.entry_ids), rng)
+        shared = set()
+        for i in xrange(self.shares):
+            key = (username(rng.randrange(self.people)),
+                    self.entry_ids[entry()])
+            if key not in shared:
+                shared.add(key)
+                yield {'type': 'share', 'people': key[0], 'entry': key[1],
+                        'timestamp': (start + datetime.timedelta(
+                            minutes=self.entries + i))
+                        .strftime(ndjson._DATE_FORMAT)}
+
+        target = power_law(self.people, rng)
+        for i in xrange(self.people):
+            if i < self.clients:
+                # The clients of the benchmark follow many people.
+                count = self.followings * 5
+            else:
+                count = int(rng.paretovariate(1.5) * self.followings / 3)
+            targets = set(target() for x in xrange(count)) - set([i])
+            for j in sorted(targets):
+                yield {'type': 'subscription', 'subscriber': username(i),
+                        'target': username(j)}
+
+def populate(dataset, batch_size=500):
+    """Inserts the data set, and creates the users of its clients."""
+    with webcache.commit_on_success():
+        importer = ndjson.Importer(batch_size)
+        for item in dataset:
+            importer.add(item)
+        importer.flush()
+        for i in xrange(dataset.clients):
+            user = User.objects.create_user(username(i), '', PASSWORD)
+            People.objects.filter(username=username(i)).update(user=user)
+    clear_identity_caches()
+    return importer.stats
+
+
+##########################################################################
+# Scenarios
+#
+# Functions taking the data set and returning the method, path, data and
+# client (username) of a request.
+
+def timeline(dataset):
+    return ('GET', '/api/json/entry/timeline/', {},
+            username(dataset.rng.randrange(dataset.clients)))
+
+def all_entries(dataset):
+    return ('GET', '/api/json/entry/', {}, None)
+
+def author(dataset):
+    people = min(int(dataset.rng.paretovariate(1.0)), dataset.people) - 1
+    return ('GET', '/api/json/entry/', {'author': username(people)}, None)
+
+def tag(dataset):
+    # Popular topics, with subtopics.
+    path = dataset.rng.choice(dataset.tag_paths()[:max(1, dataset.tags // 5)])
+    return ('GET', '/api/json/entry/', {'tag': path}, None)
+
+def content(dataset):
+    return ('GET', '/api/json/entry/',
+            {'content': dataset.rng.choice(VOCABULARY)}, None)
+
+def single_entry(dataset):
+    return ('GET', '/api/json/entry/%s/' %
+            dataset.rng.choice(dataset.entry_ids), {}, None)
+
+def post(dataset):
+    return ('POST', '/api/json/entry/', {'title': dataset.text(3),
+        'content': dataset.text(20) + ' #benchmark', 'generator': 'benchmark'},
+        username(dataset.rng.randrange(dataset.clients)))
+
+def share(dataset):
+    # Entries may already be shared by the client: it is an error (which
+    # costs about the same).
+    return ('POST', '/api/json/share/',
+            {'entry': dataset.rng.choice(dataset.entry_ids)},
+            username(dataset.rng.randrange(dataset.clients)))
+
+def subscribe(dataset):
+    # A batch of repeated form fields, some of them already subscribed to.
+    client = username(dataset.rng.randrange(dataset.clients))
+    targets = dataset.rng.sample(xrange(dataset.people),
+            min(10, dataset.people))
+    return ('POST', '/api/json/subscription/%s/people/batch/' % client,
+            {'subscribe': [username(x) for x in targets]}, client)
+
+SCENARIOS = (('timeline', timeline), ('all_entries', all_entries),
+        ('author', author), ('tag', tag), ('content', content),
+        ('single_entry', single_entry), ('post', post), ('share', share),
+        ('subscribe', subscribe))
+
+
+##########################################################################
+# Run
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    return values[max(0, int(round(percent / 100. * len(values))) - 1)]
+
+def summarize(values):
+    values = sorted(values)
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+            'p99': percentile(values, 99), 'max': values[-1] if values else None}
+
+def send(client, dataset, scenario):
+    """Sends a request of the scenario, and returns None, or the error (the
+    status of the response, or the exception raised by the handler)."""
+    (method, path, data, user) = scenario(dataset)
+    extra = {}
+    if user is not None:
+        extra['HTTP_AUTHORIZATION'] = 'Basic ' + \
+                base64.b64encode('%s:%s' % (user, PASSWORD))
+    try:
+        if method == 'GET':
+            response = client.get(path, data, **extra)
+        else:
+            response = client.post(path, data, **extra)
+    except Exception, e:
+        return '%s: %s' % (e.__class__.__name__, e)
+    if response.status_code >= 400:
+        return 'HTTP %i' % response.status_code
+    return None
+
+def run_scenario(client, dataset, scenario, runs):
+    """Times `runs` requests of the scenario, then counts the queries of
+    `runs` other ones: the query log is kept out of the timed requests, as
+    it slows them down."""
+    latencies = []
+    errors = {}
+    for i in xrange(runs):
+        start = time.time()
+        error = send(client, dataset, scenario)
+        latencies.append((time.time() - start) * 1000)
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    queries = []
+    for i in xrange(runs):
+        with QueryLog() as log:
+            send(client, dataset, scenario)
+        queries.append(log.count)
+    return {'runs': runs, 'errors': sum(errors.values()),
+            'error_types': errors, 'latency_ms': summarize(latencies),
+            'queries': summarize(queries)}
+
+def run(dataset, runs=50, scenarios=None, warmup=5):
+    """Populates the database with the data set, and runs each scenario
+    (see run_scenario), after `warmup` untimed requests. Returns the
+    report."""
+    start = time.time()
+    stats = populate(dataset)
+    report = {
+            'dataset': {'people': dataset.people, 'entries': dataset.entries,
+                'clients': dataset.clients, 'objects': stats,
+                'seconds': time.time() - start},
+            'settings': dict((x, getattr(settings, x, False)) for x in
+                ('WIDIDIT_MATERIALIZED_TIMELINES', 'WIDIDIT_SEARCH_INDEX')),
+            'scenarios': {}}
+    client = Client()
+    for (name, scenario) in SCENARIOS:
+        if scenarios is not None and name not in scenarios:
+            continue
+        for i in xrange(warmup):
+            send(client, dataset, scenario)
+        report['scenarios'][name] = run_scenario(client, dataset, scenario,
+                runs)
+    return report
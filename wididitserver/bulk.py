@@ -0,0 +1,122 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk writes of entries, for the federation and the imports.
+
+Unlike Entry.save, they keep the given `published` and `updated` dates,
+and they update the threads, counters, contributors, tags, search index,
+timelines and cached web pages of a whole batch of entries at once."""
+
+from django.db import connections, router, transaction, models
+
+from wididit import utils
+
+from wididitserver.models import Entry, EntryCounter, EntryToken, Tag
+from wididitserver.models import Share, TimelineEntry
+from wididitserver.models import timelines_enabled
+from wididitserver.utils import update_rows
+from wididitserver import search
+from wididitserver import counters
+from wididitserver import webcache
+
+def insert_raw(model, objects):
+    """Inserts the objects like bulk_create, but keeps the values of the
+    fields as they are (auto_now and auto_now_add are not applied)."""
+    using = router.db_for_write(model)
+    fields = [x for x in model._meta.local_fields
+            if not isinstance(x, models.AutoField)]
+    size = max(connections[using].ops.bulk_batch_size(fields, objects), 1)
+    for i in xrange(0, len(objects), size):
+        model._base_manager._insert(objects[i:i+size], fields=fields,
+                using=using, raw=True)
+    transaction.commit_unless_managed(using=using)
+
+def _get_ids(entries):
+    authors = set([x.author_id for x in entries])
+    ids2 = set([x.id2 for x in entries])
+    return dict(((author, id2), id_) for (author, id2, id_) in
+            Entry.objects.filter(author__in=authors, id2__in=ids2)
+            .values_list('author', 'id2', 'id'))
+
+def upsert_entries(entries):
+    """Creates or updates the entries, identified by their author and id2.
+
+    `entries` are unsaved Entry instances, whose contributors were given
+    with add_contributor(); there should be at most a few hundred of them.
+    Returns the number of created and updated entries."""
+    # Only keep the last version of each entry.
+    entries = dict(((x.author_id, x.id2), x) for x in entries).values()
+    if not entries:
+        return (0, 0)
+
+    for entry in entries:
+        entry.update_summary()
+    ids = _get_ids(entries)
+    created = [x for x in entries if (x.author_id, x.id2) not in ids]
+    updated = [x for x in entries if (x.author_id, x.id2) in ids]
+    insert_raw(Entry, created)
+    ids.update(_get_ids(created))
+    for entry in entries:
+        entry.id = ids[(entry.author_id, entry.id2)]
+    # The counters are computed from the other rows.
+    fields = [x for x in Entry._meta.local_fields if not x.primary_key and
+            x.name not in Entry.counter_fields]
+    old_parents = set(Entry.objects.filter(id__in=[x.id for x in updated])
+            .values_list('in_reply_to', flat=True))
+    update_rows(Entry, [x.name for x in fields],
+            dict((x.id, tuple(getattr(x, y.attname) for y in fields))
+                for x in updated))
+    ids = [x.id for x in entries]
+    Entry.objects.update_threads(ids)
+    parents = old_parents | set(x.in_reply_to_id for x in entries)
+    counters.reconcile_entries(list(parents - set([None])))
+
+    last_ids2 = {}
+    for entry in created:
+        last_ids2[entry.author_id] = max(entry.id2,
+                last_ids2.get(entry.author_id, 0))
+    for (author, id2) in last_ids2.items():
+        EntryCounter.objects.advance(author, id2)
+
+    Contributor = Entry.contributors.through
+    Contributor.objects.filter(entry__in=ids).delete()
+    Contributor.objects.bulk_create([Contributor(entry_id=x.id,
+        people_id=people.id) for x in entries
+        for people in getattr(x, '_contributors', [])])
+
+    EntryTag = Entry.tags.through
+    paths = dict((x.id, utils.get_tags(x.content)) for x in entries)
+    all_paths = set()
+    for entry_paths in paths.values():
+        all_paths.update(entry_paths)
+    tags = Tag.objects.resolve_paths(all_paths)
+    EntryTag.objects.filter(entry__in=ids).delete()
+    EntryTag.objects.bulk_create([EntryTag(entry_id=id_, tag_id=tags[path])
+        for (id_, entry_paths) in paths.items()
+        for path in set(entry_paths) if tags[path] is not None])
+
+    if search.enabled():
+        EntryToken.objects.filter(entry__in=[x.id for x in updated]).delete()
+        search.index_entries([(x.id, x.content) for x in entries])
+
+    if timelines_enabled():
+        TimelineEntry.objects.fanout_entries(created)
+
+    sharers = Share.objects.filter(entry__in=[x.id for x in updated]) \
+            .values_list('people', flat=True)
+    webcache.invalidate('entries', *['people:%i' % x for x in
+        set(x.author_id for x in entries) | set(sharers)])
+
+    return (len(created), len(updated))
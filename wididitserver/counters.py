@@ -0,0 +1,83 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Denormalized counters: the number of replies and shares of the entries,
+and the number of followers and followed people of the people.
+
+They are kept up to date by the Entry, Share and PeopleSubscription
+signals (see wididitserver.models); the functions of this module compute
+them from scratch, after bulk writes, or to repair them with
+`./manage.py reconcile_counters`."""
+
+from django.db.models import Count
+
+from wididitserver.models import Entry, People, Share, PeopleSubscription
+from wididitserver.models import add_to_people_counter
+
+def _count(query, field, ids):
+    return dict(query.filter(**{field + '__in': ids}).values(field)
+            .annotate(count=Count('id')).values_list(field, 'count'))
+
+def reconcile_entries(ids):
+    """Sets the reply and share counts of the entries with the given ids
+    (a few hundred at most). Returns the number of entries whose counts
+    were wrong."""
+    replies = _count(Entry.objects, 'in_reply_to', ids)
+    shares = _count(Share.objects, 'entry', ids)
+    fixed = 0
+    for (id_, reply_count, share_count) in Entry.objects.filter(id__in=ids) \
+            .values_list('id', 'reply_count', 'share_count'):
+        counts = (replies.get(id_, 0), shares.get(id_, 0))
+        if (reply_count, share_count) != counts:
+            Entry.objects.filter(id=id_).update(reply_count=counts[0],
+                    share_count=counts[1])
+            fixed += 1
+    return fixed
+
+def reconcile_people(ids):
+    """Sets the follower and following counts of the people with the given
+    ids (a few hundred at most). Returns the number of people whose counts
+    were wrong."""
+    followers = _count(PeopleSubscription.objects, 'target_people', ids)
+    following = _count(PeopleSubscription.objects, 'subscriber', ids)
+    fixed = []
+    for (id_, follower_count, following_count) in People.objects \
+            .filter(id__in=ids) \
+            .values_list('id', 'follower_count', 'following_count'):
+        counts = (followers.get(id_, 0), following.get(id_, 0))
+        if (follower_count, following_count) != counts:
+            People.objects.filter(id=id_).update(follower_count=counts[0],
+                    following_count=counts[1])
+            fixed.append(id_)
+    if fixed:
+        # Bumps the date of update, and forgets the cached people.
+        add_to_people_counter(fixed, 'follower_count', 0)
+    return len(fixed)
+
+def reconcile_all(batch_size=500):
+    """Repairs the counters of all the entries and people. Returns the
+    number of entries and people whose counts were wrong."""
+    stats = {'entry': 0, 'people': 0}
+    for (model, name, reconcile) in ((Entry, 'entry', reconcile_entries),
+            (People, 'people', reconcile_people)):
+        last_id = 0
+        while True:
+            ids = list(model.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            stats[name] += reconcile(ids)
+            last_id = ids[-1]
+    return stats
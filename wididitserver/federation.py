@@ -0,0 +1,200 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pull of the entries written on the remote servers.
+
+The entries of each server are fetched by a pool of threads, which only do
+HTTP requests, and are written to the database by the calling thread, in
+batches (see wididitserver.bulk). Each server is read from where the
+previous pull stopped, using the pagination cursors of the API."""
+
+import json
+import socket
+import urllib
+import urllib2
+import datetime
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from wididitserver.models import Server, People, Entry, FederationState
+from wididitserver.utils import settings, encode_cursor
+from wididitserver import bulk
+from wididitserver import webcache
+
+# Cursor of the first pull of a server.
+INITIAL_CURSOR = encode_cursor(datetime.datetime(1970, 1, 1), 0)
+
+def parse_date(value):
+    """Parses a date of the API: ISO 8601 (as written by the JSON encoder
+    of Django), with an optional fraction of second and an optional time
+    zone (Z or offset). Returns a naive datetime, in the local time zone.
+    Raises ValueError if the date is not valid."""
+    date = parse_datetime(value)
+    if date is None:
+        raise ValueError('Invalid date: %r' % value)
+    if timezone.is_aware(date):
+        date = timezone.make_naive(date, timezone.get_default_timezone())
+    return date
+
+def is_origin(hostname, address):
+    """Returns whether a request coming from `address` (an IP address) can
+    be sent by the server with this hostname (with an optional port), that
+    is whether the hostname resolves to this address."""
+    host = hostname.split(':')[0]
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.error:
+        return False
+    return address in set(x[4][0] for x in infos)
+
+def fetch_entries(hostname, cursor, limit=100, max_pages=10, timeout=10):
+    """Fetches the entries posted or updated on a server after the cursor,
+    at most `max_pages` pages of `limit` entries. Returns the entries (as
+    dictionnaries) and the cursor to use for the next pull."""
+    scheme = getattr(settings, 'WIDIDIT_FEDERATION_SCHEME', 'http')
+    entries = []
+    for i in xrange(max_pages):
+        url = '%s://%s/api/json/entry/?%s' % (scheme, hostname,
+                urllib.urlencode({'limit': limit, 'after': cursor}))
+        response = urllib2.urlopen(url, timeout=timeout)
+        try:
+            page = json.load(response)
+            cursor = response.info().getheader('X-Wididit-After') or cursor
+        finally:
+            response.close()
+        entries.extend(page)
+        if len(page) < limit:
+            break
+    return entries, cursor
+
+def _fetch(job):
+    (server_id, hostname, cursor, options) = job
+    try:
+        entries, cursor = fetch_entries(hostname, cursor, **options)
+    except (IOError, ValueError), e:
+        return (server_id, [], cursor, '%s: %s' % (e.__class__.__name__, e))
+    return (server_id, entries, cursor, '')
+
+def _get_people(hostname, username, server, people):
+    """Returns the People with the given userid, creating it if it is on
+    the pulled server. `people` is a cache of the known people."""
+    key = (hostname, username)
+    if key not in people:
+        try:
+            people[key] = People.objects.get(server__hostname=hostname,
+                    username=username)
+        except People.DoesNotExist:
+            if hostname != server.hostname:
+                people[key] = None
+            else:
+                people[key] = People.objects.create(server=server,
+                        username=username)
+    return people[key]
+
+def make_entries(server, data):
+    """Returns unsaved Entry instances from the entries of a server (as
+    returned by its API). The entries written on other servers are
+    ignored."""
+    people = dict(((server.hostname, x.username), x) for x in
+            People.objects.filter(server=server).filter(username__in=set(
+                [x['author']['username'] for x in data])))
+    entries = []
+    for item in data:
+        if item['author']['server']['hostname'] != server.hostname:
+            continue
+        entry = Entry(id2=item['id'],
+                author=_get_people(server.hostname,
+                    item['author']['username'], server, people),
+                content=item['content'],
+                title=item['title'],
+                subtitle=item.get('subtitle', ''),
+                category=item.get('category', ''),
+                generator=item.get('generator', ''),
+                rights=item.get('rights', ''),
+                source=item.get('source', ''),
+                published=parse_date(item['published']),
+                updated=parse_date(item['updated']))
+        for contributor in item.get('contributors', []):
+            contributor = _get_people(contributor['server']['hostname'],
+                    contributor['username'], server, people)
+            if contributor is not None:
+                entry.add_contributor(contributor)
+        parent = item.get('in_reply_to')
+        if parent:
+            author = _get_people(parent['author']['server']['hostname'],
+                    parent['author']['username'], server, people)
+            try:
+                entry.in_reply_to = Entry.objects.get(author=author,
+                        id2=parent['id'])
+            except Entry.DoesNotExist:
+                pass
+        entries.append(entry)
+    return entries
+
+def pull(workers=4, batch_size=500, requested_only=False, **options):
+    """Pulls the new entries of all the remote servers (or only of the ones
+    which notified us, if `requested_only`), fetching `workers` servers at
+    the same time. `options` are given to fetch_entries.
+    Returns a dictionnary of the number of created and updated entries (or
+    of the error) of each server."""
+    servers = Server.objects.all()
+    if requested_only:
+        servers = servers.filter(federation_state__pull_requested=True)
+    servers = dict((x.id, x) for x in servers if not x.is_self())
+    states = dict((x.server_id, x) for x in
+            FederationState.objects.filter(server__in=servers.keys()))
+    for server_id in servers:
+        if server_id not in states:
+            states[server_id] = FederationState(server_id=server_id,
+                    cursor=INITIAL_CURSOR)
+    jobs = [(x.id, x.hostname, states[x.id].cursor or INITIAL_CURSOR,
+        options) for x in servers.values()]
+
+    results = {}
+    pool = ThreadPool(max(workers, 1))
+    try:
+        for (server_id, data, cursor, error) in \
+                pool.imap_unordered(_fetch, jobs):
+            server = servers[server_id]
+            state = states[server_id]
+            state.last_pull = datetime.datetime.now()
+            try:
+                with webcache.commit_on_success():
+                    entries = make_entries(server, data)
+                    created = updated = 0
+                    for i in xrange(0, len(entries), batch_size):
+                        (c, u) = bulk.upsert_entries(
+                                entries[i:i+batch_size])
+                        created += c
+                        updated += u
+                    state.cursor = cursor
+                    state.last_error = error
+                    if not error:
+                        state.pull_requested = False
+                    state.save()
+            except (KeyError, TypeError, ValueError), e:
+                # Malformed entries; they will be fetched again next time.
+                error = 'Invalid entries: %s: %s' % (e.__class__.__name__, e)
+                with transaction.commit_on_success():
+                    state.last_error = error
+                    state.save()
+            results[server.hostname] = error or (created, updated)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,325 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load test of the API: concurrent clients sending a mix of reads
+(timeline, entry list), writes (entries, shares) and subscriptions, with
+HTTP Basic authentication.
+
+The report gives the throughput, the error rate (with the errors by kind,
+including the IntegrityErrors of the handlers) and a latency histogram of
+each operation. Running it with increasing concurrencies shows where the
+throughput stops growing.
+
+Use `./manage.py loadtest`."""
+
+import time
+import json
+import random
+import base64
+import socket
+import urllib
+import urllib2
+import threading
+import SocketServer
+
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
+from django.core.servers.basehttp import get_internal_wsgi_application
+
+OPERATIONS = ('timeline', 'entries', 'post', 'share', 'subscribe')
+DEFAULT_MIX = {'timeline': 4, 'entries': 4, 'post': 1, 'share': 1,
+        'subscribe': 1}
+# Upper bounds of the buckets of the latency histograms, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def parse_mix(mix):
+    """Parses weights given as `timeline=4,post=1`."""
+    weights = {}
+    for item in mix.split(','):
+        (operation, weight) = item.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation: %s' % operation)
+        weights[operation] = int(weight)
+    return weights
+
+
+##########################################################################
+# Transports
+
+class HttpTransport(object):
+    """Sends the requests to a server over HTTP."""
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def __call__(self, method, path, data, username, password):
+        """Returns the status and the body of the response (without
+        authentication if `username` is None)."""
+        if method == 'GET':
+            request = urllib2.Request(self.base_url + path +
+                    ('?' + urllib.urlencode(data) if data else ''))
+        else:
+            request = urllib2.Request(self.base_url + path,
+                    urllib.urlencode(data))
+        if username is not None:
+            request.add_header('Authorization', 'Basic ' +
+                    base64.b64encode('%s:%s' % (username, password)))
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            return (e.code, e.read())
+        try:
+            return (response.code, response.read())
+        finally:
+            response.close()
+
+class ClientTransport(object):
+    """Sends the requests to this Django project, in process, with the
+    test client (for a single client: the test client is not
+    thread-safe)."""
+    def __init__(self, client=None):
+        if client is None:
+            from django.test.client import Client
+            client = Client()
+        self.client = client
+
+    def __call__(self, method, path, data, username, password):
+        extra = {}
+        if username is not None:
+            extra['HTTP_AUTHORIZATION'] = 'Basic ' + \
+                    base64.b64encode('%s:%s' % (username, password))
+        if method == 'GET':
+            response = self.client.get(path, data, **extra)
+        else:
+            response = self.client.post(path, data, **extra)
+        return (response.status_code, response.content)
+
+class _QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(*args):
+        pass
+
+class _ThreadedWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def serve(host='127.0.0.1', port=0):
+    """Serves this Django project with a threaded development server, in
+    a background thread. Returns the server (its `server_port`, and
+    shutdown() to stop it)."""
+    server = _ThreadedWSGIServer((host, port), _QuietWSGIRequestHandler)
+    server.set_app(get_internal_wsgi_application())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+##########################################################################
+# Load test
+
+def create_users(transport, count, prefix='loadtest', password='loadtest'):
+    """Creates `count` accounts through the API (existing ones are
+    reused), and returns their (username, password) pairs."""
+    users = []
+    for i in xrange(count):
+        username = '%s%i' % (prefix, i)
+        (status, body) = transport('POST', '/api/json/people/',
+                {'username': username, 'password': password,
+                    'email': '%s@example.com' % username}, None, None)
+        if status not in (201, 409):
+            raise ValueError('Could not create %s: %s %s' %
+                    (username, status, body))
+        users.append((username, password))
+    return users
+
+def saturation(reports):
+    """Returns the concurrency of the run with the highest throughput,
+    among runs with increasing concurrencies: beyond it, more clients only
+    add latency."""
+    reports = [x for x in reports if x['throughput'] is not None]
+    if not reports:
+        return None
+    return max(reports, key=lambda x: x['throughput'])['concurrency']
+
+def classify_error(status, body):
+    """Returns the kind of error of a response, or None."""
+    if status < 400:
+        return None
+    elif 'IntegrityError' in body:
+        return 'IntegrityError'
+    else:
+        return str(status)
+
+def histogram(latencies):
+    """Returns the number of latencies (in milliseconds) in each bucket,
+    as a list of [upper bound, count] (the last bound is None)."""
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        i = 0
+        while i < len(BUCKETS) and latency > BUCKETS[i]:
+            i += 1
+        counts[i] += 1
+    return [[x, y] for (x, y) in zip(BUCKETS + (None,), counts)]
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    return values[max(0, int(round(percent / 100. * len(values))) - 1)]
+
+class _Stats(object):
+    """Results of the requests of one client."""
+    def __init__(self):
+        self.latencies = dict((x, []) for x in OPERATIONS)
+        self.errors = dict((x, {}) for x in OPERATIONS)
+
+    def add(self, operation, latency, error):
+        self.latencies[operation].append(latency)
+        if error is not None:
+            errors = self.errors[operation]
+            errors[error] = errors.get(error, 0) + 1
+
+class LoadTest(object):
+    """Runs concurrent clients, each one authenticated as one of the
+    `users` ((username, password) pairs, which must exist), through the
+    transport."""
+    def __init__(self, transport, users, mix=None, format='json', seed=0):
+        self.transport = transport
+        self.users = users
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.format = format
+        self.seed = seed
+        # Ids ('userid/id2') of recent entries, to share them.
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def _remember_entries(self, body):
+        try:
+            entries = ['%s@%s/%s' % (x['author']['username'],
+                x['author']['server']['hostname'], x['id'])
+                for x in json.loads(body)]
+        except (ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            self.entries = (self.entries + entries)[-1000:]
+
+    def _choose(self, rng):
+        total = sum(x[1] for x in self.mix)
+        value = rng.random() * total
+        for (operation, weight) in self.mix:
+            value -= weight
+            if value < 0:
+                return operation
+        return self.mix[-1][0]
+
+    def _request(self, operation, rng, username):
+        """Returns the method, path and data of a request."""
+        prefix = '/api/%s/' % self.format
+        if operation == 'timeline':
+            return ('GET', prefix + 'entry/timeline/', {})
+        elif operation == 'entries':
+            return ('GET', prefix + 'entry/', {})
+        elif operation == 'post':
+            return ('POST', prefix + 'entry/', {'title': 'Load test',
+                'content': 'Load test %i' % rng.randrange(10 ** 9),
+                'generator': 'loadtest'})
+        elif operation == 'share':
+            with self._lock:
+                if not self.entries:
+                    return None
+                entry = rng.choice(self.entries)
+            return ('POST', prefix + 'share/', {'entry': entry})
+        elif operation == 'subscribe':
+            target = rng.choice(self.users)[0]
+            return ('POST', prefix + 'subscription/%s/people/batch/' %
+                    username, {'subscribe': target})
+
+    def request(self, operation, rng, username, password, stats):
+        request = self._request(operation, rng, username)
+        if request is None:
+            return
+        (method, path, data) = request
+        start = time.time()
+        try:
+            (status, body) = self.transport(method, path, data, username,
+                    password)
+            error = classify_error(status, body)
+        except (IOError, socket.error):
+            (status, body) = (None, '')
+            error = 'connection'
+        stats.add(operation, (time.time() - start) * 1000, error)
+        if operation == 'entries' and status == 200 and \
+                self.format == 'json':
+            self._remember_entries(body)
+
+    def client(self, index, deadline, requests, stats):
+        """Sends requests until the deadline, or until `requests` requests
+        were sent."""
+        rng = random.Random('%s-%s' % (self.seed, index))
+        (username, password) = self.users[index % len(self.users)]
+        sent = 0
+        while (deadline is None or time.time() < deadline) and \
+                (requests is None or sent < requests):
+            self.request(self._choose(rng), rng, username, password, stats)
+            sent += 1
+
+    def run(self, concurrency, duration=None, requests=None):
+        """Runs `concurrency` clients for `duration` seconds, or until
+        each one sent `requests` requests. With one client, it runs in the
+        current thread. Returns the report."""
+        assert duration is not None or requests is not None
+        if not self.entries:
+            rng = random.Random(self.seed)
+            self.request('entries', rng, self.users[0][0], self.users[0][1],
+                    _Stats())
+        deadline = None if duration is None else time.time() + duration
+        stats = [_Stats() for x in xrange(concurrency)]
+        start = time.time()
+        if concurrency == 1:
+            self.client(0, deadline, requests, stats[0])
+        else:
+            threads = [threading.Thread(target=self.client,
+                args=(x, deadline, requests, stats[x]))
+                for x in xrange(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return self.report(concurrency, time.time() - start, stats)
+
+    def report(self, concurrency, seconds, stats):
+        report = {'concurrency': concurrency, 'seconds': seconds,
+                'operations': {}}
+        total = errors = 0
+        for operation in OPERATIONS:
+            latencies = sorted(sum([x.latencies[operation] for x in stats],
+                []))
+            if not latencies:
+                continue
+            kinds = {}
+            for x in stats:
+                for (kind, count) in x.errors[operation].items():
+                    kinds[kind] = kinds.get(kind, 0) + count
+            total += len(latencies)
+            errors += sum(kinds.values())
+            report['operations'][operation] = {
+                    'requests': len(latencies),
+                    'errors': kinds,
+                    'error_rate': float(sum(kinds.values())) / len(latencies),
+                    'latency_ms': dict([('p%i' % x, percentile(latencies, x))
+                        for x in (50, 90, 99)] + [('max', latencies[-1])]),
+                    'histogram': histogram(latencies)}
+        report['requests'] = total
+        report['throughput'] = total / seconds if seconds else None
+        report['error_rate'] = float(errors) / total if total else None
+        return report
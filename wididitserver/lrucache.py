@@ -0,0 +1,73 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A thread-safe mapping keeping at most `size` items, each of them for
+    at most `ttl` seconds, and counting its hits and misses."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value associated to the key. Raises KeyError if it is
+        not in the cache or expired."""
+        with self._lock:
+            try:
+                (expiry, value) = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            if expiry < time.time():
+                self.misses += 1
+                raise KeyError(key)
+            # Move it to the end of the queue.
+            self._items[key] = (expiry, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def discard_values(self, predicate):
+        """Removes the items whose value matches the predicate."""
+        with self._lock:
+            for (key, (expiry, value)) in self._items.items():
+                if predicate(value):
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items)}
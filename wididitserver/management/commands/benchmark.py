@@ -0,0 +1,71 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from wididitserver import benchmark
+
+class Command(BaseCommand):
+    help = 'Times the API on synthetic data, in a temporary test ' \
+            'database, and writes the report as JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--people', type='int', default=1000,
+            help='Number of people.'),
+        make_option('--entries', type='int', default=10000,
+            help='Number of entries.'),
+        make_option('--clients', type='int', default=10,
+            help='Number of people making the authenticated requests.'),
+        make_option('--seed', type='int', default=0,
+            help='Seed of the data and of the requests.'),
+        make_option('--runs', type='int', default=50,
+            help='Number of timed requests per scenario.'),
+        make_option('--scenario', action='append', dest='scenarios',
+            help='Only run this scenario (can be repeated): %s.' %
+            ', '.join(x[0] for x in benchmark.SCENARIOS)),
+        make_option('--output', default=None,
+            help='File where the report is written (default: standard '
+            'output).'),
+        )
+
+    def handle(self, *args, **options):
+        dataset = benchmark.DataSet(people=options['people'],
+                entries=options['entries'], seed=options['seed'],
+                clients=options['clients'])
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            report = benchmark.run(dataset, options['runs'],
+                    options['scenarios'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        report['seed'] = options['seed']
+        output = sys.stdout
+        if options['output']:
+            output = open(options['output'], 'w')
+        try:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write('\n')
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,61 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from wididitserver import outbox
+
+class Command(NoArgsCommand):
+    help = 'Delivers the notifications queued for the remote servers.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+            help='Number of requests sent at the same time.'),
+        make_option('--per-host', type='int', default=1, dest='per_host',
+            help='Number of requests sent to a server at the same time.'),
+        make_option('--batch', type='int', default=100,
+            help='Number of notifications per request.'),
+        make_option('--timeout', type='float', default=10,
+            help='Timeout of the requests, in seconds.'),
+        make_option('--interval', type='float', default=None,
+            help='Deliver again every INTERVAL seconds instead of exiting.'),
+        make_option('--stats', action='store_true', default=False,
+            help='Only display the state of the queue.'),
+        )
+
+    def print_stats(self):
+        stats = outbox.queue_stats()
+        self.stdout.write('depth: %i, lag: %is\n' %
+                (stats['depth'], stats['lag']))
+        for (hostname, depth) in sorted(stats['servers'].items()):
+            self.stdout.write('    %s: %i\n' % (hostname, depth))
+
+    def handle_noargs(self, **options):
+        if options['stats']:
+            self.print_stats()
+            return
+        while True:
+            result = outbox.deliver(workers=options['workers'],
+                    per_host=options['per_host'],
+                    batch_size=options['batch'],
+                    timeout=options['timeout'])
+            self.stdout.write('%(delivered)i delivered, %(failed)i failed, '
+                    '%(dropped)i dropped\n' % result)
+            self.print_stats()
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
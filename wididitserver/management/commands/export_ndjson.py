@@ -0,0 +1,49 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wididitserver.models import People, get_people
+from wididitserver import ndjson
+
+class Command(BaseCommand):
+    args = '[userid ...]'
+    help = 'Exports people, entries, shares and subscriptions as ' \
+            'newline-delimited JSON (everybody, or the given people).'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', default=None,
+            help='File to write to, instead of the standard output.'),
+        )
+
+    def handle(self, *args, **options):
+        authors = None
+        if args:
+            try:
+                authors = [get_people(x).id for x in args]
+            except People.DoesNotExist, e:
+                raise CommandError(str(e))
+        if options['output'] is None:
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'w')
+        try:
+            for line in ndjson.export_lines(authors):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,46 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from wididitserver import ndjson
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = 'Imports an export of export_ndjson (from the standard input ' \
+            'if no file is given).'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=500,
+            help='Number of rows inserted at once.'),
+        make_option('--transaction', type='int', default=10000,
+            help='Number of lines imported per transaction.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            input_ = open(args[0])
+        else:
+            input_ = sys.stdin
+        try:
+            stats = ndjson.import_lines(input_, options['batch'],
+                    options['transaction'])
+        finally:
+            if input_ is not sys.stdin:
+                input_.close()
+        for (type_, count) in sorted(stats.items()):
+            self.stdout.write('%s: %i\n' % (type_, count))
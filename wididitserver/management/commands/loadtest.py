@@ -0,0 +1,101 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wididitserver import loadtest
+
+class Command(BaseCommand):
+    help = 'Runs concurrent clients against the API (of a local ' \
+            'development server, unless --url is given), with increasing ' \
+            'concurrencies, and writes the report as JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--url', default=None,
+            help='Base URL of the server (default: serve this project on '
+            'a random local port).'),
+        make_option('--user', action='append', dest='accounts', default=[],
+            help='Account of a client, as username:password (can be '
+            'repeated).'),
+        make_option('--users', type='int', default=0,
+            help='Number of accounts to create for the clients.'),
+        make_option('--concurrency', default='1,2,4,8,16',
+            help='Comma-separated numbers of concurrent clients.'),
+        make_option('--duration', type='float', default=None,
+            help='Duration of each run, in seconds (default: 10, unless '
+            '--requests is given).'),
+        make_option('--requests', type='int', default=None,
+            help='Number of requests of each client in each run.'),
+        make_option('--mix', default=None,
+            help='Weights of the operations, as timeline=4,post=1 '
+            '(operations: %s).' % ', '.join(loadtest.OPERATIONS)),
+        make_option('--format', default='json',
+            help='Emitter format of the API.'),
+        make_option('--seed', type='int', default=0,
+            help='Seed of the requests.'),
+        make_option('--output', default=None,
+            help='File where the report is written (default: standard '
+            'output).'),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            concurrencies = [int(x) for x in
+                    options['concurrency'].split(',')]
+            mix = options['mix'] and loadtest.parse_mix(options['mix'])
+        except ValueError, e:
+            raise CommandError(str(e))
+        users = [tuple(x.split(':', 1)) for x in options['accounts']]
+        if [x for x in users if len(x) != 2]:
+            raise CommandError('--user must be username:password.')
+        duration = options['duration']
+        if duration is None and options['requests'] is None:
+            duration = 10
+
+        server = None
+        url = options['url']
+        if url is None:
+            server = loadtest.serve()
+            url = 'http://127.0.0.1:%i' % server.server_port
+        try:
+            transport = loadtest.HttpTransport(url)
+            if options['users']:
+                users += loadtest.create_users(transport, options['users'])
+            if not users:
+                raise CommandError('Use --user or --users.')
+            test = loadtest.LoadTest(transport, users, mix,
+                    options['format'], options['seed'])
+            runs = []
+            for concurrency in concurrencies:
+                runs.append(test.run(concurrency, duration,
+                    options['requests']))
+        finally:
+            if server is not None:
+                server.shutdown()
+
+        report = {'url': url, 'users': len(users), 'runs': runs,
+                'saturation': loadtest.saturation(runs)}
+        output = sys.stdout
+        if options['output']:
+            output = open(options['output'], 'w')
+        try:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write('\n')
+        finally:
+            if output is not sys.stdout:
+                output.close()
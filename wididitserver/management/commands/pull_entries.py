@@ -0,0 +1,54 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from wididitserver import federation
+
+class Command(NoArgsCommand):
+    help = 'Pulls the new entries of the remote servers.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+            help='Number of servers fetched at the same time.'),
+        make_option('--limit', type='int', default=100,
+            help='Number of entries per request.'),
+        make_option('--pages', type='int', default=10,
+            help='Maximum number of requests per server and pull.'),
+        make_option('--timeout', type='float', default=10,
+            help='Timeout of the requests, in seconds.'),
+        make_option('--interval', type='float', default=None,
+            help='Pull again every INTERVAL seconds instead of exiting.'),
+        make_option('--requested', action='store_true', default=False,
+            help='Only pull the servers which notified new entries.'),
+        )
+
+    def handle_noargs(self, **options):
+        while True:
+            results = federation.pull(workers=options['workers'],
+                    limit=options['limit'], max_pages=options['pages'],
+                    timeout=options['timeout'],
+                    requested_only=options['requested'])
+            for (hostname, result) in sorted(results.items()):
+                if isinstance(result, tuple):
+                    self.stdout.write('%s: %i created, %i updated\n' %
+                            ((hostname,) + result))
+                else:
+                    self.stderr.write('%s: %s\n' % (hostname, result))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
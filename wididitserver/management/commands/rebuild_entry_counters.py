@@ -0,0 +1,27 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from wididitserver.models import EntryCounter
+
+class Command(NoArgsCommand):
+    help = 'Sets the counters used to number the entries of each people ' \
+            'from the existing entries.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        EntryCounter.objects.rebuild()
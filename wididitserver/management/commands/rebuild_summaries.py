@@ -0,0 +1,33 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from wididitserver.models import Entry
+
+class Command(NoArgsCommand):
+    help = 'Computes the summary and the content length of all the entries.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', type='int', default=1000,
+            help='Number of entries loaded at once.'),
+        )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        changed = Entry.objects.rebuild_summaries(options['batch'])
+        self.stdout.write('%i entries updated.\n' % changed)
@@ -0,0 +1,35 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from wididitserver import counters
+
+class Command(NoArgsCommand):
+    help = 'Repairs the reply, share, follower and following counters, ' \
+            'and shows how many entries and people had wrong counts.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', type='int', default=500,
+            help='Number of rows checked at once.'),
+        )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        stats = counters.reconcile_all(options['batch'])
+        for (type_, count) in sorted(stats.items()):
+            self.stdout.write('%s: %i\n' % (type_, count))
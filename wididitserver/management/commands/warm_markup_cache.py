@@ -0,0 +1,41 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from wididitserver.models import Entry
+from wididitserver import markup
+
+class Command(NoArgsCommand):
+    help = 'Renders the content of the entries which are not in the ' \
+            'markup cache.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', type='int', default=500,
+            help='Number of entries loaded at once.'),
+        )
+
+    def handle_noargs(self, **options):
+        rendered = 0
+        last = 0
+        query = Entry.objects.only('id', 'content', 'updated').order_by('pk')
+        while True:
+            entries = list(query.filter(pk__gt=last)[:options['batch']])
+            if not entries:
+                break
+            rendered += markup.warm(entries)
+            last = entries[-1].pk
+        self.stdout.write('%i entries rendered.\n' % rendered)
@@ -0,0 +1,73 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rendering of the content of the entries for the web interface.
+
+The HTML of each entry is rendered when it is saved, and kept in a cache
+(`WIDIDIT_MARKUP_CACHE`, an alias of settings.CACHES) for each version of
+the entry, so page views do not parse the Markdown again."""
+
+from django.core.cache import get_cache
+from django.utils.safestring import mark_safe
+from django.template.defaultfilters import force_escape
+from django.contrib.markup.templatetags.markup import markdown
+
+from wididitserver.utils import settings
+
+def get_markup_cache():
+    return get_cache(getattr(settings, 'WIDIDIT_MARKUP_CACHE', 'default'))
+
+def _timeout():
+    return getattr(settings, 'WIDIDIT_MARKUP_CACHE_TTL', 86400)
+
+def _key(entry):
+    return 'wididit:markup:%i:%s' % (entry.id,
+            entry.updated.strftime('%Y%m%d%H%M%S%f'))
+
+def render(content):
+    """Returns the HTML of the content of an entry."""
+    return markdown(force_escape(content))
+
+def rendered_content(entry):
+    """Returns the HTML of the content of the entry, from the cache if
+    possible."""
+    if entry.id is None or entry.updated is None:
+        # Not saved (previews).
+        return render(entry.content)
+    cache = get_markup_cache()
+    html = cache.get(_key(entry))
+    if html is None:
+        html = render(entry.content)
+        cache.set(_key(entry), unicode(html), _timeout())
+    return mark_safe(html)
+
+def cache_entry(entry):
+    """Renders the content of the entry in the cache."""
+    get_markup_cache().set(_key(entry), unicode(render(entry.content)),
+            _timeout())
+
+def uncache_entry(entry):
+    get_markup_cache().delete(_key(entry))
+
+def warm(entries):
+    """Renders the content of the entries which are not in the cache, and
+    returns their number."""
+    cache = get_markup_cache()
+    keys = dict((x.id, _key(x)) for x in entries)
+    cached = cache.get_many(keys.values())
+    rendered = dict((keys[x.id], unicode(render(x.content)))
+            for x in entries if keys[x.id] not in cached)
+    cache.set_many(rendered, _timeout())
+    return len(rendered)
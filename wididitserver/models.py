@@ -14,26 +14,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import json
+import datetime
 import textwrap
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.base import ModelState
 from django.contrib import admin
 from django import forms
 from django.forms.forms import BoundField
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User, AnonymousUser
-from django.dispatch import Signal
 from django.core.signals import request_finished
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.utils.html import conditional_escape
 from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 
 from wididit import constants, utils
 
-from wididitserver.utils import settings
+from wididitserver.utils import settings, update_rows
 from wididitserver.fields import EntryField, PeopleField, TagField
+from wididitserver.lrucache import LRUCache
+from wididitserver.pistonextras import forget_credentials
 
 
 ##########################################################################
@@ -43,21 +47,117 @@ class Atomizable:
     """Parent class for all models compatible with the Atom protocol."""
     pass
 
+class HasCounters(object):
+    """Parent class of the models with denormalized counters (the fields
+    named in `counter_fields`), which are only changed by UPDATEs (see
+    wididitserver.counters). Saving an instance loaded from the database
+    leaves them as they are in the database, instead of writing back the
+    values loaded with the instance, which may be stale by then."""
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if self._state.adding or self.pk is None:
+            return super(HasCounters, self).save(*args, **kwargs)
+        # Django 1.4 has no update_fields: the counters are set to
+        # themselves instead.
+        loaded = [(x, getattr(self, x)) for x in self.counter_fields]
+        for (name, value) in loaded:
+            setattr(self, name, models.F(name))
+        try:
+            super(HasCounters, self).save(*args, **kwargs)
+        finally:
+            for (name, value) in loaded:
+                setattr(self, name, value)
+
 _username_regexp = re.compile(constants.USERNAME_REGEXP)
 def validate_username(value):
     if value == '' or not _username_regexp.match(value):
         raise ValidationError(u'%s is not a valid username.' % value)
 
+# Caches of the identities: hostname -> Server and (username, server id) ->
+# People. Missing identities are cached as None.
+_server_cache = LRUCache(
+        getattr(settings, 'WIDIDIT_IDENTITY_CACHE_SIZE', 1000),
+        getattr(settings, 'WIDIDIT_IDENTITY_CACHE_TTL', 300))
+_people_cache = LRUCache(
+        getattr(settings, 'WIDIDIT_IDENTITY_CACHE_SIZE', 1000),
+        getattr(settings, 'WIDIDIT_IDENTITY_CACHE_TTL', 300))
+
+def _copy_instance(instance):
+    """Returns a copy of a cached instance, so callers can modify it
+    without altering the cache."""
+    copy = instance.__class__.__new__(instance.__class__)
+    copy.__dict__.update(instance.__dict__)
+    copy._state = ModelState()
+    copy._state.db = instance._state.db
+    copy._state.adding = instance._state.adding
+    return copy
+
 def get_server(hostname=None):
     if hostname is None:
         hostname = settings.WIDIDIT_HOSTNAME
-    return Server.objects.get(hostname=hostname)
+    try:
+        server = _server_cache.get(hostname)
+    except KeyError:
+        try:
+            server = Server.objects.get(hostname=hostname)
+        except Server.DoesNotExist:
+            server = None
+        _server_cache.set(hostname, server)
+    if server is None:
+        raise Server.DoesNotExist('Server matching query does not exist.')
+    return _copy_instance(server)
 
 def get_people(userid):
     username, servername = utils.userid2tuple(userid,
             settings.WIDIDIT_HOSTNAME)
     server = get_server(servername)
-    return People.objects.get(username=username, server=server)
+    key = (username, server.id)
+    try:
+        people = _people_cache.get(key)
+    except KeyError:
+        try:
+            people = People.objects.get(username=username, server=server)
+            people.server = server
+        except People.DoesNotExist:
+            people = None
+        _people_cache.set(key, people)
+    if people is None:
+        raise People.DoesNotExist('People matching query does not exist.')
+    people = _copy_instance(people)
+    people.server = get_server(servername)
+    return people
+
+def get_people_list(userids):
+    """Returns a dict mapping the given userids to the People they refer
+    to, with one query for all of them. Unknown (or invalid) userids are
+    left out."""
+    wanted = {}
+    for userid in userids:
+        try:
+            wanted.setdefault(utils.userid2tuple(userid,
+                settings.WIDIDIT_HOSTNAME), []).append(userid)
+        except ValueError:
+            pass
+    if not wanted:
+        return {}
+    query = People.objects.select_related('server').filter(
+            username__in=set(x[0] for x in wanted),
+            server__hostname__in=set(x[1] for x in wanted))
+    found = {}
+    for people in query:
+        key = (people.username, people.server.hostname)
+        for userid in wanted.get(key, []):
+            found[userid] = people
+    return found
+
+def identity_cache_stats():
+    """Returns the hits, misses and size of the identity caches."""
+    return {'server': _server_cache.stats(), 'people': _people_cache.stats()}
+
+def clear_identity_caches():
+    _server_cache.clear()
+    _people_cache.clear()
 
 
 ##########################################################################
@@ -75,6 +175,14 @@ class Server(models.Model):
     def __unicode__(self):
         return self.hostname
 
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def forget_server(sender, instance, **kwargs):
+    _server_cache.discard(instance.hostname)
+    # The hostname may have changed.
+    _server_cache.discard_values(
+            lambda x: x is not None and x.id == instance.id)
+
 class ServerAdmin(admin.ModelAdmin):
     pass
 admin.site.register(Server, ServerAdmin)
@@ -88,7 +196,7 @@ class ServerForm(forms.ModelForm):
 ##########################################################################
 # People
 
-class People(models.Model):
+class People(HasCounters, models.Model):
     server = models.ForeignKey(Server,
             help_text='The server to where this people is register.',
             default=get_server)
@@ -99,6 +207,12 @@ class People(models.Model):
             'this is the associated User instance of this people.',
             blank=True, null=True)
     biography = models.TextField(default='', blank=True)
+    updated = models.DateTimeField(auto_now=True)
+    # Maintained by the PeopleSubscription signals (see
+    # wididitserver.counters).
+    follower_count = models.IntegerField(default=0, editable=False)
+    following_count = models.IntegerField(default=0, editable=False)
+    counter_fields = ('follower_count', 'following_count')
 
     def is_local(self):
         """Returns whether the people is registered on this server."""
@@ -116,6 +230,14 @@ class People(models.Model):
     class Meta:
         unique_together = ('server', 'username',)
 
+@receiver(post_save, sender=People)
+@receiver(post_delete, sender=People)
+def forget_people(sender, instance, **kwargs):
+    _people_cache.discard((instance.username, instance.server_id))
+    # The username may have changed.
+    _people_cache.discard_values(
+            lambda x: x is not None and x.id == instance.id)
+
 class PeopleAdmin(admin.ModelAdmin):
     pass
 admin.site.register(People, PeopleAdmin)
@@ -143,6 +265,8 @@ class PeopleForm(forms.ModelForm):
                 if data['email'] != '':
                     people.user.email = data['email']
                 people.user.save()
+                if data['password'] != '':
+                    forget_credentials(people.user.username)
         if commit:
             people.save()
         return people
@@ -155,43 +279,186 @@ class PeopleForm(forms.ModelForm):
 ##########################################################################
 # Tag
 
+# Cache of the tree of tags: (parent id, name) -> id
+_tag_ids = {}
+
+# Length of Tag.path
+MAX_TAG_PATH_LENGTH = 255
+
+def split_tag_path(path):
+    """Returns the list of the names in a tag path (`#foo#bar` or
+    `foo#bar`)."""
+    return [x for x in path.split('#') if x != '']
+
+def make_tag_path(names):
+    """Reverse of `split_tag_path`."""
+    return u''.join([u'#' + x for x in names])
+
+def valid_tag_path(names):
+    """Returns whether tags with these names fit in the database."""
+    return bool(names) and \
+            max([len(x) for x in names]) <= constants.MAX_TAG_LENGTH and \
+            len(make_tag_path(names)) <= MAX_TAG_PATH_LENGTH
+
 class TagManager(models.Manager):
     def get_or_create_from_path(self, path):
         """Get a Tag from its path."""
-        current_tag = None
-        for tag_name in path.split('#'):
-            if tag_name == '':
-                continue
-            try:
-                current_tag = self.get(name=tag_name, parent=current_tag)
-            except Tag.DoesNotExist:
-                current_tag = Tag(name=tag_name, parent=current_tag)
-                current_tag.save()
-        return current_tag
+        tag_id = self.resolve_paths([path])[path]
+        if tag_id is None:
+            return None
+        return self.get(pk=tag_id)
+
+    def path_get(self, path):
+        """Returns the tag with the given path."""
+        return self.get(path=make_tag_path(split_tag_path(path)))
+
+    def subtree(self, path):
+        """Returns the tag with the given path and all its descendants."""
+        path = make_tag_path(split_tag_path(path))
+        return self.filter(models.Q(path=path) |
+                models.Q(path__startswith=path + '#'))
+
+    def resolve_paths(self, paths):
+        """Returns a dictionnary of the ids of the tags with the given paths
+        (None for empty paths, and for paths too long to be stored: see
+        valid_tag_path), creating the missing tags.
+
+        Known tags are looked up in an in-process cache, and the others with
+        a single query. Missing tags are created with one query per
+        level; they are only cached by the next call, so that the cache
+        does not keep tags whose creation is rolled back."""
+        paths = dict([(path, split_tag_path(path)) for path in paths])
+        invalid = [x for (x, y) in paths.items() if not valid_tag_path(y)]
+        for path in invalid:
+            del paths[path]
+        ids = {}
+        def walk(names):
+            parent = None
+            for name in names:
+                if (parent, name) not in ids:
+                    return False, None
+                parent = ids[(parent, name)]
+            return True, parent
+        def load(tag_paths):
+            for (id_, parent, name) in self.filter(path__in=tag_paths) \
+                    .values_list('id', 'parent', 'name'):
+                ids[(parent, name)] = id_
+
+        tag_paths = set()
+        for path_names in paths.values():
+            parent = None
+            for (i, name) in enumerate(path_names):
+                tag_id = _tag_ids.get((parent, name))
+                if tag_id is None:
+                    tag_paths.update([make_tag_path(path_names[0:j+1])
+                        for j in range(i, len(path_names))])
+                    break
+                ids[(parent, name)] = parent = tag_id
+        if tag_paths:
+            load(tag_paths)
+
+        created = set()
+        depth = 0
+        max_depth = max([len(x) for x in paths.values()] or [0])
+        while depth < max_depth:
+            missing = {}
+            for path_names in paths.values():
+                if len(path_names) <= depth:
+                    continue
+                found, parent = walk(path_names[:depth])
+                if found and (parent, path_names[depth]) not in ids:
+                    missing[(parent, path_names[depth])] = \
+                            make_tag_path(path_names[:depth+1])
+            if missing:
+                sid = transaction.savepoint()
+                try:
+                    self.bulk_create([Tag(parent_id=x, name=name, path=path)
+                        for ((x, name), path) in missing.items()])
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    # Some of them were created by a concurrent transaction.
+                    transaction.savepoint_rollback(sid)
+                    for ((x, name), path) in missing.items():
+                        self.get_or_create(path=path,
+                                defaults={'parent_id': x, 'name': name})
+                load(missing.values())
+                created.update(missing.keys())
+            depth += 1
+
+        if len(_tag_ids) + len(ids) > \
+                getattr(settings, 'WIDIDIT_TAG_CACHE_SIZE', 10000):
+            _tag_ids.clear()
+        _tag_ids.update([x for x in ids.items() if x[0] not in created])
+        result = dict([(path, walk(path_names)[1])
+                for (path, path_names) in paths.items()])
+        result.update((x, None) for x in invalid)
+        return result
+
+    def forget(self, tag):
+        """Removes a tag from the cache."""
+        for (key, tag_id) in _tag_ids.items():
+            if tag_id == tag.id:
+                _tag_ids.pop(key, None)
+
+    def clear_cache(self):
+        _tag_ids.clear()
+
+    def rebuild_paths(self):
+        """Sets the path of all the tags from their names and parents."""
+        tags = dict([(x[0], x[1:]) for x in
+                self.values_list('id', 'parent', 'name', 'path')])
+        paths = {}
+        def get_path(tag_id):
+            if tag_id not in paths:
+                (parent, name, path) = tags[tag_id]
+                prefix = '' if parent is None else get_path(parent)
+                paths[tag_id] = prefix + make_tag_path([name])
+            return paths[tag_id]
+        for tag_id in tags:
+            if get_path(tag_id) != tags[tag_id][2]:
+                self.filter(pk=tag_id).update(path=get_path(tag_id))
 
 class Tag(models.Model):
     name = models.CharField(max_length=constants.MAX_TAG_LENGTH)
     parent = models.ForeignKey('self', null=True, blank=True)
+    # Names of the tag and its ancestors, from the root (eg. #foo#bar).
+    path = models.CharField(max_length=MAX_TAG_PATH_LENGTH, unique=True,
+            editable=False)
 
     objects = TagManager()
 
-    def belongs_to(self, other):
-        if self is other:
-            return True
-        elif self.parent is None:
-            return False
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        if self.parent is None:
+            self.path = make_tag_path([self.name])
         else:
-            return self.parent.belongs_to(other)
+            self.path = self.parent.path + make_tag_path([self.name])
+        if not valid_tag_path(split_tag_path(self.path)):
+            raise ValueError('Tag path too long: %r' % self.path)
+        super(Tag, self).save(*args, **kwargs)
+        if old_path and old_path != self.path:
+            for child in Tag.objects.filter(parent=self):
+                child.save()
+
+    def belongs_to(self, other):
+        return self.path == other.path or \
+                self.path.startswith(other.path + '#')
 
     def __unicode__(self):
-        if self.parent is None:
-            return '#' + self.name
-        else:
-            return u''.join(self.parent, self.name)
+        return self.path
 
     class Meta:
         unique_together = ('name', 'parent',)
 
+@receiver(post_save, sender=Tag)
+def forget_saved_tag(sender, instance, created, **kwargs):
+    if not created:
+        Tag.objects.forget(instance)
+
+@receiver(post_delete, sender=Tag)
+def forget_deleted_tag(sender, instance, **kwargs):
+    Tag.objects.forget(instance)
+
 class TagAdmin(admin.ModelAdmin):
     pass
 admin.site.register(Tag, TagAdmin)
@@ -200,7 +467,132 @@ admin.site.register(Tag, TagAdmin)
 ##########################################################################
 # Entry
 
-class Entry(models.Model, Atomizable):
+_THREAD_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+THREAD_SEGMENT_LENGTH = 7
+MAX_THREAD_PATH_LENGTH = 252
+
+def make_thread_path(parent_path, entry_id):
+    """Returns the thread path of a reply: the path of its parent followed
+    by its id, in base 36 on THREAD_SEGMENT_LENGTH characters, so sorting
+    the entries of a thread by path lists them depth-first, the replies
+    to an entry in the order they were posted.
+    Replies too deep for the path are sorted as siblings of their
+    parent."""
+    segment = ''
+    while entry_id:
+        entry_id, digit = divmod(entry_id, 36)
+        segment = _THREAD_DIGITS[digit] + segment
+    if len(parent_path) + THREAD_SEGMENT_LENGTH > MAX_THREAD_PATH_LENGTH:
+        parent_path = parent_path[:-THREAD_SEGMENT_LENGTH]
+    return parent_path + segment.rjust(THREAD_SEGMENT_LENGTH, '0')
+
+def thread_ancestors(entry):
+    """Returns the ids of the entries the entry replies to, directly or
+    not, which are known from its thread root and path (the ones of the
+    replies too deep for the path are missing)."""
+    if entry.thread_root_id is None:
+        return []
+    path = entry.thread_path[:-THREAD_SEGMENT_LENGTH]
+    return [entry.thread_root_id] + [int(path[i:i+THREAD_SEGMENT_LENGTH], 36)
+            for i in xrange(0, len(path), THREAD_SEGMENT_LENGTH)]
+
+def make_summary(content):
+    """Returns the content, or its first 1000 characters (cut at a
+    whitespace) followed by '...' if it is longer than 500 characters."""
+    if len(content) <= 500:
+        return content
+    # Lines are at most 1000 characters long, so wrapping the beginning of
+    # the content gives the same first line as wrapping all of it (a word
+    # cut at 2000 characters would not fit in it either).
+    lines = textwrap.wrap(content[:2001], 1000, replace_whitespace=False)
+    return (lines[0] if lines else '') + '...'
+
+class EntryManager(models.Manager):
+    def thread(self, entry, depth=None):
+        """Returns the entry and its replies, recursively (up to `depth`
+        levels below the entry), sorted depth-first."""
+        if entry.thread_root_id is None:
+            query = self.filter(models.Q(pk=entry.pk) |
+                    models.Q(thread_root=entry.pk))
+        else:
+            query = self.filter(thread_root=entry.thread_root_id,
+                    thread_path__startswith=entry.thread_path)
+        if depth is not None:
+            query = query.filter(thread_depth__lte=entry.thread_depth + depth)
+        return query.order_by('thread_path')
+
+    def update_threads(self, ids):
+        """Sets the thread root, depth and path of the entries with the
+        given ids, from the (current) ones of their parents, for entries
+        created or moved without Entry.save."""
+        pending = dict(self.filter(id__in=ids)
+                .values_list('id', 'in_reply_to'))
+        parents = set(pending.values()) - set(pending) - set([None])
+        threads = dict((x[0], x[1:]) for x in self.filter(id__in=parents)
+                .values_list('id', 'thread_root', 'thread_depth',
+                    'thread_path'))
+        # The paths are computed from the ones of the parents, level by
+        # level, then written with a few queries.
+        roots = [x for (x, y) in pending.items() if y is None]
+        for i in xrange(0, len(roots), 500):
+            self.filter(id__in=roots[i:i+500]).update(thread_root=None,
+                    thread_depth=0, thread_path='')
+        threads.update((x, (None, 0, '')) for x in roots)
+        for id_ in roots:
+            del pending[id_]
+        changed = {}
+        while pending:
+            # Replies whose parent is already done.
+            ready = [x for (x, y) in pending.items() if y not in pending]
+            if not ready:
+                break # Only possible with a cycle of replies.
+            for id_ in ready:
+                parent = pending.pop(id_)
+                (root, depth, path) = threads[parent]
+                threads[id_] = (root or parent, depth + 1,
+                        make_thread_path(path, id_))
+                changed[id_] = threads[id_]
+        update_rows(self.model, ['thread_root', 'thread_depth', 'thread_path'],
+                changed)
+
+    def rebuild_threads(self, batch_size=1000):
+        """Sets the thread root, depth and path of all the entries, level
+        by level."""
+        self.filter(in_reply_to__isnull=True).update(thread_root=None,
+                thread_depth=0, thread_path='')
+        # Mark the replies as not done.
+        self.filter(in_reply_to__isnull=False).update(thread_depth=0)
+        while True:
+            ids = list(self.filter(thread_depth=0, in_reply_to__isnull=False)
+                    .filter(models.Q(in_reply_to__in_reply_to__isnull=True) |
+                        models.Q(in_reply_to__thread_depth__gt=0))
+                    .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            self.update_threads(ids)
+
+    def rebuild_summaries(self, batch_size=1000):
+        """Computes the summary and the content length of all the entries,
+        and returns the number of entries which were changed. The changed
+        entries of a batch are written with a few queries."""
+        changed = 0
+        last = 0
+        while True:
+            batch = list(self.filter(pk__gt=last).order_by('pk')
+                    .values_list('id', 'content', 'summary',
+                        'content_length')[:batch_size])
+            if not batch:
+                return changed
+            rows = {}
+            for (id_, content, summary, content_length) in batch:
+                values = (make_summary(content), len(content))
+                if (summary, content_length) != values:
+                    rows[id_] = values
+            update_rows(self.model, ['summary', 'content_length'], rows)
+            changed += len(rows)
+            last = batch[-1][0]
+
+class Entry(HasCounters, models.Model, Atomizable):
     # Fields specified in RFC 4287 (Atom Syndication Format)
     id2 = models.IntegerField(null=True, blank=True)
     content = models.TextField()
@@ -221,12 +613,6 @@ class Entry(models.Model, Atomizable):
     title = models.CharField(max_length=constants.MAX_TITLE_LENGTH)
     updated = models.DateTimeField(auto_now=True)
 
-    def summary(self):
-        if len(self.content) <= 500:
-            return self.content
-        else:
-            return textwrap.wrap(self.content, 1000, replace_whitespace=False)[0] + '...'
-
     # Fields specified in RFC 4685 (Atom Threading Extensions)
     in_reply_to = models.ForeignKey('self', null=True, blank=True,
             related_name='entry_in-reply-to')
@@ -234,20 +620,96 @@ class Entry(models.Model, Atomizable):
     # Extra fields:
     tags = models.ManyToManyField(Tag, related_name='tags',
             null=True, blank=True)
+    # First entry of the thread (None for the first entry itself), number
+    # of entries between them, and path in the thread (see
+    # make_thread_path; empty for the first entry).
+    thread_root = models.ForeignKey('self', null=True, blank=True,
+            related_name='thread_entries', editable=False)
+    thread_depth = models.PositiveIntegerField(default=0, editable=False)
+    thread_path = models.CharField(max_length=255, default='', blank=True,
+            db_index=True, editable=False)
+    # Maintained by the Entry and Share signals (see
+    # wididitserver.counters).
+    reply_count = models.IntegerField(default=0, editable=False)
+    share_count = models.IntegerField(default=0, editable=False)
+    counter_fields = ('reply_count', 'share_count')
+    # Computed from the content on save (see make_summary).
+    summary = models.TextField(default='', blank=True, editable=False)
+    content_length = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = EntryManager()
+
+    def __init__(self, *args, **kwargs):
+        super(Entry, self).__init__(*args, **kwargs)
+        # Parent in the database, to update the reply counts when the entry
+        # is moved.
+        self._saved_in_reply_to_id = self.in_reply_to_id
+
+    def update_summary(self):
+        self.summary = make_summary(self.content)
+        self.content_length = len(self.content)
 
     def save(self, *args, **kwargs):
+        from wididitserver import webcache
+        # The cached pages are invalidated once the contributors and the
+        # tags are saved too.
+        with webcache.deferred():
+            self._save(*args, **kwargs)
+
+    def _save(self, *args, **kwargs):
+        if self.id2 is None:
+            self.id2 = EntryCounter.objects.allocate(self.author)
+        self.update_summary()
+
+        old_thread = (self.thread_root_id, self.thread_path)
+        if self.in_reply_to is None:
+            parent = None
+            self.thread_root = None
+            self.thread_depth = 0
+            self.thread_path = ''
+        else:
+            parent = self.in_reply_to
+            self.thread_root_id = parent.thread_root_id or parent.id
+            self.thread_depth = parent.thread_depth + 1
+            if self.pk is not None:
+                self.thread_path = make_thread_path(parent.thread_path,
+                        self.pk)
+        created = self.pk is None
+
         # Prevent ValueError: 'Entry' instance needs to have a primary key
         # value before a many-to-many relationship can be used.
         super(Entry, self).save(*args, **kwargs)
 
+        if created and parent is not None:
+            # The path ends with the id of the entry.
+            self.thread_path = make_thread_path(parent.thread_path, self.pk)
+            Entry.objects.filter(pk=self.pk) \
+                    .update(thread_path=self.thread_path)
+        elif not created and old_thread != (self.thread_root_id,
+                self.thread_path):
+            # Moved to another thread, with its replies.
+            (old_root, old_path) = old_thread
+            if old_root is None:
+                replies = Entry.objects.filter(thread_root=self.pk)
+            else:
+                replies = Entry.objects.filter(thread_root=old_root,
+                        thread_path__startswith=old_path)
+            Entry.objects.update_threads(replies.exclude(pk=self.pk)
+                    .values_list('id', flat=True))
+
         self.contributors = []
         if hasattr(self, '_contributors'):
             for people in self._contributors:
                 self.contributors.add(people)
 
-        tags = utils.get_tags(self.content)
-        self.tags = [Tag.objects.get_or_create_from_path(x) for x in tags]
-        super(Entry, self).save(*args, **kwargs)
+        tags = Tag.objects.resolve_paths(utils.get_tags(self.content))
+        self.tags = [x for x in tags.values() if x is not None]
+
+    @property
+    def rendered_content(self):
+        """HTML of the content (see wididitserver.markup)."""
+        from wididitserver import markup
+        return markup.rendered_content(self)
 
     def can_edit(self, people):
         if people == self.author:
@@ -256,14 +718,14 @@ class Entry(models.Model, Atomizable):
             return people in self.contributors.all()
 
     def add_contributor(self, people):
-        try:
-            self.contributors.add(people)
-        except ValueError:
-            # ValueError: 'Entry' instance needs to have a primary key
-            # value before a many-to-many relationship can be used.
+        if self.pk is None:
+            # A many-to-many relationship cannot be used before the entry
+            # has a primary key: save() adds them.
             if not hasattr(self, '_contributors'):
                 self._contributors = []
             self._contributors.append(people)
+        else:
+            self.contributors.add(people)
 
     def can_delete(self, people):
         return people == self.author
@@ -275,21 +737,76 @@ class Entry(models.Model, Atomizable):
         verbose_name_plural = 'Entries'
         unique_together = ('id2', 'author',)
 
-@receiver(post_save)
-def set_entry_id(sender, **kwargs):
-    entry = kwargs['instance']
-    if not isinstance(entry, Entry) or not kwargs['created']:
-        return
+class EntryCounterManager(models.Manager):
+    def allocate(self, people):
+        """Returns a new id2 for an entry of the people. The UPDATE locks
+        the counter until the end of the transaction: the one of the caller
+        if it manages one, a transaction of its own otherwise (the UPDATE and
+        the read of the counter must not be committed separately)."""
+        if not transaction.is_managed(using=self.db):
+            with transaction.commit_on_success(using=self.db):
+                return self.allocate(people)
+        if not self.filter(people=people) \
+                .update(last_id2=models.F('last_id2') + 1):
+            # First entry since the counters were added.
+            last_id2 = Entry.objects.filter(author=people) \
+                    .aggregate(models.Max('id2'))['id2__max'] or 0
+            sid = transaction.savepoint()
+            try:
+                self.create(people=people, last_id2=last_id2 + 1)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by a concurrent transaction
+                transaction.savepoint_rollback(sid)
+                self.filter(people=people) \
+                        .update(last_id2=models.F('last_id2') + 1)
+        return self.get(people=people).last_id2
+
+    def advance(self, people, id2):
+        """Makes sure the next id2 given to the people is greater than
+        `id2`, for entries created without allocate()."""
+        self.filter(people=people, last_id2__lt=id2).update(last_id2=id2)
+
+    def rebuild(self):
+        """Sets the counters to the greatest id2 of each people."""
+        self.all().delete()
+        counters = Entry.objects.values('author') \
+                .annotate(last_id2=models.Max('id2'))
+        self.bulk_create([EntryCounter(people_id=x['author'],
+                last_id2=x['last_id2'] or 0) for x in counters])
+
+class EntryCounter(models.Model):
+    """Greatest id2 given to the entries of a people."""
+    people = models.OneToOneField(People, related_name='entry_counter')
+    last_id2 = models.IntegerField(default=0)
+
+    objects = EntryCounterManager()
+
+class EntryToken(models.Model):
+    """A word of the content of an entry, in the search index (see
+    wididitserver.search)."""
+    entry = models.ForeignKey(Entry, related_name='tokens')
+    token = models.CharField(max_length=64)
+    frequency = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('token', 'entry',)
 
-    if entry.id2 is not None:
-        return
-    max_id = Entry.objects\
-            .filter(author=entry.author) \
-            .order_by('-id2')[0].id2 or 0
-    entry.id2 = max_id + 1
-    entry.save()
+@receiver(post_save, sender=Entry)
+def index_entry(sender, instance, **kwargs):
+    from wididitserver import search
+    if search.enabled():
+        search.index_entry(instance)
 
-Signal().connect(set_entry_id, Entry)
+@receiver(post_save, sender=Entry)
+def cache_rendered_content(sender, instance, **kwargs):
+    from wididitserver import markup
+    markup.cache_entry(instance)
+
+@receiver(post_delete, sender=Entry)
+def uncache_rendered_content(sender, instance, **kwargs):
+    from wididitserver import markup
+    markup.uncache_entry(instance)
 
 class EntryAdmin(admin.ModelAdmin):
     fieldsets = (
@@ -314,6 +831,11 @@ class EntryForm(forms.ModelForm):
             self._contributors = data['contributors'].split()
             del data['contributors']
         super(EntryForm, self).__init__(data, *args, **kwargs)
+        self.fields['rights'].required = False
+
+    def clean_rights(self):
+        return self.cleaned_data['rights'] or \
+                Entry._meta.get_field('rights').default
 
     def save(self, commit=True, *args, **kwargs):
         self.fields['contributors'].required = False
@@ -346,9 +868,43 @@ class Subscription(models.Model):
 class SubscriptionForm(forms.ModelForm):
     pass
 
+class PeopleSubscriptionManager(models.Manager):
+    def subscribe_many(self, subscriber, targets):
+        """Subscribes the subscriber to the targets (People) it is not
+        subscribed to yet, with one insert, and returns the ids of the
+        new targets. Runs in the transaction of the caller."""
+        targets = dict((x.id, x) for x in targets)
+        existing = set(self.filter(subscriber=subscriber,
+            target_people__in=targets.keys())
+            .values_list('target_people', flat=True))
+        new = [x for x in targets if x not in existing]
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([PeopleSubscription(subscriber=subscriber,
+                target_people_id=x) for x in new])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Some of them were created by a concurrent transaction.
+            # get_or_create sends the post_save signals itself.
+            transaction.savepoint_rollback(sid)
+            return set(x for x in new if self.get_or_create(
+                subscriber=subscriber, target_people_id=x)[1])
+        # bulk_create does not send the post_save signals.
+        if new:
+            add_to_people_counter([subscriber.id], 'following_count',
+                    len(new))
+            add_to_people_counter(new, 'follower_count', 1)
+        if timelines_enabled():
+            for target in new:
+                TimelineEntry.objects.backfill(PeopleSubscription(
+                    subscriber=subscriber, target_people_id=target))
+        return set(new)
+
 class PeopleSubscription(Subscription):
     target_people = models.ForeignKey(People, related_name='target_people')
 
+    objects = PeopleSubscriptionManager()
+
     tag_whitelist = models.TextField(blank=True, null=True)
 
     class Meta:
@@ -382,3 +938,268 @@ class ShareForm(forms.ModelForm):
     class Meta:
         model = Share
         exclude = ('people', 'timestamp',)
+
+
+
+##########################################################################
+# Timeline
+
+def timelines_enabled():
+    """Returns whether timelines are materialized (see
+    WIDIDIT_MATERIALIZED_TIMELINES)."""
+    return getattr(settings, 'WIDIDIT_MATERIALIZED_TIMELINES', False)
+
+class TimelineEntryManager(models.Manager):
+    def _insert(self, timeline_entries):
+        timeline_entries = list(timeline_entries)
+        for i in xrange(0, len(timeline_entries), 500):
+            self.bulk_create(timeline_entries[i:i+500])
+
+    def fanout_entry(self, entry):
+        """Adds a new entry to the timeline of its author's subscribers."""
+        self.fanout_entries([entry])
+
+    def fanout_entries(self, entries):
+        """Adds new entries to the timeline of their authors' subscribers,
+        with one query for all the subscriptions."""
+        subscribers = {}
+        for (target, subscriber) in PeopleSubscription.objects \
+                .filter(target_people__in=set([x.author_id for x in entries])) \
+                .values_list('target_people', 'subscriber'):
+            subscribers.setdefault(target, []).append(subscriber)
+        self._insert([TimelineEntry(subscriber_id=x, entry_id=entry.id,
+                timestamp=entry.published) for entry in entries
+                for x in subscribers.get(entry.author_id, [])])
+
+    def fanout_share(self, share):
+        """Adds a shared entry to the timeline of the sharer's
+        subscribers."""
+        self.fanout_shares([share])
+
+    def fanout_shares(self, shares):
+        """Adds shared entries to the timeline of the sharers'
+        subscribers, with one query for all the subscriptions."""
+        subscribers = {}
+        for (target, subscriber) in PeopleSubscription.objects \
+                .filter(target_people__in=set([x.people_id for x in shares])) \
+                .values_list('target_people', 'subscriber'):
+            subscribers.setdefault(target, []).append(subscriber)
+        self._insert([TimelineEntry(subscriber_id=x, entry_id=share.entry_id,
+                sharer_id=share.people_id, timestamp=share.timestamp)
+                for share in shares
+                for x in subscribers.get(share.people_id, [])])
+
+    def backfill(self, subscription):
+        """Adds the entries written and shared by the target of a
+        subscription to the subscriber's timeline."""
+        subscriber = subscription.subscriber_id
+        target = subscription.target_people_id
+        entries = Entry.objects.filter(author=target) \
+                .values_list('id', 'published')
+        self._insert([TimelineEntry(subscriber_id=subscriber, entry_id=id_,
+                timestamp=published) for (id_, published) in entries])
+        shares = Share.objects.filter(people=target) \
+                .values_list('entry', 'timestamp')
+        self._insert([TimelineEntry(subscriber_id=subscriber, entry_id=entry,
+                sharer_id=target, timestamp=timestamp)
+                for (entry, timestamp) in shares])
+
+    def forget(self, subscription):
+        """Removes from the subscriber's timeline what came from the
+        target of a subscription."""
+        target = subscription.target_people_id
+        self.filter(subscriber=subscription.subscriber_id) \
+                .filter(models.Q(entry__author=target, sharer=None) |
+                        models.Q(sharer=target)) \
+                .delete()
+
+class TimelineEntry(models.Model):
+    """An entry in the materialized timeline of a people.
+
+    There is one row with no `sharer` if the subscriber follows the author
+    of the entry, plus one row per followed people who shared it."""
+    subscriber = models.ForeignKey(People, related_name='timeline')
+    entry = models.ForeignKey(Entry, related_name='timeline_entries')
+    sharer = models.ForeignKey(People, related_name='timeline_shares',
+            null=True, blank=True)
+    timestamp = models.DateTimeField()
+
+    objects = TimelineEntryManager()
+
+    class Meta:
+        verbose_name_plural = 'Timeline entries'
+        unique_together = ('subscriber', 'entry', 'sharer',)
+
+@receiver(post_save, sender=Entry)
+def fanout_entry(sender, instance, created, **kwargs):
+    if created and timelines_enabled():
+        TimelineEntry.objects.fanout_entry(instance)
+
+@receiver(post_save, sender=Share)
+def fanout_share(sender, instance, created, **kwargs):
+    if created and timelines_enabled():
+        TimelineEntry.objects.fanout_share(instance)
+
+@receiver(post_delete, sender=Share)
+def unshare(sender, instance, **kwargs):
+    if timelines_enabled():
+        TimelineEntry.objects.filter(entry=instance.entry_id,
+                sharer=instance.people_id).delete()
+
+@receiver(post_save, sender=PeopleSubscription)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created and timelines_enabled():
+        TimelineEntry.objects.backfill(instance)
+
+@receiver(post_delete, sender=PeopleSubscription)
+def forget_timeline(sender, instance, **kwargs):
+    if timelines_enabled():
+        TimelineEntry.objects.forget(instance)
+
+
+##########################################################################
+# Counters
+
+def add_to_people_counter(ids, field, delta):
+    """Adds `delta` to a counter of the people with the given ids."""
+    # The date of update is used for conditional GETs.
+    People.objects.filter(id__in=ids).update(updated=datetime.datetime.now(),
+            **{field: models.F(field) + delta})
+    ids = set(ids)
+    _people_cache.discard_values(lambda x: x is not None and x.id in ids)
+
+def add_to_entry_counter(ids, field, delta):
+    """Adds `delta` to a counter of the entries with the given ids."""
+    Entry.objects.filter(id__in=ids).update(**{field: models.F(field) + delta})
+
+@receiver(post_save, sender=Entry)
+def count_reply(sender, instance, created, **kwargs):
+    old_parent = None if created else instance._saved_in_reply_to_id
+    if instance.in_reply_to_id != old_parent:
+        if old_parent is not None:
+            add_to_entry_counter([old_parent], 'reply_count', -1)
+        if instance.in_reply_to_id is not None:
+            add_to_entry_counter([instance.in_reply_to_id], 'reply_count', 1)
+    instance._saved_in_reply_to_id = instance.in_reply_to_id
+
+@receiver(post_delete, sender=Entry)
+def uncount_reply(sender, instance, **kwargs):
+    if instance._saved_in_reply_to_id is not None:
+        add_to_entry_counter([instance._saved_in_reply_to_id],
+                'reply_count', -1)
+
+@receiver(post_save, sender=Share)
+def count_share(sender, instance, created, **kwargs):
+    if created:
+        add_to_entry_counter([instance.entry_id], 'share_count', 1)
+
+@receiver(post_delete, sender=Share)
+def uncount_share(sender, instance, **kwargs):
+    add_to_entry_counter([instance.entry_id], 'share_count', -1)
+
+@receiver(post_save, sender=PeopleSubscription)
+def count_subscription(sender, instance, created, **kwargs):
+    if created:
+        add_to_people_counter([instance.subscriber_id], 'following_count', 1)
+        add_to_people_counter([instance.target_people_id],
+                'follower_count', 1)
+
+@receiver(post_delete, sender=PeopleSubscription)
+def uncount_subscription(sender, instance, **kwargs):
+    add_to_people_counter([instance.subscriber_id], 'following_count', -1)
+    add_to_people_counter([instance.target_people_id], 'follower_count', -1)
+
+
+##########################################################################
+# Federation
+
+class FederationState(models.Model):
+    """Where the last pull of the entries of a remote server stopped."""
+    server = models.OneToOneField(Server, related_name='federation_state')
+    cursor = models.CharField(max_length=255, blank=True, default='')
+    last_pull = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    # Set when the server notified us of new entries.
+    pull_requested = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return unicode(self.server)
+
+def outbox_enabled():
+    """Returns whether remote servers are notified of the new entries and
+    shares (see WIDIDIT_FEDERATION_OUTBOX)."""
+    return getattr(settings, 'WIDIDIT_FEDERATION_OUTBOX', False)
+
+class OutboxItemManager(models.Manager):
+    def enqueue(self, people, notification):
+        """Queues a notification for the remote servers of the subscribers
+        of a people."""
+        servers = Server.objects \
+                .filter(people__peoplesubscription_subscriber__target_people=
+                    people) \
+                .exclude(hostname=settings.WIDIDIT_HOSTNAME) \
+                .distinct().values_list('id', flat=True)
+        payload = json.dumps(notification)
+        self.bulk_create([OutboxItem(server_id=x, payload=payload)
+            for x in servers])
+
+class OutboxItem(models.Model):
+    """A notification waiting to be delivered to a remote server."""
+    server = models.ForeignKey(Server, related_name='outbox')
+    payload = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=datetime.datetime.now,
+            db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+
+    objects = OutboxItemManager()
+
+@receiver(post_save, sender=Entry)
+def notify_entry(sender, instance, created, **kwargs):
+    if created and outbox_enabled() and \
+            instance.author.server_id == get_server().id:
+        OutboxItem.objects.enqueue(instance.author, {'type': 'entry',
+            'author': instance.author.userid(), 'id': instance.id2})
+
+@receiver(post_save, sender=Share)
+def notify_share(sender, instance, created, **kwargs):
+    if created and outbox_enabled() and \
+            instance.people.server_id == get_server().id:
+        OutboxItem.objects.enqueue(instance.people, {'type': 'share',
+            'people': instance.people.userid(),
+            'entry': unicode(instance.entry)})
+
+
+##########################################################################
+# Web cache
+
+# See wididitserver.webcache.
+
+@receiver(post_save, sender=Entry)
+def invalidate_saved_entry_pages(sender, instance, created, **kwargs):
+    from wididitserver import webcache
+    names = ['entries', 'people:%i' % instance.author_id]
+    if not created:
+        names.extend('people:%i' % x for x in
+                instance.share_set.values_list('people', flat=True))
+    webcache.invalidate(*names)
+
+@receiver(post_delete, sender=Entry)
+def invalidate_deleted_entry_pages(sender, instance, **kwargs):
+    from wididitserver import webcache
+    # The pages of the people who shared it are invalidated when the
+    # shares are deleted.
+    webcache.invalidate('entries', 'people:%i' % instance.author_id)
+
+@receiver(post_save, sender=Share)
+@receiver(post_delete, sender=Share)
+def invalidate_share_pages(sender, instance, **kwargs):
+    from wididitserver import webcache
+    webcache.invalidate('people:%i' % instance.people_id)
+
+@receiver(post_save, sender=People)
+@receiver(post_delete, sender=People)
+def invalidate_people_pages(sender, instance, **kwargs):
+    from wididitserver import webcache
+    webcache.invalidate('people', 'people:%i' % instance.id)
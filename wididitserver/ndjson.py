@@ -0,0 +1,285 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Export and import of people, entries, shares and subscriptions as
+newline-delimited JSON (one object per line, with a `type` key).
+
+Both work on streams, loading the rows by batches, so their memory usage
+does not depend on the number of rows."""
+
+import json
+import datetime
+import itertools
+
+from wididit import utils
+
+from wididitserver.models import Server, People, Entry, Share
+from wididitserver.models import PeopleSubscription, TimelineEntry
+from wididitserver.models import timelines_enabled, clear_identity_caches
+from wididitserver.utils import settings
+from wididitserver import bulk
+from wididitserver import counters
+from wididitserver import webcache
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _format_date(date):
+    return date.strftime(_DATE_FORMAT)
+
+def _parse_date(date):
+    return datetime.datetime.strptime(date, _DATE_FORMAT)
+
+def _iterate(query, size=500):
+    """Iterates over a queryset by batches of `size` rows, in the order of
+    their primary keys."""
+    last = None
+    while True:
+        batch = query.order_by('pk')
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        batch = list(batch[:size])
+        if not batch:
+            return
+        for item in batch:
+            yield item
+        last = batch[-1].pk
+
+
+##########################################################################
+# Export
+
+def export_lines(authors=None):
+    """Yields the lines of the export of the people (ids) in `authors`,
+    or of everybody."""
+    people = People.objects.select_related('server')
+    entries = Entry.objects.select_related('author__server',
+            'in_reply_to__author__server') \
+            .prefetch_related('contributors__server')
+    shares = Share.objects.select_related('people__server',
+            'entry__author__server')
+    subscriptions = PeopleSubscription.objects.select_related(
+            'subscriber__server', 'target_people__server')
+    if authors is not None:
+        people = people.filter(id__in=authors)
+        entries = entries.filter(author__in=authors)
+        shares = shares.filter(people__in=authors)
+        subscriptions = subscriptions.filter(subscriber__in=authors)
+
+    for x in _iterate(people):
+        yield json.dumps({'type': 'people', 'userid': x.userid(),
+            'biography': x.biography}) + '\n'
+    for x in _iterate(entries):
+        yield json.dumps({'type': 'entry', 'author': x.author.userid(),
+            'id': x.id2, 'title': x.title, 'subtitle': x.subtitle,
+            'content': x.content, 'category': x.category,
+            'generator': x.generator, 'rights': x.rights,
+            'source': x.source,
+            'published': _format_date(x.published),
+            'updated': _format_date(x.updated),
+            'contributors': [y.userid() for y in x.contributors.all()],
+            'in_reply_to': x.in_reply_to and unicode(x.in_reply_to)}) + '\n'
+    for x in _iterate(shares):
+        yield json.dumps({'type': 'share', 'people': x.people.userid(),
+            'entry': unicode(x.entry),
+            'timestamp': _format_date(x.timestamp)}) + '\n'
+    for x in _iterate(subscriptions):
+        yield json.dumps({'type': 'subscription',
+            'subscriber': x.subscriber.userid(),
+            'target': x.target_people.userid(),
+            'tag_blacklist': x.tag_blacklist,
+            'tag_whitelist': x.tag_whitelist}) + '\n'
+
+
+##########################################################################
+# Import
+
+class Importer(object):
+    """Imports the objects given to add(), by batches of objects of the
+    same type. Objects referenced by userid or by entry id ('userid/id2')
+    must have been imported before (or already exist); missing people and
+    servers are created."""
+    TYPES = ('people', 'entry', 'share', 'subscription')
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.stats = dict((x, 0) for x in self.TYPES)
+        self._type = None
+        self._pending = []
+        self._servers = {}
+
+    def add(self, item):
+        if item.get('type') not in self.TYPES:
+            raise ValueError('Unknown type: %r' % item.get('type'))
+        if item['type'] != self._type or \
+                len(self._pending) >= self.batch_size:
+            self.flush()
+        self._type = item['type']
+        self._pending.append(item)
+
+    def flush(self):
+        if self._pending:
+            getattr(self, '_import_' + self._type)(self._pending)
+            self.stats[self._type] += len(self._pending)
+        self._pending = []
+
+    def _server(self, hostname):
+        if hostname not in self._servers:
+            self._servers[hostname] = Server.objects \
+                    .get_or_create(hostname=hostname)[0].id
+        return self._servers[hostname]
+
+    def _people(self, userids, biographies=None):
+        """Returns the ids of the people with the given userids, creating
+        the missing ones (with the given biographies)."""
+        biographies = biographies or {}
+        by_server = {}
+        for userid in set(userids):
+            (username, hostname) = utils.userid2tuple(userid,
+                    settings.WIDIDIT_HOSTNAME)
+            by_server.setdefault(self._server(hostname), {})[username] = \
+                    userid
+        ids = {}
+        for (server, usernames) in by_server.items():
+            existing = dict((x[0], x[1:]) for x in People.objects
+                    .filter(server=server, username__in=usernames.keys())
+                    .values_list('username', 'id', 'biography'))
+            People.objects.bulk_create([People(server_id=server,
+                username=x, biography=biographies.get(y, ''))
+                for (x, y) in usernames.items() if x not in existing])
+            for (username, (id_, biography)) in existing.items():
+                userid = usernames[username]
+                if biographies.get(userid, biography) != biography:
+                    People.objects.filter(id=id_) \
+                            .update(biography=biographies[userid])
+            ids.update((usernames[x], y) for (x, y) in
+                    People.objects
+                    .filter(server=server, username__in=usernames.keys())
+                    .values_list('username', 'id'))
+        return ids
+
+    def _entries(self, references):
+        """Returns the ids of the entries with the given ids
+        ('userid/id2'), or None for unknown entries."""
+        references = [x.rsplit('/', 1) for x in set(references)]
+        people = self._people([x[0] for x in references])
+        ids = dict(((x[0], x[1]), x[2]) for x in Entry.objects
+                .filter(author__in=people.values(),
+                    id2__in=[int(x[1]) for x in references])
+                .values_list('author', 'id2', 'id'))
+        return dict(('%s/%s' % (userid, id2),
+            ids.get((people[userid], int(id2)))) for (userid, id2) in
+            references)
+
+    def _import_people(self, items):
+        self._people([x['userid'] for x in items],
+                dict((x['userid'], x.get('biography', '')) for x in items))
+
+    def _import_entry(self, items):
+        # Replies to entries of the same batch are inserted after them.
+        while items:
+            ids = set('%s/%s' % (x['author'], x['id']) for x in items)
+            first = [x for x in items if x.get('in_reply_to') not in ids]
+            items = [x for x in items if x.get('in_reply_to') in ids]
+            if not first:
+                # Only entries replying to themselves.
+                (first, items) = (items, [])
+            self._insert_entries(first)
+
+    def _insert_entries(self, items):
+        people = self._people([x['author'] for x in items] +
+                sum([x.get('contributors', []) for x in items], []))
+        parents = self._entries([x['in_reply_to'] for x in items
+            if x.get('in_reply_to')])
+        entries = []
+        for item in items:
+            entry = Entry(author_id=people[item['author']], id2=item['id'],
+                    title=item['title'],
+                    subtitle=item.get('subtitle', ''),
+                    content=item['content'],
+                    category=item.get('category', ''),
+                    generator=item.get('generator', ''),
+                    rights=item.get('rights', ''),
+                    source=item.get('source', ''),
+                    published=_parse_date(item['published']),
+                    updated=_parse_date(item['updated']))
+            if item.get('in_reply_to'):
+                entry.in_reply_to_id = parents[item['in_reply_to']]
+            for userid in item.get('contributors', []):
+                entry.add_contributor(People(id=people[userid]))
+            entries.append(entry)
+        bulk.upsert_entries(entries)
+
+    def _import_share(self, items):
+        people = self._people([x['people'] for x in items])
+        entries = self._entries([x['entry'] for x in items])
+        existing = set(Share.objects
+                .filter(people__in=people.values(),
+                    entry__in=[x for x in entries.values() if x is not None])
+                .values_list('people', 'entry'))
+        shares = {}
+        for item in items:
+            key = (people[item['people']], entries[item['entry']])
+            if key[1] is not None and key not in existing:
+                shares[key] = Share(people_id=key[0], entry_id=key[1],
+                        timestamp=_parse_date(item['timestamp']))
+        bulk.insert_raw(Share, shares.values())
+        counters.reconcile_entries(list(set(x[1] for x in shares)))
+        webcache.invalidate(*['people:%i' % x for x in
+            set(x[0] for x in shares)])
+        if timelines_enabled():
+            TimelineEntry.objects.fanout_shares(shares.values())
+
+    def _import_subscription(self, items):
+        people = self._people([x['subscriber'] for x in items] +
+                [x['target'] for x in items])
+        existing = set(PeopleSubscription.objects
+                .filter(subscriber__in=people.values())
+                .values_list('subscriber', 'target_people'))
+        subscriptions = {}
+        for item in items:
+            key = (people[item['subscriber']], people[item['target']])
+            if key not in existing:
+                subscriptions[key] = PeopleSubscription(subscriber_id=key[0],
+                        target_people_id=key[1],
+                        tag_blacklist=item.get('tag_blacklist', ''),
+                        tag_whitelist=item.get('tag_whitelist'))
+        PeopleSubscription.objects.bulk_create(subscriptions.values())
+        counters.reconcile_people(list(set(people.values())))
+        if timelines_enabled():
+            for subscription in subscriptions.values():
+                TimelineEntry.objects.backfill(subscription)
+
+def import_lines(lines, batch_size=500, transaction_size=10000):
+    """Imports the objects of an export, given as an iterable of lines,
+    committing every `transaction_size` lines. Returns the number of
+    imported objects of each type. Raises ValueError (or KeyError) on
+    invalid lines; the lines of the current transaction are not
+    imported."""
+    importer = Importer(batch_size)
+    lines = iter(lines)
+    try:
+        while True:
+            chunk = list(itertools.islice(lines, transaction_size))
+            if not chunk:
+                break
+            with webcache.commit_on_success():
+                for line in chunk:
+                    if line.strip():
+                        importer.add(json.loads(line))
+                importer.flush()
+    finally:
+        # Some people may have been created without signals.
+        clear_identity_caches()
+    return importer.stats
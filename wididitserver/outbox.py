@@ -0,0 +1,156 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Delivery of the notifications queued in the outbox.
+
+Each remote server gets the notifications queued for it in batches, POSTed
+to its federation inbox, which asks it to pull our new entries (see
+wididitserver.federation). Failed deliveries are retried with an
+exponential backoff."""
+
+import datetime
+import threading
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+from django.db.models import Count, Min
+
+from wididitserver.models import Server, OutboxItem
+from wididitserver.utils import settings
+
+def retry_delay(attempts):
+    """Returns the time to wait before the next delivery of a notification
+    which failed `attempts` times."""
+    delay = getattr(settings, 'WIDIDIT_OUTBOX_RETRY_DELAY', 60)
+    max_delay = getattr(settings, 'WIDIDIT_OUTBOX_MAX_RETRY_DELAY', 6*3600)
+    return datetime.timedelta(seconds=min(delay * 2 ** (attempts - 1),
+        max_delay))
+
+def post_notifications(hostname, payloads, timeout=10):
+    """Sends a batch of notifications (as JSON strings) to a server."""
+    scheme = getattr(settings, 'WIDIDIT_FEDERATION_SCHEME', 'http')
+    request = urllib2.Request('%s://%s/api/json/federation/inbox/' %
+            (scheme, hostname),
+            '{"notifications": [%s]}' % ', '.join(payloads),
+            {'Content-Type': 'application/json'})
+    urllib2.urlopen(request, timeout=timeout).close()
+
+def claim(limit):
+    """Returns the notifications which are due, at most `limit` of them
+    (as (id, server id, payload, attempts) tuples), after postponing them
+    by WIDIDIT_OUTBOX_CLAIM_TIMEOUT seconds in a single UPDATE, so the
+    deliveries running at the same time do not send them too. They are
+    deleted or postponed again once sent; those of a delivery which died
+    are sent again after the timeout."""
+    now = datetime.datetime.now()
+    claimed_until = now + datetime.timedelta(seconds=getattr(settings,
+        'WIDIDIT_OUTBOX_CLAIM_TIMEOUT', 3600))
+    due = OutboxItem.objects.filter(next_attempt__lte=now)
+    last = list(due.order_by('id').values_list('id', flat=True)
+            [limit-1:limit])
+    if last:
+        due = due.filter(id__lte=last[0])
+    with transaction.commit_on_success():
+        # The condition on next_attempt is checked again by the UPDATE, so
+        # the rows claimed by another delivery meanwhile are left out.
+        count = due.update(next_attempt=claimed_until)
+    items = list(OutboxItem.objects.filter(next_attempt=claimed_until)
+            .order_by('id')
+            .values_list('id', 'server', 'payload', 'attempts'))
+    if len(items) != count:
+        # Another delivery claimed notifications with the same date (the
+        # database does not store microseconds), and ours cannot be told
+        # apart: they will be sent after the timeout.
+        return []
+    return items
+
+def deliver(workers=4, per_host=1, batch_size=100, limit=10000, timeout=10):
+    """Delivers the notifications which are due, at most `limit` of them,
+    with `workers` threads and at most `per_host` requests to the same
+    server at the same time. Returns the number of delivered, failed and
+    dropped notifications."""
+    items = claim(limit)
+    hostnames = dict(Server.objects
+            .filter(id__in=set([x[1] for x in items]))
+            .values_list('id', 'hostname'))
+
+    # One job per batch of notifications of a server.
+    by_server = {}
+    for item in items:
+        by_server.setdefault(item[1], []).append(item)
+    jobs = []
+    for (server, server_items) in by_server.items():
+        for i in xrange(0, len(server_items), batch_size):
+            jobs.append((hostnames[server], server_items[i:i+batch_size]))
+    semaphores = dict((x, threading.BoundedSemaphore(per_host))
+            for x in hostnames.values())
+    failed_hosts = set()
+
+    def send(job):
+        (hostname, batch) = job
+        if hostname in failed_hosts:
+            # Do not insist on a server which is down.
+            return (batch, 'Previous batch failed.')
+        with semaphores[hostname]:
+            try:
+                post_notifications(hostname, [x[2] for x in batch], timeout)
+            except (IOError, ValueError), e:
+                failed_hosts.add(hostname)
+                return (batch, '%s: %s' % (e.__class__.__name__, e))
+        return (batch, None)
+
+    stats = {'delivered': 0, 'failed': 0, 'dropped': 0}
+    max_attempts = getattr(settings, 'WIDIDIT_OUTBOX_MAX_ATTEMPTS', 20)
+    pool = ThreadPool(max(workers, 1))
+    try:
+        for (batch, error) in pool.imap_unordered(send, jobs):
+            with transaction.commit_on_success():
+                if error is None:
+                    OutboxItem.objects.filter(id__in=[x[0] for x in batch]) \
+                            .delete()
+                    stats['delivered'] += len(batch)
+                    continue
+                by_attempts = {}
+                for (id_, server, payload, attempts) in batch:
+                    by_attempts.setdefault(attempts + 1, []).append(id_)
+                for (attempts, ids) in by_attempts.items():
+                    query = OutboxItem.objects.filter(id__in=ids)
+                    if attempts >= max_attempts:
+                        query.delete()
+                        stats['dropped'] += len(ids)
+                    else:
+                        query.update(attempts=attempts, last_error=error,
+                                next_attempt=datetime.datetime.now() +
+                                    retry_delay(attempts))
+                        stats['failed'] += len(ids)
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+def queue_stats():
+    """Returns the number of queued notifications (total and per server),
+    and the age in seconds of the oldest one."""
+    aggregates = OutboxItem.objects.aggregate(depth=Count('id'),
+            oldest=Min('created'))
+    if aggregates['oldest'] is None:
+        lag = 0
+    else:
+        lag = datetime.datetime.now() - aggregates['oldest']
+        lag = lag.days * 86400 + lag.seconds
+    servers = dict(OutboxItem.objects.values_list('server__hostname')
+            .annotate(Count('id')))
+    return {'depth': aggregates['depth'], 'lag': lag, 'servers': servers}
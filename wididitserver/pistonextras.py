@@ -13,12 +13,119 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import hmac
+import time
+import calendar
+import hashlib
+import itertools
+
 from django import forms
+from django.http import HttpResponse
+from django.db.models.query import QuerySet
+from django.utils import simplejson
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe
+from django.core.cache import cache
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
 
 from piston.authentication import OAuthAuthentication
 from piston.models import Consumer, Token
 from piston.utils import rc
 from piston.resource import Resource
+from piston.emitters import Emitter, JSONEmitter
+from piston.validate_jsonp import is_valid_jsonp_callback_value
+
+from wididitserver.utils import settings
+from wididitserver import querylog
+
+def set_response_header(request, header, value):
+    """Sets a header of the response that will be built from the value
+    returned by the handler."""
+    if not hasattr(request, 'response_headers'):
+        request.response_headers = {}
+    request.response_headers[header] = value
+
+def not_modified(request, validators, last_modified=None):
+    """Sets the ETag (computed from the validators, the URL and the user)
+    and Last-Modified headers of the response, and returns whether the
+    client already has this version (If-None-Match or If-Modified-Since).
+    In that case, the handler can return an HttpResponseNotModified without
+    serializing anything."""
+    user = getattr(request, 'user', None)
+    etag = '"%s"' % hashlib.md5(repr((request.get_full_path(),
+        getattr(user, 'id', None), validators))).hexdigest()
+    set_response_header(request, 'ETag', etag)
+    if last_modified is not None:
+        if timezone.is_aware(last_modified):
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+        else:
+            last_modified = int(time.mktime(last_modified.timetuple()))
+        set_response_header(request, 'Last-Modified', http_date(last_modified))
+
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        etags = [x.strip() for x in
+                request.META['HTTP_IF_NONE_MATCH'].split(',')]
+        return etag in etags or '*' in etags
+    if 'HTTP_IF_MODIFIED_SINCE' in request.META and last_modified is not None:
+        since = parse_http_date_safe(request.META['HTTP_IF_MODIFIED_SINCE'])
+        return since is not None and last_modified <= since
+    return False
+
+def iterate_chunks(query, size):
+    """Yields the objects of a queryset in lists of at most `size` objects,
+    with their related objects loaded by each list (select_related and
+    prefetch_related), without loading the whole result."""
+    # Extra selects are kept, as the queryset may be ordered on them.
+    extra = query.query.extra_select.keys()
+    ids = (x[0] for x in query.values_list('pk', *extra).iterator())
+    while True:
+        chunk = list(itertools.islice(ids, size))
+        if not chunk:
+            return
+        objects = dict((x.pk, x) for x in query.filter(pk__in=chunk))
+        yield [objects[x] for x in chunk if x in objects]
+
+def streaming(request):
+    """Returns whether the response to the request will be streamed, so
+    handlers can return querysets of any size."""
+    return getattr(request, 'emitter_format', None) == 'jsonstream'
+
+class StreamingJSONEmitter(JSONEmitter):
+    """Same output as the JSON emitter, but querysets are serialized and
+    sent by chunks, so the memory used does not depend on their size."""
+    chunk_size = 100
+
+    def render(self, request):
+        if not isinstance(self.data, QuerySet):
+            return super(StreamingJSONEmitter, self).render(request)
+        return HttpResponse(self.stream_json(request),
+                mimetype='application/json; charset=utf-8')
+
+    def stream_json(self, request):
+        cb = request.GET.get('callback', None)
+        if cb and is_valid_jsonp_callback_value(cb):
+            yield '%s(' % cb
+        yield '['
+        separator = ''
+        for chunk in iterate_chunks(self.data, self.chunk_size):
+            emitter = JSONEmitter(chunk, self.typemapper, self.handler,
+                    self.fields, self.anonymous)
+            for item in emitter.construct():
+                yield separator
+                yield simplejson.dumps(item, cls=DateTimeAwareJSONEncoder,
+                        ensure_ascii=False, indent=4)
+                separator = ', '
+        yield ']'
+        if cb and is_valid_jsonp_callback_value(cb):
+            yield ')'
+
+Emitter.register('jsonstream', StreamingJSONEmitter,
+        'application/json; charset=utf-8')
 
 class CsrfExemptResource(Resource):
     """A Custom Resource that is csrf exempt"""
@@ -26,6 +133,64 @@ class CsrfExemptResource(Resource):
         super(CsrfExemptResource, self).__init__(handler, authentication)
         self.csrf_exempt = getattr(self.handler, 'csrf_exempt', True)
 
+    def __call__(self, request, *args, **kwargs):
+        request.response_headers = {}
+        request.emitter_format = self.determine_emitter(request,
+                *args, **kwargs)
+        response = querylog.log_call(
+                '%s %s' % (request.method, self.handler.__class__.__name__),
+                super(CsrfExemptResource, self).__call__, request,
+                *args, **kwargs)
+        for (header, value) in request.response_headers.items():
+            response[header] = value
+        return response
+
+def _credentials_generation_key(username):
+    return 'wididit:credentials-generation:%s' % \
+            hashlib.sha1(username.encode('utf8')).hexdigest()
+
+def _credentials_key(username, password):
+    generation = cache.get(_credentials_generation_key(username), '')
+    if isinstance(username, unicode):
+        username = username.encode('utf8')
+    if isinstance(password, unicode):
+        password = password.encode('utf8')
+    digest = hmac.new(settings.SECRET_KEY,
+            '%s:%s:%s' % (generation, username, password), hashlib.sha256)
+    return 'wididit:credentials:%s' % digest.hexdigest()
+
+def cached_authenticate(username, password):
+    """Same as django.contrib.auth.authenticate, but remembers the verified
+    credentials for a while, so the password hasher is not run on each
+    request."""
+    ttl = getattr(settings, 'WIDIDIT_CREDENTIAL_CACHE_TTL', 300)
+    if not ttl:
+        return authenticate(username=username, password=password)
+    key = _credentials_key(username, password)
+    cached = cache.get(key)
+    if cached is not None:
+        (user_id, password_hash) = cached
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            user = None
+        # The password may have been changed without forget_credentials().
+        if user is not None and user.is_active and \
+                user.password == password_hash:
+            return user
+        cache.delete(key)
+    user = authenticate(username=username, password=password)
+    if user is not None:
+        cache.set(key, (user.id, user.password), ttl)
+    return user
+
+def forget_credentials(username):
+    """Invalidates the cached credentials of the user."""
+    ttl = getattr(settings, 'WIDIDIT_CREDENTIAL_CACHE_TTL', 300)
+    if ttl:
+        cache.set(_credentials_generation_key(username),
+                os.urandom(8).encode('hex'), ttl)
+
 class StrictOAuthAuthentication(OAuthAuthentication):
     def challenge(self, *args, **kwargs):
         return rc.FORBIDDEN
@@ -0,0 +1,192 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counting of the SQL queries run by the API handlers.
+
+With WIDIDIT_QUERY_LOG set, each call to an API resource logs the number
+and the total time of its queries to the `wididitserver.queries` logger,
+and warns about the queries run several times with different parameters
+(usually a query run for each row of a result: an "N+1" query).
+
+In tests, `QueryBudget` checks the queries of each call to an API
+resource against a budget.
+
+The queries run while streaming a response (with the `jsonstream`
+format) are not counted."""
+
+import re
+import time
+import logging
+import functools
+import threading
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends import util
+
+from wididitserver.utils import settings
+
+logger = logging.getLogger('wididitserver.queries')
+
+_local = threading.local()
+
+_placeholders_regexp = re.compile(r'%s(, %s)+')
+_rows_regexp = re.compile(r'(\(%s\))(, \1)+')
+
+def get_shape(sql):
+    """Returns the SQL of a query with its lists of parameters collapsed,
+    so a query gets the same shape whatever the number of values in its
+    `IN (...)` and `VALUES (...)` clauses."""
+    return _rows_regexp.sub(r'\1', _placeholders_regexp.sub('%s', sql))
+
+class _RecordingCursor(util.CursorDebugWrapper):
+    """Debug cursor which also gives its queries, without their
+    parameters, to the active query logs."""
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return super(_RecordingCursor, self).execute(sql, params)
+        finally:
+            _record(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(_RecordingCursor, self).executemany(sql, param_list)
+        finally:
+            _record(sql, time.time() - start)
+
+def _get_logs():
+    if not hasattr(_local, 'logs'):
+        _local.logs = []
+    return _local.logs
+
+def _record(sql, duration):
+    for log in _get_logs():
+        log.queries.append((sql, duration))
+
+class QueryLog(object):
+    """Context manager recording the SQL queries run on the default
+    database, in the current thread, in its block. Logs can be nested."""
+    def __init__(self, name=None):
+        self.name = name
+        self.queries = []
+
+    def __enter__(self):
+        logs = _get_logs()
+        if not logs:
+            db = connections[DEFAULT_DB_ALIAS]
+            self._use_debug_cursor = db.use_debug_cursor
+            db.use_debug_cursor = True
+            db.make_debug_cursor = lambda cursor: _RecordingCursor(cursor, db)
+        logs.append(self)
+        return self
+
+    def __exit__(self, *args):
+        logs = _get_logs()
+        logs.remove(self)
+        if not logs:
+            db = connections[DEFAULT_DB_ALIAS]
+            db.use_debug_cursor = self._use_debug_cursor
+            del db.make_debug_cursor
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(x[1] for x in self.queries)
+
+    def repeated(self, threshold=2):
+        """Returns the shapes of the queries run at least `threshold` times,
+        with their number of runs, the most frequent first."""
+        shapes = {}
+        for (sql, duration) in self.queries:
+            shape = get_shape(sql)
+            shapes[shape] = shapes.get(shape, 0) + 1
+        return sorted([x for x in shapes.items() if x[1] >= threshold],
+                key=lambda x: -x[1])
+
+    def report(self):
+        """Logs the number and the time of the queries, and the queries
+        run at least WIDIDIT_QUERY_LOG_REPEATS times."""
+        logger.info('%s: %i queries in %.3fs', self.name, self.count,
+                self.time)
+        for (shape, count) in self.repeated(
+                getattr(settings, 'WIDIDIT_QUERY_LOG_REPEATS', 3)):
+            logger.warning('%s: query run %i times: %s', self.name, count,
+                    shape)
+
+def _get_budgets():
+    if not hasattr(_local, 'budgets'):
+        _local.budgets = []
+    return _local.budgets
+
+def log_call(name, function, *args, **kwargs):
+    """Calls the function, and reports its queries if WIDIDIT_QUERY_LOG is
+    set, or checks them against the active budgets."""
+    budgets = _get_budgets()
+    if not budgets and not getattr(settings, 'WIDIDIT_QUERY_LOG', False):
+        return function(*args, **kwargs)
+    with QueryLog(name) as log:
+        result = function(*args, **kwargs)
+    if getattr(settings, 'WIDIDIT_QUERY_LOG', False):
+        log.report()
+    for budget in budgets:
+        budget.calls.append(log)
+    return result
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryBudget(object):
+    """Context manager (or decorator) raising QueryBudgetExceeded at the
+    end of its block if an API call of the block ran more than `queries`
+    queries, or a query (shape) more than `repeats` times."""
+    def __init__(self, queries, repeats=None):
+        self.queries = queries
+        self.repeats = repeats
+        self.calls = []
+
+    def __enter__(self):
+        self.calls = []
+        _get_budgets().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _get_budgets().remove(self)
+        if exc_type is None:
+            self.check()
+
+    def check(self):
+        errors = []
+        for log in self.calls:
+            if log.count > self.queries:
+                errors.append('%s ran %i queries (budget: %i):\n%s' %
+                        (log.name, log.count, self.queries,
+                            '\n'.join(x[0] for x in log.queries)))
+            if self.repeats is not None:
+                for (shape, count) in log.repeated(self.repeats + 1):
+                    errors.append('%s ran %i times (budget: %i): %s' %
+                            (log.name, count, self.repeats, shape))
+        if errors:
+            raise QueryBudgetExceeded('\n\n'.join(errors))
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with QueryBudget(self.queries, self.repeats):
+                return function(*args, **kwargs)
+        return wrapper
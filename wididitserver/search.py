@@ -0,0 +1,130 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Inverted index of the content of the entries.
+
+The index is only used when WIDIDIT_SEARCH_INDEX is set in the settings.
+It is kept up to date by the Entry signals, and can be rebuilt with
+`./manage.py rebuild_search_index`."""
+
+import re
+
+from wididitserver.models import Entry, EntryToken
+from wididitserver.utils import settings
+
+_token_regexp = re.compile(r'\w+', re.UNICODE)
+
+def enabled():
+    """Returns whether the search index is enabled."""
+    return getattr(settings, 'WIDIDIT_SEARCH_INDEX', False)
+
+def tokenize(text):
+    """Returns the list of the words in the text, lowercased."""
+    max_length = EntryToken._meta.get_field('token').max_length
+    return [x.lower()[:max_length] for x in _token_regexp.findall(text)]
+
+def _make_tokens(entry_id, content):
+    frequencies = {}
+    for token in tokenize(content):
+        frequencies[token] = frequencies.get(token, 0) + 1
+    return [EntryToken(entry_id=entry_id, token=token, frequency=frequency)
+            for (token, frequency) in frequencies.items()]
+
+def index_entry(entry):
+    """Updates the index of an entry if its content changed since it was
+    last indexed."""
+    if getattr(entry, '_indexed_content', None) == entry.content:
+        return
+    EntryToken.objects.filter(entry=entry).delete()
+    EntryToken.objects.bulk_create(_make_tokens(entry.id, entry.content))
+    entry._indexed_content = entry.content
+
+def index_entries(entries):
+    """Adds a batch of entries, given as (id, content) tuples, to the index.
+    They must not be indexed yet."""
+    tokens = []
+    for (entry_id, content) in entries:
+        tokens.extend(_make_tokens(entry_id, content))
+    EntryToken.objects.bulk_create(tokens)
+
+def parse_query(query_string):
+    """Splits a query string the same way as
+    `wididitserver.utils.auto_query`. Returns a tuple of three lists: the
+    phrases (wrapped in quotes), the keywords and the excluded keywords
+    (starting with a `-`)."""
+    phrases = []
+    rest = query_string
+    open_quote_position = None
+    for offset, char in enumerate(query_string):
+        if char == '"':
+            if open_quote_position is not None:
+                phrase = query_string[open_quote_position + 1:offset]
+                if phrase:
+                    phrases.append(phrase)
+                rest = rest.replace('"%s"' % phrase, '', 1)
+                open_quote_position = None
+            else:
+                open_quote_position = offset
+
+    keywords = []
+    excluded = []
+    for keyword in rest.split():
+        if keyword.startswith('-') and len(keyword) > 1:
+            excluded.append(keyword[1:])
+        else:
+            keywords.append(keyword)
+    return phrases, keywords, excluded
+
+def _with_token(token):
+    return EntryToken.objects.filter(token=token).values('entry')
+
+def search(query, query_string):
+    """Filters an Entry queryset with the index, with the same syntax as
+    `wididitserver.utils.auto_query`, except that words only match whole
+    words."""
+    phrases, keywords, excluded = parse_query(query_string)
+    for phrase in phrases:
+        tokens = tokenize(phrase)
+        for token in set(tokens):
+            query = query.filter(id__in=_with_token(token))
+        if len(tokens) != 1 or tokens[0] != phrase.lower():
+            # Check the words are in the right order, on the few entries
+            # containing all of them.
+            query = query.filter(content__contains=phrase)
+    for keyword in keywords:
+        for token in set(tokenize(keyword)):
+            query = query.filter(id__in=_with_token(token))
+    for keyword in excluded:
+        for token in set(tokenize(keyword)):
+            query = query.exclude(id__in=_with_token(token))
+    return query
+
+def rank(query, query_string):
+    """Sorts an Entry queryset by relevance for the query string (the
+    number of occurrences of its words in the entry)."""
+    phrases, keywords, excluded = parse_query(query_string)
+    tokens = set()
+    for x in phrases + keywords:
+        tokens.update(tokenize(x))
+    if not tokens:
+        return query.order_by('-updated', '-id')
+    sql = 'SELECT COALESCE(SUM(frequency), 0) FROM %s WHERE %s.entry_id = ' \
+            '%s.id AND %s.token IN (%s)' % (
+            EntryToken._meta.db_table, EntryToken._meta.db_table,
+            Entry._meta.db_table, EntryToken._meta.db_table,
+            ', '.join(['%s'] * len(tokens)))
+    return query.extra(select={'search_score': sql},
+            select_params=list(tokens)) \
+            .order_by('-search_score', '-updated', '-id')
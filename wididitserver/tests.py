@@ -5,20 +5,53 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import re
 import json
+import datetime
 import base64
+import socket
+import urllib
+import threading
+import BaseHTTPServer
+from xml.dom import minidom
 
 from django.test import TestCase
 from django.test.client import Client
+from django.contrib.auth.models import User
+
+from wididitserver.models import Entry, EntryCounter, Tag, People, Server
+from wididitserver.models import FederationState, OutboxItem
+from wididitserver.models import PeopleSubscription
+from wididitserver.models import get_people, identity_cache_stats
+from wididitserver.models import clear_identity_caches, make_summary
+from wididitserver.utils import settings
+from wididitserver import search
+from wididitserver import atom
+from wididitserver import federation
+from wididitserver import bulk
+from wididitserver import outbox
+from wididitserver import ndjson
+from wididitserver import counters
+from wididitserver import benchmark
+from wididitserver import loadtest
+from wididitserver import markup
+from wididitserver import webcache
+from wididitserver.querylog import QueryLog, QueryBudget
 
 def get_token(login, password):
     return 'Basic ' + base64.b64encode(':'.join([login, password]))
 
 class WididitTestCase(TestCase):
+    # Most queries run by an API call of the tests, and most runs of a
+    # same query in an API call (see QueryBudget).
+    query_budget = None
+
     def getExtras(self, user='tester'):
         return {'HTTP_AUTHORIZATION': get_token(user, 'foo')}
 
     def setUp(self):
+        Tag.objects.clear_cache()
+        clear_identity_caches()
         c = Client()
 
         response = c.post('/api/json/people/', {
@@ -37,9 +70,20 @@ class WididitTestCase(TestCase):
             'password': 'foo'})
         self.assertEqual(response.status_code, 201, response.content)
 
+        if self.query_budget is not None:
+            self._query_budget = QueryBudget(*self.query_budget)
+            self._query_budget.__enter__()
+
+    def tearDown(self):
+        if self.query_budget is not None:
+            self._query_budget.__exit__(None, None, None)
+        super(WididitTestCase, self).tearDown()
 
 
 class TestPeople(TestCase):
+    def setUp(self):
+        clear_identity_caches()
+
     def test_creation(self):
         c = Client()
 
@@ -60,6 +104,14 @@ class TestPeople(TestCase):
         self.assertEqual(len(reply), 1)
         self.assertEqual(reply[0]['username'], 'tester')
 
+        response = c.post('/api/json/people/', {
+            'username': 'tester',
+            'email': 'bar@wididit.net',
+            'password': 'bar'})
+        self.assertEqual(response.status_code, 409, response.content)
+        self.assertEqual(User.objects.get(username='tester').email,
+                'foo@wididit.net')
+
     def test_update(self):
         c = Client()
 
@@ -143,7 +195,121 @@ class TestPeople(TestCase):
         self.assertNotIn('email', reply[0])
         self.assertNotIn('user', reply[0])
 
+    def test_credential_cache(self):
+        c = Client()
+
+        response = c.post('/api/json/people/', {
+            'username': 'tester',
+            'email': 'foo@wididit.net',
+            'password': 'foo'})
+        self.assertEqual(response.status_code, 201, response.content)
+
+        checks = []
+        check_password = User.check_password
+        def counting_check_password(self, raw_password):
+            checks.append(raw_password)
+            return check_password(self, raw_password)
+        User.check_password = counting_check_password
+        try:
+            for i in range(3):
+                response = c.get('/api/json/whoami/',
+                    HTTP_AUTHORIZATION=get_token('tester', 'foo'))
+                self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(checks, ['foo'])
+
+            response = c.put('/api/json/people/tester/', {
+                'username': 'tester',
+                'email': 'foo@wididit.net',
+                'password': 'foo2'},
+                HTTP_AUTHORIZATION=get_token('tester', 'foo'))
+            self.assertEqual(response.status_code, 200, response.content)
+            response = c.get('/api/json/whoami/',
+                HTTP_AUTHORIZATION=get_token('tester', 'foo'))
+            self.assertEqual(response.status_code, 401, response.content)
+            response = c.get('/api/json/whoami/',
+                HTTP_AUTHORIZATION=get_token('tester', 'foo2'))
+            self.assertEqual(response.status_code, 200, response.content)
+        finally:
+            User.check_password = check_password
+
+class TestIdentityCache(WididitTestCase):
+    def testCache(self):
+        people = get_people('tester')
+        hits = identity_cache_stats()['people']['hits']
+        with self.assertNumQueries(0):
+            self.assertEqual(get_people('tester').id, people.id)
+            self.assertEqual(get_people('tester').server.id, people.server.id)
+        self.assertEqual(identity_cache_stats()['people']['hits'], hits + 2)
+
+        # Cached instances are copies.
+        people.biography = 'foo'
+        self.assertEqual(get_people('tester').biography, '')
+        people.save()
+        self.assertEqual(get_people('tester').biography, 'foo')
+
+        self.assertRaises(People.DoesNotExist, get_people, 'nobody')
+        with self.assertNumQueries(0):
+            self.assertRaises(People.DoesNotExist, get_people, 'nobody')
+        People.objects.create(username='nobody', server=people.server)
+        self.assertEqual(get_people('nobody').username, 'nobody')
+
+        People.objects.get(username='tester2').delete()
+        self.assertRaises(People.DoesNotExist, get_people, 'tester2')
+
+class TestTag(TestCase):
+    def setUp(self):
+        Tag.objects.clear_cache()
+
+    def tearDown(self):
+        Tag.objects.clear_cache()
+
+    def testResolve(self):
+        ids = Tag.objects.resolve_paths(['#foo#bar', '#foo', '#baz', ''])
+        self.assertEqual(ids[''], None)
+        foo = Tag.objects.get(name='foo', parent=None)
+        self.assertEqual(ids['#foo'], foo.id)
+        self.assertEqual(Tag.objects.get(pk=ids['#foo#bar']).parent_id, foo.id)
+        self.assertEqual(Tag.objects.get(pk=ids['#baz']).parent_id, None)
+        self.assertEqual(Tag.objects.count(), 3)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Tag.objects.resolve_paths(['#foo#bar']),
+                    {'#foo#bar': ids['#foo#bar']})
+        with self.assertNumQueries(0):
+            self.assertEqual(Tag.objects.resolve_paths(['#foo#bar']),
+                    {'#foo#bar': ids['#foo#bar']})
+
+        Tag.objects.get(pk=ids['#foo#bar']).delete()
+        bar = Tag.objects.resolve_paths(['#foo#bar'])['#foo#bar']
+        self.assertNotEqual(bar, None)
+        self.assertEqual(Tag.objects.get(pk=bar).name, 'bar')
+        self.assertEqual(Tag.objects.count(), 3)
+
+        # Too long to be stored.
+        deep = '#foo' + '#bar' * 100
+        self.assertEqual(Tag.objects.resolve_paths([deep, '#foo']),
+                {deep: None, '#foo': foo.id})
+        self.assertEqual(Tag.objects.count(), 3)
+
+    def testPath(self):
+        bar = Tag.objects.get_or_create_from_path('#foo#bar')
+        self.assertEqual(bar.path, '#foo#bar')
+        self.assertEqual(Tag.objects.path_get('foo#bar'), bar)
+        foo = bar.parent
+        self.assertTrue(bar.belongs_to(foo))
+        self.assertFalse(foo.belongs_to(bar))
+
+        foo.name = 'qux'
+        foo.save()
+        self.assertEqual(Tag.objects.get(pk=bar.pk).path, '#qux#bar')
+        self.assertEqual(list(Tag.objects.subtree('#qux').order_by('path')),
+                [foo, bar])
+
 class TestEntry(WididitTestCase):
+    # The heaviest calls (posting a reply with contributors, deleting an
+    # entry) run about 20 queries.
+    query_budget = (25, 2)
+
     def testPost(self):
         c = Client()
 
@@ -211,6 +377,80 @@ class TestEntry(WididitTestCase):
         self.assertEqual(reply[0]['title'], 'test')
         self.assertEqual(reply[0]['content'], 'This is an editted test')
 
+    def testSummary(self):
+        c = Client()
+        content = ' '.join(['word%i' % i for i in xrange(400)])
+
+        response = c.post('/api/json/entry/', {
+            'content': content,
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/entry/tester/1/')
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(reply['content_length'], len(content))
+        self.assertTrue(reply['summary'].endswith('...'))
+        self.assertTrue(content.startswith(reply['summary'][:-3]))
+        self.assertTrue(len(reply['summary']) <= 1003)
+
+        response = c.put('/api/json/entry/tester/1/', {
+            'content': 'Short',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        entry = Entry.objects.get()
+        self.assertEqual((entry.summary, entry.content_length), ('Short', 5))
+
+        Entry.objects.update(summary='', content_length=0)
+        self.assertEqual(Entry.objects.rebuild_summaries(), 1)
+        self.assertEqual(Entry.objects.rebuild_summaries(), 0)
+        entry = Entry.objects.get()
+        self.assertEqual((entry.summary, entry.content_length), ('Short', 5))
+
+        long_word = 'a' * 3000
+        self.assertEqual(make_summary(long_word), 'a' * 1000 + '...')
+        self.assertEqual(make_summary('b ' + long_word),
+                'b ' + 'a' * 998 + '...')
+
+    def testMarkup(self):
+        c = Client()
+        cache = markup.get_markup_cache()
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is *a* <test>',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        entry = Entry.objects.get()
+        html = markup.render('This is *a* <test>')
+        self.assertFalse('<test>' in html)
+        self.assertEqual(cache.get(markup._key(entry)), html)
+        self.assertEqual(entry.rendered_content, html)
+
+        old_key = markup._key(entry)
+        response = c.put('/api/json/entry/tester/1/', {
+            'content': 'This is an editted test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        entry = Entry.objects.get()
+        self.assertNotEqual(markup._key(entry), old_key)
+        self.assertEqual(cache.get(markup._key(entry)),
+                markup.render('This is an editted test'))
+
+        cache.delete(markup._key(entry))
+        self.assertEqual(markup.warm([entry]), 1)
+        self.assertEqual(markup.warm([entry]), 0)
+        key = markup._key(entry)
+        entry.delete()
+        self.assertEqual(cache.get(key), None)
+
     def testDelete(self):
         c = Client()
 
@@ -360,6 +600,32 @@ class TestEntry(WididitTestCase):
         reply = json.loads(response.content)
         self.assertEqual(len(reply), 2)
 
+        def get_thread(url):
+            response = c.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            return [(x['id'], x['thread_depth'])
+                    for x in json.loads(response.content)]
+        for i in range(2):
+            self.assertEqual(get_thread('/api/json/entry/tester/1/thread/'),
+                    [(1, 0), (2, 1), (4, 2), (3, 1)])
+            self.assertEqual(
+                    get_thread('/api/json/entry/tester/1/thread/?depth=1'),
+                    [(1, 0), (2, 1), (3, 1)])
+            self.assertEqual(
+                    get_thread('/api/json/entry/tester/1/thread/?limit=2'),
+                    [(1, 0), (2, 1)])
+            self.assertEqual(get_thread('/api/json/entry/tester/2/thread/'),
+                    [(2, 1), (4, 2)])
+
+            Entry.objects.update(thread_root=None, thread_depth=0,
+                    thread_path='')
+            Entry.objects.rebuild_threads()
+
+        response = c.get('/api/json/entry/tester/1/thread/?depth=-1')
+        self.assertEqual(response.status_code, 400, response.content)
+        response = c.get('/api/json/entry/tester/5/thread/')
+        self.assertEqual(response.status_code, 404, response.content)
+
     def testShare(self):
         c = Client()
 
@@ -405,8 +671,397 @@ class TestEntry(WididitTestCase):
         reply = json.loads(response.content)
         self.assertEqual(len(reply), 3)
 
+    def testIds(self):
+        c = Client()
+
+        for i in range(2):
+            response = c.post('/api/json/entry/', {
+                'content': 'This is a test',
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+
+        # Counters are created on the fly if they are missing.
+        EntryCounter.objects.all().delete()
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/entry/?author=tester')
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['id'] for x in reply], [1, 2, 3])
+
+        response = c.get('/api/json/entry/?author=tester2')
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['id'] for x in reply], [1])
+
+    def testTags(self):
+        c = Client()
+
+        for i in range(3):
+            response = c.post('/api/json/entry/', {
+                'content': 'This is a test',
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+
+        tags = Tag.objects.resolve_paths(['#foo', '#foo#bar', '#baz'])
+        entries = Entry.objects.order_by('id2')
+        entries[0].tags = [tags['#foo#bar']]
+        entries[1].tags = [tags['#foo'], tags['#baz']]
+        entries[2].tags = [tags['#baz']]
+
+        for (query, ids) in (('tag=%23foo', [1, 2]),
+                ('tag=foo%23bar', [1]),
+                ('tag=%23foo&tag=%23baz', [2]),
+                ('tag=%23foo%20%23baz', [2]),
+                ('tag=%23bar', [])):
+            response = c.get('/api/json/entry/?' + query)
+            self.assertEqual(response.status_code, 200, response.content)
+            reply = json.loads(response.content)
+            self.assertEqual([x['id'] for x in reply], ids, query)
+
+    def testQueryCount(self):
+        c = Client()
+
+        def post_thread():
+            response = c.post('/api/json/entry/', {
+                'content': 'This is a test',
+                'generator': 'API tests',
+                'contributors': 'tester2',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+            entry = Entry.objects.order_by('-id')[0]
+            response = c.post('/api/json/entry/tester/%i/' % entry.id2, {
+                'content': 'This is a reply',
+                'generator': 'API tests',
+                'contributors': 'tester3',
+                'title': 'test',
+                }, **self.getExtras('tester2'))
+            self.assertEqual(response.status_code, 201, response.content)
+            for sharer in ('tester2', 'tester3'):
+                response = c.post('/api/json/share/', {
+                    'entry': 'tester/%i' % entry.id2,
+                    }, **self.getExtras(sharer))
+                self.assertEqual(response.status_code, 201, response.content)
+
+        def count_queries():
+            with QueryLog() as log:
+                response = c.get('/api/json/entry/')
+            self.assertEqual(response.status_code, 200, response.content)
+            # No query per entry.
+            self.assertEqual(log.repeated(5), [])
+            return len(json.loads(response.content)), log.count
+
+        post_thread()
+        (entries, queries) = count_queries()
+        self.assertEqual(entries, 2)
+        for i in range(5):
+            post_thread()
+        self.assertEqual(count_queries(), (12, queries))
+
+        # The entries replied to are serialized recursively.
+        for i in range(5):
+            entry = Entry.objects.order_by('-id')[0]
+            response = c.post('/api/json/entry/%s/%i/' % (
+                entry.author.username, entry.id2), {
+                'content': 'This is a reply',
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+        with QueryLog() as log:
+            response = c.get('/api/json/entry/?limit=1')
+        self.assertEqual(response.status_code, 200, response.content)
+        # The related objects are loaded once for the page and once for all
+        # the parents, whatever the depth.
+        self.assertEqual(log.repeated(3), [])
+        entry = json.loads(response.content)[0]
+        depth = 0
+        while entry['in_reply_to'] is not None:
+            entry = entry['in_reply_to']
+            depth += 1
+        self.assertEqual(depth, 6)
+
+    def testPagination(self):
+        c = Client()
+
+        for i in range(1, 4):
+            response = c.post('/api/json/entry/', {
+                'content': 'Test number %i' % i,
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/entry/?limit=2')
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['id'] for x in reply], [2, 3])
+        before = response['X-Wididit-Before']
+        after = response['X-Wididit-After']
+
+        response = c.get('/api/json/entry/?limit=2&before=%s' % before)
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['id'] for x in reply], [1])
+
+        response = c.get('/api/json/entry/?after=%s' % after)
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply), 0)
+        self.assertEqual(response['X-Wididit-After'], after)
+
+        response = c.post('/api/json/entry/', {
+            'content': 'Test number 4',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/entry/?after=%s' % after)
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['id'] for x in reply], [4])
+
+        response = c.get('/api/json/entry/?before=foo')
+        self.assertEqual(response.status_code, 400, response.content)
+        response = c.get('/api/json/entry/?limit=0')
+        self.assertEqual(response.status_code, 400, response.content)
+
+    def testStreaming(self):
+        c = Client()
+
+        for i in range(1, 4):
+            response = c.post('/api/json/entry/', {
+                'content': 'Test number %i' % i,
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/share/', {
+            'entry': 'tester/2',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        for url in ('entry/', 'entry/?shared&nonative', 'entry/?limit=2',
+                'people/'):
+            response = c.get('/api/json/' + url)
+            self.assertEqual(response.status_code, 200, response.content)
+            expected = json.loads(response.content)
+            response = c.get('/api/jsonstream/' + url)
+            # The content of a streamed response can only be read once.
+            content = response.content
+            self.assertEqual(response.status_code, 200, content)
+            self.assertEqual(json.loads(content), expected)
+
+    def testAtom(self):
+        c = Client()
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a #test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/entry/tester/1/', {
+            'content': 'This is a reply',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/atom/entry/')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response['Content-Type'],
+                'application/atom+xml; charset=utf-8')
+        feed = minidom.parseString(response.content)
+        entries = feed.getElementsByTagName('entry')
+        self.assertEqual(len(entries), 2)
+        reply, entry = entries
+        self.assertEqual(entry.getElementsByTagName('content')[0]
+                .firstChild.data, 'This is a #test')
+        self.assertEqual(entry.getElementsByTagName('category')[0]
+                .getAttribute('term'), '#test')
+        self.assertEqual(reply.getElementsByTagName('thr:in-reply-to')[0]
+                .getAttribute('ref'),
+                entry.getElementsByTagName('id')[0].firstChild.data)
+
+        # The fragments are cached.
+        entries = list(Entry.objects.all())
+        with self.assertNumQueries(0):
+            atom.render_entries(entries)
+
+        response = c.get('/api/atom/people/')
+        self.assertEqual(response.status_code, 400, response.content)
+
+    def testConditionalGet(self):
+        c = Client()
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        for url in ('/api/json/entry/', '/api/json/entry/tester/1/',
+                '/api/json/entry/tester/1/thread/'):
+            response = c.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            etag = response['ETag']
+            self.assertFalse(response.has_header('Last-Modified'))
+
+            response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, response.content)
+            self.assertEqual(response.content, '')
+            response = c.get(url + '?limit=1', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, response.content)
+
+        # A 304 costs the query of the page and the aggregate of its
+        # versions, not the loading of the related objects.
+        response = c.get('/api/json/entry/')
+        with self.assertNumQueries(2):
+            response = c.get('/api/json/entry/',
+                    HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304, response.content)
+
+        response = c.post('/api/json/share/', {
+            'entry': 'tester/1',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.get('/api/json/entry/tester/1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply['shared_by']), 1)
+
+        # Deleting an entry changes the ETag of the list, though no date
+        # changes.
+        response = c.post('/api/json/entry/', {
+            'content': 'This is another test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.get('/api/json/entry/')
+        self.assertEqual(response.status_code, 200, response.content)
+        etag = response['ETag']
+        response = c.delete('/api/json/entry/tester/2/', **self.getExtras())
+        self.assertEqual(response.status_code, 204, response.content)
+        response = c.get('/api/json/entry/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len(json.loads(response.content)), 1)
+
+        response = c.get('/api/json/people/tester/')
+        self.assertEqual(response.status_code, 200, response.content)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        response = c.get('/api/json/people/tester/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304, response.content)
+        response = c.get('/api/json/people/tester/',
+                HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304, response.content)
+
+        # The cached people of this process are not used for the ETag.
+        People.objects.filter(username='tester').update(follower_count=42)
+        response = c.get('/api/json/people/tester/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content)['follower_count'], 42)
+
+
+class TestTransfer(WididitTestCase):
+    def testExportImport(self):
+        c = Client()
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a #test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/entry/tester/1/', {
+            'content': 'This is a reply',
+            'generator': 'API tests',
+            'title': 'test',
+            'contributors': 'tester2',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/share/', {
+            'entry': 'tester/2',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/subscription/tester/people/', {
+            'target_people': 'tester2'}, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/transfer/')
+        self.assertEqual(response.status_code, 401, response.content)
+        response = c.get('/api/json/transfer/', **self.getExtras())
+        self.assertEqual(response.status_code, 403, response.content)
+        User.objects.filter(username='tester').update(is_staff=True)
+        response = c.get('/api/xml/transfer/', **self.getExtras())
+        self.assertEqual(response.status_code, 400, response.content)
+        response = c.get('/api/json/transfer/', **self.getExtras())
+        # The export is streamed: its content can only be read once.
+        export = response.content
+        self.assertEqual(response.status_code, 200, export)
+        self.assertEqual(export, ''.join(ndjson.export_lines()))
+        self.assertEqual(len(export.splitlines()), 3 + 2 + 1 + 1)
+
+        Entry.objects.all().delete()
+        PeopleSubscription.objects.all().delete()
+        EntryCounter.objects.update(last_id2=0)
+
+        response = c.post('/api/json/transfer/', export,
+                content_type='application/x-ndjson', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content), {'people': 3,
+            'entry': 2, 'share': 1, 'subscription': 1})
+        self.assertEqual(''.join(ndjson.export_lines()), export)
+        response = c.post('/api/xml/transfer/', export,
+                content_type='application/x-ndjson', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(minidom.parseString(response.content)
+                .getElementsByTagName('entry')[0].firstChild.data, '2')
+        entry = Entry.objects.get(author__username='tester', id2=2)
+        self.assertEqual(entry.in_reply_to.id2, 1)
+        self.assertEqual(list(Entry.objects.thread(entry.in_reply_to)),
+                [entry.in_reply_to, entry])
+        self.assertEqual([x.path for x in
+            Entry.objects.get(author__username='tester', id2=1).tags.all()],
+            ['#test'])
+
+        # Importing twice does not duplicate anything.
+        ndjson.import_lines(export.splitlines())
+        self.assertEqual(''.join(ndjson.export_lines()), export)
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(Entry.objects.get(pk=response.content).id2, 3)
 
 class TestSubscription(WididitTestCase):
+    # The heaviest calls (batch subscriptions, deleting an entry, with
+    # materialized timelines) run about 20 queries.
+    query_budget = (25, 2)
+
     def testPeople(self):
         c = Client()
 
@@ -508,3 +1163,724 @@ class TestSubscription(WididitTestCase):
         self.assertEqual(response.status_code, 200, response.content)
         reply = json.loads(response.content)
         self.assertEqual(len(reply), 0)
+
+    def testMerge(self):
+        c = Client()
+
+        for target in ('tester2', 'tester3'):
+            response = c.post('/api/json/subscription/tester/people/', {
+                'target_people': target}, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+
+        for content in ('foo', 'bar'):
+            response = c.post('/api/json/entry/', {
+                'content': content,
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/entry/', {
+            'content': 'baz',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        for entry in ('tester/2', 'tester/1'):
+            response = c.post('/api/json/share/', {
+                'entry': entry,
+                }, **self.getExtras('tester3'))
+            self.assertEqual(response.status_code, 201, response.content)
+
+        # The entries of tester were shared after baz was posted.
+        response = c.get('/api/json/entry/timeline/?shared',
+                **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['content'] for x in reply], ['baz', 'bar', 'foo'])
+        response = c.get('/api/json/entry/timeline/?shared&limit=2',
+                **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['content'] for x in reply], ['bar', 'foo'])
+        response = c.get('/api/json/entry/timeline/?shared&before=' +
+                response['X-Wididit-Before'], **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['content'] for x in reply], ['baz'])
+
+        # Sorted by date of share.
+        response = c.get('/api/json/entry/timeline/?shared&nonative&limit=1',
+                **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['content'] for x in reply], ['foo'])
+        response = c.get('/api/json/entry/timeline/?shared&nonative&before=' +
+                response['X-Wididit-Before'], **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual([x['content'] for x in reply], ['bar'])
+
+    def testBatch(self):
+        c = Client()
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.post('/api/json/subscription/tester/people/', {
+            'target_people': 'tester3'}, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.post('/api/json/subscription/tester/people/batch/', {
+            'subscribe': ['tester2', 'tester3', 'nobody']},
+            **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 403, response.content)
+
+        response = c.post('/api/json/subscription/tester/people/batch/', {
+            'subscribe': ['tester2', 'tester3', 'nobody']},
+            **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(reply['subscribe'], {
+            'tester2': 'subscribed',
+            'tester3': 'already subscribed',
+            'nobody': 'not found'})
+        self.assertEqual(reply['unsubscribe'], {})
+
+        response = c.get('/api/json/entry/timeline/', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply), 1)
+
+        tester2 = 'tester2@' + settings.WIDIDIT_HOSTNAME
+        response = c.post('/api/json/subscription/tester/people/batch/',
+                json.dumps({'unsubscribe': ['tester2', tester2, 'tester3']}),
+                content_type='application/json', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(reply['unsubscribe'], {
+            'tester2': 'unsubscribed',
+            tester2: 'unsubscribed',
+            'tester3': 'unsubscribed'})
+
+        response = c.get('/api/json/subscription/tester/people/',
+                **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content), [])
+
+        response = c.get('/api/json/entry/timeline/', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply), 0)
+
+        # URL-encoded forms can repeat the fields too.
+        response = c.post('/api/json/subscription/tester/people/batch/',
+                'subscribe=tester2&subscribe=tester3',
+                content_type='application/x-www-form-urlencoded',
+                **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content)['subscribe'], {
+            'tester2': 'subscribed',
+            'tester3': 'subscribed'})
+
+    def testCounters(self):
+        c = Client()
+
+        def get(url):
+            response = c.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            return json.loads(response.content)
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/entry/tester/1/', {
+            'content': 'This is a reply',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/share/', {
+            'entry': 'tester/1',
+            }, **self.getExtras('tester3'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        reply = get('/api/json/entry/tester/1/')
+        self.assertEqual((reply['reply_count'], reply['share_count']), (1, 1))
+
+        # Cached by the identity cache.
+        reply = get('/api/json/people/tester2/')
+        self.assertEqual(reply['follower_count'], 0)
+        response = c.post('/api/json/subscription/tester/people/', {
+            'target_people': 'tester2'}, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/subscription/tester/people/batch/', {
+            'subscribe': ['tester3']}, **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        response = c.post('/api/json/subscription/tester2/people/', {
+            'target_people': 'tester3'}, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        def get_counts():
+            return [(x['username'], x['follower_count'], x['following_count'])
+                    for x in get('/api/json/people/')]
+        counts = [('tester', 0, 2), ('tester2', 1, 1), ('tester3', 2, 0)]
+        self.assertEqual(get_counts(), counts)
+        reply = get('/api/json/people/tester2/')
+        self.assertEqual(reply['follower_count'], 1)
+
+        People.objects.update(follower_count=7)
+        Entry.objects.update(reply_count=5)
+        self.assertEqual(counters.reconcile_all(), {'entry': 2, 'people': 3})
+        self.assertEqual(counters.reconcile_all(), {'entry': 0, 'people': 0})
+        self.assertEqual(get_counts(), counts)
+
+        response = c.delete('/api/json/entry/tester2/1/',
+                **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 204, response.content)
+        response = c.post('/api/json/subscription/tester/people/batch/', {
+            'unsubscribe': ['tester2', 'tester3']}, **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = get('/api/json/entry/tester/1/')
+        self.assertEqual((reply['reply_count'], reply['share_count']), (0, 1))
+        self.assertEqual(get_counts(),
+                [('tester', 0, 0), ('tester2', 0, 1), ('tester3', 1, 0)])
+
+    def testSaveKeepsCounters(self):
+        c = Client()
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        # Loaded before the share and the subscription.
+        entry = Entry.objects.get(author__username='tester', id2=1)
+        people = People.objects.get(username='tester')
+        response = c.post('/api/json/share/', {
+            'entry': 'tester/1',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.post('/api/json/subscription/tester2/people/', {
+            'target_people': 'tester'}, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        entry.content = 'This is an edited test'
+        entry.save()
+        people.biography = 'Edited'
+        people.save()
+        entry = Entry.objects.get(pk=entry.pk)
+        self.assertEqual((entry.content, entry.share_count),
+                ('This is an edited test', 1))
+        people = People.objects.get(pk=people.pk)
+        self.assertEqual((people.biography, people.follower_count),
+                ('Edited', 1))
+
+class TestMaterializedTimeline(TestSubscription):
+    def setUp(self):
+        self._timelines = getattr(settings, 'WIDIDIT_MATERIALIZED_TIMELINES',
+                False)
+        settings.WIDIDIT_MATERIALIZED_TIMELINES = True
+        super(TestMaterializedTimeline, self).setUp()
+
+    def tearDown(self):
+        settings.WIDIDIT_MATERIALIZED_TIMELINES = self._timelines
+        super(TestMaterializedTimeline, self).tearDown()
+
+    def testDelete(self):
+        c = Client()
+
+        response = c.post('/api/json/subscription/tester/people/', {
+            'target_people': 'tester2'}, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 201, response.content)
+
+        response = c.get('/api/json/entry/timeline/', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply), 1)
+
+        response = c.delete('/api/json/entry/tester2/1/',
+                **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 204, response.content)
+
+        response = c.get('/api/json/entry/timeline/', **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        reply = json.loads(response.content)
+        self.assertEqual(len(reply), 0)
+
+class TestWebCache(WididitTestCase):
+    def setUp(self):
+        webcache.get_page_cache().clear()
+        super(TestWebCache, self).setUp()
+
+    def post(self, title, user='tester'):
+        response = Client().post('/api/json/entry/', {
+            'content': 'This is a test',
+            'generator': 'API tests',
+            'title': title,
+            }, **self.getExtras(user))
+        self.assertEqual(response.status_code, 201, response.content)
+
+    def testIndex(self):
+        c = Client()
+        self.post('First entry')
+
+        response = c.get('/web/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('First entry' in response.content)
+        with QueryLog() as log:
+            response = c.get('/web/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('First entry' in response.content)
+        self.assertEqual(log.count, 0)
+
+        self.post('Second entry', 'tester2')
+        response = c.get('/web/')
+        self.assertTrue('Second entry' in response.content)
+
+        # Pages of logged-in people have a CSRF token; only the list of
+        # entries is cached.
+        self.assertTrue(c.login(username='tester', password='foo'))
+        response = c.get('/web/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('csrfmiddlewaretoken' in response.content)
+        self.assertTrue('Second entry' in response.content)
+
+    def testPeople(self):
+        c = Client()
+        self.post('First entry')
+        self.post('Second entry', 'tester2')
+
+        response = c.get('/web/people/tester/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('First entry' in response.content)
+        self.assertFalse('Second entry' in response.content)
+        response = c.get('/web/people/tester2/')
+        self.assertTrue('Second entry' in response.content)
+
+        response = c.post('/api/json/share/', {
+            'entry': 'tester2/1',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        response = c.get('/web/people/tester/')
+        self.assertTrue('Second entry' in response.content)
+
+        response = c.put('/api/json/entry/tester2/1/', {
+            'content': 'This is an editted test',
+            'generator': 'API tests',
+            'title': 'Editted entry',
+            }, **self.getExtras('tester2'))
+        self.assertEqual(response.status_code, 200, response.content)
+        response = c.get('/web/people/tester/')
+        self.assertTrue('Editted entry' in response.content)
+
+        response = c.get('/web/people/nobody/')
+        self.assertTrue('There is nobody with this name.' in
+                response.content)
+
+    def testPagination(self):
+        c = Client()
+        for i in xrange(3):
+            self.post('Entry %i' % i)
+
+        response = c.get('/web/?limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse('Entry 0' in response.content)
+        self.assertTrue('Entry 2' in response.content)
+        self.assertFalse('class="newer"' in response.content)
+        before = re.search('\\?before=([^"]*)', response.content).group(1)
+
+        response = c.get('/web/', {'limit': 2,
+            'before': urllib.unquote(before)})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Entry 0' in response.content)
+        self.assertFalse('Entry 2' in response.content)
+        self.assertTrue('class="newer"' in response.content)
+
+        response = c.get('/web/?before=foo')
+        self.assertTrue('This page of entries does not exist.' in
+                response.content)
+
+    def testShowEntry(self):
+        c = Client()
+        self.post('First entry')
+
+        response = c.get('/web/entry/tester/1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('First entry' in response.content)
+
+        response = c.get('/web/entry/tester/2/')
+        self.assertTrue('There is no entry with this id.' in
+                response.content)
+        for query in ('limit=0', 'depth=x'):
+            response = c.get('/web/entry/tester/1/?' + query)
+            self.assertTrue('cannot be displayed' in response.content)
+
+    def testDeferred(self):
+        (version,) = webcache.get_versions(['people:1'])
+        with webcache.deferred():
+            with webcache.deferred():
+                webcache.invalidate('people:1')
+            self.assertEqual(webcache.get_versions(['people:1']), [version])
+        self.assertNotEqual(webcache.get_versions(['people:1']), [version])
+
+class TestSearchIndex(WididitTestCase):
+    def setUp(self):
+        self._search_index = getattr(settings, 'WIDIDIT_SEARCH_INDEX', False)
+        settings.WIDIDIT_SEARCH_INDEX = True
+        super(TestSearchIndex, self).setUp()
+
+    def tearDown(self):
+        settings.WIDIDIT_SEARCH_INDEX = self._search_index
+        super(TestSearchIndex, self).tearDown()
+
+    def search(self, query):
+        c = Client()
+        response = c.get('/api/json/entry/?' + query)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [x['content'] for x in json.loads(response.content)]
+
+    def testSearch(self):
+        c = Client()
+
+        for content in ('This is a test', 'This is a second test',
+                'Second thoughts: a test is a test'):
+            response = c.post('/api/json/entry/', {
+                'content': content,
+                'generator': 'API tests',
+                'title': 'test',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+
+        self.assertEqual(self.search('content=tester'), [])
+        self.assertEqual(self.search('content=second'),
+                ['This is a second test', 'Second thoughts: a test is a test'])
+        self.assertEqual(self.search('content=a%20second'),
+                ['This is a second test'])
+        query = search.search(Entry.objects.all(), 'test -second')
+        self.assertEqual([x.content for x in query], ['This is a test'])
+        self.assertEqual(self.search('content=test&order=relevance')[0],
+                'Second thoughts: a test is a test')
+
+        response = c.put('/api/json/entry/tester/1/', {
+            'content': 'This is an edited entry',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.search('content=edited'),
+                ['This is an edited entry'])
+        self.assertEqual(len(self.search('content=test')), 2)
+
+class RemoteServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the API of a remote server, serving the pages of
+    entries in `self.server.pages`."""
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.pages:
+            page = self.server.pages.pop(0)
+        else:
+            page = []
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Wididit-After',
+                'cursor%i' % len(self.server.requests))
+        self.end_headers()
+        self.wfile.write(json.dumps(page))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append((self.path, json.loads(body)))
+        self.send_response(self.server.post_status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class TestFederation(WididitTestCase):
+    def setUp(self):
+        super(TestFederation, self).setUp()
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                RemoteServerHandler)
+        self.httpd.pages = []
+        self.httpd.requests = []
+        self.httpd.posts = []
+        self.httpd.post_status = 200
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.hostname = '127.0.0.1:%i' % self.httpd.server_port
+        self.server = Server.objects.create(hostname=self.hostname)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        super(TestFederation, self).tearDown()
+
+    def makeEntry(self, id_, content, hostname=None, updated='12:00:00'):
+        author = {'username': 'alice', 'biography': '',
+                'server': {'hostname': hostname or self.hostname}}
+        return {'id': id_, 'title': 'test', 'author': author,
+                'content': content, 'contributors': [], 'shared_by': [],
+                'in_reply_to': None, 'published': '2012-01-01 10:00:00',
+                'updated': '2012-01-01 %s' % updated}
+
+    def testPull(self):
+        self.httpd.pages = [[self.makeEntry(1, 'This is a #test'),
+            self.makeEntry(2, 'Another test'),
+            self.makeEntry(1, 'Not from there', 'example.org')]]
+        results = federation.pull(limit=10)
+        self.assertEqual(results, {self.hostname: (2, 0)})
+        self.assertIn(urllib.urlencode({'after': federation.INITIAL_CURSOR}),
+                self.httpd.requests[0])
+
+        alice = People.objects.get(server=self.server, username='alice')
+        entry = Entry.objects.get(author=alice, id2=1)
+        self.assertEqual(entry.content, 'This is a #test')
+        self.assertEqual(entry.published.year, 2012)
+        self.assertEqual([x.path for x in entry.tags.all()], ['#test'])
+        self.assertEqual(Entry.objects.filter(author=alice).count(), 2)
+        self.assertEqual(
+                FederationState.objects.get(server=self.server).cursor,
+                'cursor1')
+
+        self.httpd.pages = [[self.makeEntry(1, 'Edited', updated='13:00:00')]]
+        results = federation.pull(limit=10)
+        self.assertEqual(results, {self.hostname: (0, 1)})
+        self.assertIn('after=cursor1', self.httpd.requests[1])
+        entry = Entry.objects.get(author=alice, id2=1)
+        self.assertEqual(entry.content, 'Edited')
+        self.assertEqual(entry.tags.count(), 0)
+
+    def testUpsert(self):
+        alice = People.objects.create(server=self.server, username='alice')
+        date = datetime.datetime(2012, 1, 1, 10, 0, 0)
+        def make(id2, content, parent=None):
+            return Entry(author=alice, id2=id2, content=content,
+                    in_reply_to=parent, published=date, updated=date)
+        self.assertEqual(bulk.upsert_entries([make(1, 'First'),
+            make(2, 'Second')]), (2, 0))
+        first = Entry.objects.get(author=alice, id2=1)
+        self.assertEqual(first.updated, date)
+
+        # Existing entries are updated in place, foreign keys included.
+        self.assertEqual(bulk.upsert_entries([make(2, 'Reply', first),
+            make(3, 'Third')]), (1, 1))
+        second = Entry.objects.get(author=alice, id2=2)
+        self.assertEqual(second.content, 'Reply')
+        self.assertEqual(second.in_reply_to_id, first.id)
+        self.assertEqual(second.thread_root_id, first.id)
+        self.assertEqual(second.updated, date)
+        self.assertEqual(Entry.objects.get(pk=first.pk).reply_count, 1)
+        self.assertEqual(EntryCounter.objects.allocate(alice), 4)
+
+    def testParseDate(self):
+        self.assertEqual(federation.parse_date('2012-01-01T10:00:00.123'),
+                datetime.datetime(2012, 1, 1, 10, 0, 0, 123000))
+        self.assertEqual(federation.parse_date('2012-01-01T10:00:00'),
+                datetime.datetime(2012, 1, 1, 10, 0, 0))
+        self.assertEqual(federation.parse_date('2012-01-01 10:00:00'),
+                datetime.datetime(2012, 1, 1, 10, 0, 0))
+        self.assertEqual(federation.parse_date('2012-01-01T10:00:00Z'),
+                federation.parse_date('2012-01-01T12:00:00+02:00'))
+        self.assertRaises(ValueError, federation.parse_date, '01/01/2012')
+
+    def testPullApiPayload(self):
+        # The remote server answers with what our own API returns.
+        c = Client()
+        response = c.post('/api/json/entry/', {
+            'content': 'This is a #test',
+            'generator': 'API tests',
+            'title': 'test',
+            }, **self.getExtras())
+        self.assertEqual(response.status_code, 201, response.content)
+        updated = datetime.datetime(2012, 1, 1, 10, 0, 0, 123000)
+        Entry.objects.filter(id2=1).update(updated=updated)
+        response = c.get('/api/json/entry/')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn('"2012-01-01T10:00:00.123"', response.content)
+        page = json.loads(response.content)
+        for item in page:
+            item['author']['server']['hostname'] = self.hostname
+
+        self.httpd.pages = [page]
+        results = federation.pull(limit=10)
+        self.assertEqual(results, {self.hostname: (1, 0)})
+        entry = Entry.objects.get(author__server=self.server, id2=1)
+        self.assertEqual(entry.updated, updated)
+        self.assertEqual(entry.content, 'This is a #test')
+
+    def testUnreachable(self):
+        # Get a port nobody listens to.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        hostname = '127.0.0.1:%i' % sock.getsockname()[1]
+        sock.close()
+        self.server.hostname = hostname
+        self.server.save()
+
+        results = federation.pull(timeout=1)
+        self.assertIsInstance(results[hostname], basestring)
+        state = FederationState.objects.get(server=self.server)
+        self.assertEqual(state.cursor, federation.INITIAL_CURSOR)
+        self.assertNotEqual(state.last_error, '')
+
+    def testOutbox(self):
+        c = Client()
+        outbox_enabled = getattr(settings, 'WIDIDIT_FEDERATION_OUTBOX', False)
+        settings.WIDIDIT_FEDERATION_OUTBOX = True
+        try:
+            bob = People.objects.create(server=self.server, username='bob')
+            PeopleSubscription.objects.create(subscriber=bob,
+                    target_people=get_people('tester'))
+
+            for user in ('tester', 'tester2'):
+                response = c.post('/api/json/entry/', {
+                    'content': 'This is a test',
+                    'generator': 'API tests',
+                    'title': 'test',
+                    }, **self.getExtras(user))
+                self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(outbox.queue_stats()['depth'], 1)
+            self.assertEqual(outbox.queue_stats()['servers'],
+                    {self.hostname: 1})
+
+            # Notifications claimed by another delivery are not sent again.
+            self.assertEqual(len(outbox.claim(10)), 1)
+            self.assertEqual(outbox.deliver(),
+                    {'delivered': 0, 'failed': 0, 'dropped': 0})
+            self.assertEqual(self.httpd.posts, [])
+            OutboxItem.objects.update(next_attempt=datetime.datetime.now())
+
+            self.assertEqual(outbox.deliver(),
+                    {'delivered': 1, 'failed': 0, 'dropped': 0})
+            self.assertEqual(self.httpd.posts, [('/api/json/federation/inbox/',
+                {'notifications': [{'type': 'entry', 'id': 1,
+                    'author': get_people('tester').userid()}]})])
+            self.assertEqual(outbox.queue_stats()['depth'], 0)
+
+            self.httpd.post_status = 500
+            response = c.post('/api/json/share/', {
+                'entry': 'tester2/1',
+                }, **self.getExtras())
+            self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(outbox.deliver(),
+                    {'delivered': 0, 'failed': 1, 'dropped': 0})
+            item = OutboxItem.objects.get()
+            self.assertEqual(item.attempts, 1)
+            self.assertNotEqual(item.last_error, '')
+            # Not retried before the end of the delay.
+            self.assertEqual(outbox.deliver(),
+                    {'delivered': 0, 'failed': 0, 'dropped': 0})
+        finally:
+            settings.WIDIDIT_FEDERATION_OUTBOX = outbox_enabled
+
+    def testInbox(self):
+        c = Client()
+        remote = Server.objects.create(hostname='127.0.0.1:8000')
+        notifications = json.dumps({
+            'notifications': [{'type': 'entry', 'id': 1,
+                'author': 'alice@127.0.0.1:8000'},
+                {'type': 'share', 'entry': 'alice@127.0.0.1:8000/1',
+                'people': 'bob@127.0.0.1:8000'}]})
+
+        # Only the server of the authors can send their notifications.
+        response = c.post('/api/json/federation/inbox/', notifications,
+            content_type='application/json', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 403, response.content)
+        self.assertFalse(FederationState.objects.exists())
+
+        response = c.post('/api/json/federation/inbox/', notifications,
+            content_type='application/json', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(FederationState.objects.get(server=remote)
+                .pull_requested)
+        self.assertEqual(FederationState.objects.count(), 1)
+
+        # Unknown servers are not pulled.
+        response = c.post('/api/json/federation/inbox/', json.dumps({
+            'notifications': [{'type': 'entry', 'id': 1,
+                'author': 'alice@127.0.0.1:8001'}]}),
+            content_type='application/json', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(FederationState.objects.count(), 1)
+
+        response = c.post('/api/json/federation/inbox/', json.dumps({}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400, response.content)
+
+class TestBenchmark(TestCase):
+    def setUp(self):
+        clear_identity_caches()
+
+    def testRun(self):
+        dataset = benchmark.DataSet(people=20, entries=100, clients=2,
+                shares=20, followings=5)
+        report = benchmark.run(dataset, runs=3, warmup=1)
+        json.dumps(report)
+        self.assertEqual(report['dataset']['objects']['people'], 20)
+        self.assertEqual(report['dataset']['objects']['entry'], 100)
+        # One warmup, three timed and three counted posts.
+        self.assertEqual(Entry.objects.count(), 100 + 7)
+        self.assertTrue(Entry.objects.exclude(in_reply_to=None).exists())
+        self.assertEqual(sorted(report['scenarios']),
+                sorted(x[0] for x in benchmark.SCENARIOS))
+        for (name, stats) in report['scenarios'].items():
+            if name != 'share':
+                # Shares may be duplicates.
+                self.assertEqual(stats['errors'], 0, name)
+                self.assertEqual(stats['error_types'], {}, name)
+            self.assertEqual(stats['runs'], 3)
+            self.assertTrue(stats['queries']['p50'] > 0, name)
+            self.assertTrue(stats['latency_ms']['p50'] <=
+                    stats['latency_ms']['p99'], name)
+
+class TestLoadTest(TestCase):
+    def setUp(self):
+        clear_identity_caches()
+
+    def testRun(self):
+        transport = loadtest.ClientTransport()
+        users = loadtest.create_users(transport, 3)
+        self.assertEqual(loadtest.create_users(transport, 3), users)
+        self.assertEqual(People.objects.count(), 3)
+
+        test = loadtest.LoadTest(transport, users,
+                loadtest.parse_mix('timeline=1,entries=1,post=2,share=1,'
+                    'subscribe=1'))
+        report = test.run(1, requests=30)
+        json.dumps(report)
+        self.assertEqual(report['requests'],
+                sum(x['requests'] for x in report['operations'].values()))
+        self.assertTrue(report['throughput'] > 0)
+        self.assertTrue(Entry.objects.exists())
+        for (name, stats) in report['operations'].items():
+            if name != 'share':
+                # Entries may be shared twice.
+                self.assertEqual(stats['errors'], {}, name)
+            self.assertEqual(sum(x[1] for x in stats['histogram']),
+                    stats['requests'])
+        self.assertEqual(loadtest.saturation([report]), 1)
+
+        self.assertEqual(loadtest.classify_error(500,
+            'IntegrityError: columns id2, author_id are not unique'),
+            'IntegrityError')
+        self.assertEqual(loadtest.histogram([0.5, 3, 10000]),
+                [[x, int(x in (1, 5))] for x in loadtest.BUCKETS] +
+                [[None, 1]])
+        self.assertRaises(ValueError, loadtest.parse_mix, 'foo=1')
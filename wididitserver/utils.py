@@ -13,6 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.backends.util import typecast_timestamp
+
 import settings
 
 ##########################################################################
@@ -69,3 +76,117 @@ def auto_query(query, query_string):
             clone = clone.filter(content=cleaned_keyword)
 
     return clone
+
+def update_rows(model, fields, rows, batch_size=500):
+    """Sets the `fields` of rows of the model to different values, with
+    one UPDATE per batch of rows instead of one per row. `rows` maps the
+    primary keys of the rows to the tuples of their new values. Like
+    QuerySet.update, it sends no signal."""
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(x) for x in fields]
+    pk = qn(model._meta.pk.column)
+    rows = rows.items()
+    # Each row takes two parameters per field, and one for the WHERE.
+    size = connection.ops.bulk_batch_size(['id'] + fields * 2, rows)
+    size = max(min(size, batch_size), 1)
+    cursor = connection.cursor()
+    for i in xrange(0, len(rows), size):
+        batch = rows[i:i+size]
+        assignments = []
+        params = []
+        for (j, field) in enumerate(fields):
+            assignments.append('%s = CASE %s %s END' % (qn(field.column), pk,
+                ' '.join(['WHEN %s THEN %s'] * len(batch))))
+            for (id_, values) in batch:
+                params.extend([id_, field.get_db_prep_save(values[j],
+                    connection=connection)])
+        params.extend([id_ for (id_, values) in batch])
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), ', '.join(assignments), pk,
+            ', '.join(['%s'] * len(batch))), params)
+    transaction.commit_unless_managed()
+
+
+##########################################################################
+# Pagination
+
+_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(value, id_):
+    """Returns an opaque cursor pointing to the row with the given sort key
+    and id."""
+    return base64.urlsafe_b64encode('%s|%i' % (value.strftime(_CURSOR_FORMAT),
+        id_))
+
+def decode_cursor(cursor):
+    """Reverse of `encode_cursor`. Raises ValueError if the cursor is not
+    valid."""
+    try:
+        value, id_ = base64.urlsafe_b64decode(str(cursor)).split('|')
+    except TypeError:
+        raise ValueError('Invalid cursor: %r' % cursor)
+    return datetime.datetime.strptime(value, _CURSOR_FORMAT), int(id_)
+
+def get_limit(fields):
+    """Returns the page size requested with `?limit=`, bounded by
+    WIDIDIT_MAX_PAGE_SIZE. Raises ValueError if it is not a positive
+    integer."""
+    max_size = getattr(settings, 'WIDIDIT_MAX_PAGE_SIZE', 500)
+    if 'limit' not in fields:
+        return min(getattr(settings, 'WIDIDIT_PAGE_SIZE', 50), max_size)
+    limit = int(fields['limit'][0])
+    if limit <= 0:
+        raise ValueError('The limit must be positive.')
+    return min(limit, max_size)
+
+def paginate(query, fields, key='updated', expression=None):
+    """Returns a page of the query, sorted by `key` then `id`, and the
+    cursors to give as `?before=` and `?after=` to get the previous and the
+    next page.
+
+    `fields` is a dictionnary of lists (like `dict(request.GET)`). Without
+    cursor, the last page is returned. Raises ValueError if the request is
+    not valid.
+
+    If `key` was added with `query.extra(select=...)`, `expression` is the
+    (sql, params) pair it was computed with, used to compare it to the
+    cursors."""
+    def after_or_before(operator, value, id_):
+        if expression is None:
+            return query.filter(Q(**{key + '__' + operator: value}) |
+                    Q(**{key: value, 'id__' + operator: id_}))
+        (sql, params) = expression
+        sign = {'gt': '>', 'lt': '<'}[operator]
+        return query.extra(where=['%s %s %%s OR (%s = %%s AND %s.id %s %%s)' %
+            (sql, sign, sql, connection.ops.quote_name(
+                query.model._meta.db_table), sign)],
+            params=list(params) + [value] + list(params) + [value, id_])
+
+    limit = get_limit(fields)
+    if 'after' in fields:
+        value, id_ = decode_cursor(fields['after'][0])
+        query = after_or_before('gt', value, id_)
+        page = list(query.order_by(key, 'id')[:limit])
+    else:
+        if 'before' in fields:
+            value, id_ = decode_cursor(fields['before'][0])
+            query = after_or_before('lt', value, id_)
+        page = list(query.order_by('-' + key, '-id')[:limit])
+        page.reverse()
+
+    def get_key(item):
+        value = getattr(item, key)
+        if isinstance(value, basestring):
+            # Values selected with extra() are not converted by SQLite.
+            value = typecast_timestamp(value)
+        return value
+    if page:
+        before = encode_cursor(get_key(page[0]), page[0].id)
+        after = encode_cursor(get_key(page[-1]), page[-1].id)
+    elif 'after' in fields:
+        # Nothing new yet; the client can keep polling with the same cursor.
+        before = None
+        after = fields['after'][0]
+    else:
+        before = after = None
+    return page, before, after
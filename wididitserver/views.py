@@ -3,7 +3,9 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.utils.translation import ugettext as _
 from django.shortcuts import render_to_response
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.db import IntegrityError
@@ -13,8 +15,9 @@ import settings
 from wididit import constants
 from wididitserver.models import validate_username, models
 from wididitserver.models import PeopleForm, EntryForm
-from wididitserver.models import People, Entry
+from wididitserver.models import People, Server, Entry, get_people
 from wididitserver.api import EntryHandler
+from wididitserver import webcache
 
 def error(request, title, message):
     c = RequestContext(request, {
@@ -56,17 +59,63 @@ def api_request(request, handler, mode='read', **kwargs):
     handler = api_handler(request, handler, mode)
     return handler(request, **kwargs)
 
+def entry_list(request, names):
+    """Returns the HTML of the page of entries given by the API for the
+    request (see entrylist.html), which depends on the data with the given
+    names (see wididitserver.webcache), or None if the API refused the
+    request (invalid cursor)."""
+    def render():
+        entries = api_request(request, 'Entry')
+        if isinstance(entries, HttpResponse):
+            return None
+        headers = getattr(request, 'response_headers', {})
+        return render_to_string('wididitserver/entrylist.html', {
+                'entries': entries,
+                'before': headers.get('X-Wididit-Before'),
+                'after': headers.get('X-Wididit-After'),
+                'paginated': 'before' in request.GET or
+                    'after' in request.GET,
+            }, RequestContext(request))
+    html = webcache.cache_fragment('entrylist', names, request, render)
+    return html and mark_safe(html)
+
+def invalid_page(request):
+    return error(request, _('Invalid page'),
+            _('This page of entries does not exist.'))
+
+@webcache.cache_page(lambda request: ['entries', 'people'])
 def index(request):
+    entrylist = entry_list(request, ['entries', 'people'])
+    if entrylist is None:
+        return invalid_page(request)
     c = RequestContext(request, {
-            'entries': api_request(request, 'Entry'),
+            'entrylist': entrylist,
             'post_form' : EntryForm(),
         })
     return render_to_response('wididitserver/index.html', c)
 
+def people_page_names(request, userid):
+    try:
+        return ['people', 'people:%i' % get_people(userid).id]
+    except (People.DoesNotExist, Server.DoesNotExist):
+        return None
+
+@webcache.cache_page(people_page_names)
 def show_people(request, userid):
+    people = api_request(request, 'People', userid=userid)
+    if isinstance(people, HttpResponse):
+        return error(request, _('Unknown people'),
+                _('There is nobody with this name.'))
+    # Entries written or shared by the people.
+    request.GET = request.GET.copy()
+    request.GET.setlist('author', [userid])
+    request.GET['shared'] = '1'
+    entrylist = entry_list(request, people_page_names(request, userid))
+    if entrylist is None:
+        return invalid_page(request)
     c = RequestContext(request, {
-            'people': api_request(request, 'People', userid=userid),
-            'entries': api_request(request, 'Entry', userid=userid),
+            'people': people,
+            'entrylist': entrylist,
         })
     return render_to_response('wididitserver/people.html', c)
 
@@ -173,6 +222,9 @@ def post(request):
 
 def show_entry(request, userid, entryid):
     entry = EntryHandler().read(request, userid=userid, entryid=entryid)
+    if isinstance(entry, HttpResponse):
+        return error(request, _('Unknown entry'),
+                _('There is no entry with this id.'))
     form = EntryForm(instance=entry)
     if request.method == 'POST':
         people = People.objects.get(user=request.user)
@@ -181,8 +233,17 @@ def show_entry(request, userid, entryid):
                     _('You are not authorized to edit this entry.'))
         form = EntryForm(request.POST, instance=entry)
         entry.save()
+    thread = EntryHandler().read(request, mode='thread', userid=userid,
+            entryid=entryid)
+    if isinstance(thread, HttpResponse):
+        # Invalid ?limit= or ?depth=
+        return error(request, _('Invalid request'),
+                _('This thread cannot be displayed with these parameters.'))
+    for reply in thread:
+        reply.reply_depth = reply.thread_depth - entry.thread_depth
     c = RequestContext(request, {
         'entry': entry,
+        'thread': thread[1:],
         'form': form,
         })
     return render_to_response('wididitserver/display_entry.html', c)
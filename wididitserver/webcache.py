@@ -0,0 +1,161 @@
+# Copyright (C) 2011, Valentin Lorentz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caching of the pages and fragments of the web interface.
+
+Cache keys contain the versions of the data the page depends on:
+'entries' (all the entries, and the names of their authors) and
+'people:<id>' (the entries written or shared by this people, and their
+profile). The Entry, Share and People signals increment these versions, so
+the pages are invalidated as soon as what they show changes, without
+having to know the keys of the cached pages.
+
+The versions must only change once the changes are committed: otherwise,
+a page rendered from the old data in the meantime would be cached with
+the new versions. Writes done in a transaction use commit_on_success()
+of this module, which increments the versions after the commit.
+
+The cache is `WIDIDIT_PAGE_CACHE` (an alias of settings.CACHES); it must
+be shared by all the processes of the server, so they see the same
+versions."""
+
+import time
+import hashlib
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from django.core.cache import get_cache
+from django.db import transaction
+from django.utils.translation import get_language
+
+from django_mobile import get_flavour
+
+from wididitserver.utils import settings
+
+def get_page_cache():
+    return get_cache(getattr(settings, 'WIDIDIT_PAGE_CACHE', 'default'))
+
+def get_timeout():
+    return getattr(settings, 'WIDIDIT_PAGE_CACHE_TTL', 300)
+
+# The versions are kept longer than the pages.
+_VERSION_TIMEOUT = 86400
+
+def _version_key(name):
+    return 'wididit:page:version:%s' % name
+
+def get_versions(names):
+    """Returns the current versions of the data with the given names."""
+    cache = get_page_cache()
+    keys = [_version_key(x) for x in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Starting from the time (instead of 0) makes sure the pages of
+            # a version evicted from the cache are not used again.
+            cache.add(key, int(time.time() * 1000), _VERSION_TIMEOUT)
+            versions[key] = cache.get(key)
+    return [versions[x] for x in keys]
+
+_local = threading.local()
+
+def invalidate(*names):
+    """Increments the versions of the data with the given names, at the
+    end of the outermost deferred() block if in one."""
+    if getattr(_local, 'depth', 0):
+        _local.pending.update(names)
+        return
+    cache = get_page_cache()
+    for name in names:
+        try:
+            cache.incr(_version_key(name))
+        except ValueError:
+            # Not in the cache: pages of this version are not used anyway.
+            pass
+
+@contextmanager
+def deferred():
+    """Context manager delaying the invalidations of its block to its end
+    (to the end of the outermost one, when nested)."""
+    depth = getattr(_local, 'depth', 0)
+    if not depth:
+        _local.pending = set()
+    _local.depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.depth = depth
+        if not depth:
+            # Also after a failure: some of the changes may be committed.
+            invalidate(*_local.pending)
+
+@contextmanager
+def commit_on_success():
+    """Same as django.db.transaction.commit_on_success (as a context
+    manager), but the invalidations of the block happen after the
+    commit."""
+    with deferred():
+        with transaction.commit_on_success():
+            yield
+
+def make_key(prefix, names, request, user=None):
+    """Returns the key of a page or fragment depending on the data with
+    the given names, for the URL, flavour and language of the request and
+    the (id of the) logged-in user."""
+    return 'wididit:page:%s:%s' % (prefix, hashlib.md5(repr((
+        get_versions(names), request.get_full_path(), get_flavour(request),
+        get_language(), user))).hexdigest())
+
+def cache_fragment(prefix, names, request, render):
+    """Returns the fragment of the request from the cache, or calls
+    `render()` to get it and caches it (unless it is None). The fragment
+    must not depend on who is logged in."""
+    cache = get_page_cache()
+    key = make_key(prefix, names, request)
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render()
+        if fragment is not None:
+            cache.set(key, fragment, get_timeout())
+    return fragment
+
+def cache_page(names):
+    """Decorator caching the GET responses of a view, for each logged-in
+    user (and for anonymous visitors). `names` is a function taking the
+    arguments of the view and returning the names of the data the page
+    depends on, or None to not cache the page.
+
+    Pages with a CSRF token or setting a cookie are not cached."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+            page_names = names(request, *args, **kwargs)
+            if page_names is None:
+                return view(request, *args, **kwargs)
+            cache = get_page_cache()
+            key = make_key('view:' + view.__name__, page_names, request,
+                    request.user.id)
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.cookies and \
+                        not request.META.get('CSRF_COOKIE_USED'):
+                    cache.set(key, response, get_timeout())
+            return response
+        return wrapper
+    return decorator